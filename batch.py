@@ -0,0 +1,220 @@
+#/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from threading import BoundedSemaphore
+from prettytable import PrettyTable
+from columnar import prepare_shared_memory
+from krano import Krano
+from postgresql import ConnectionPool
+from resources import resolve_parallel_processes
+from workers import WorkerPool
+
+
+class BatchManifestError(Exception):
+    """Raised when a batch manifest cannot be read."""
+    pass
+
+
+class BatchJob(object):
+    """Describes one export of a batch.
+
+    Args:
+        connection_name (str): Name of the database connection, a key of the connection settings of the batch.
+        sql_statement (str): The SQL query to be executed.
+        xlsx_filename (str): Filename of the Excel file to be created.
+        chunk_size (int): Maximum number of rows per Excel file.
+        jira_issue (str): The JIRA issue where the created files should be attached, defaults to None.
+        watermark_column (str): Export only the rows added since the last run of the export, see Krano.export, defaults to None.
+    """
+    def __init__(self, connection_name, sql_statement, xlsx_filename, chunk_size, jira_issue=None, watermark_column=None):
+        self.connection_name = connection_name
+        self.sql_statement = sql_statement
+        self.xlsx_filename = xlsx_filename
+        self.chunk_size = chunk_size
+        self.jira_issue = jira_issue
+        self.watermark_column = watermark_column
+
+    def __repr__(self):
+        repr = "<BatchJob connection_name={0} xlsx_filename={1}>".format(self.connection_name, self.xlsx_filename)
+        return repr
+
+
+class BatchJobResult(object):
+    """Contains the outcome of one export of a batch.
+
+    Args:
+        job (BatchJob): The export.
+        duration (datetime.timedelta): The time needed for the export, including the time waited for a free connection.
+        error (Exception): The error the export failed with, None if it succeeded.
+    """
+    def __init__(self, job, duration, error=None):
+        self.job = job
+        self.duration = duration
+        self.error = error
+
+    def succeeded(self):
+        """Indicates whether the export succeeded."""
+        return self.error is None
+
+
+def load_manifest(filepath):
+    """Reads the exports of a batch from a JSON manifest.
+
+    The manifest is a list of objects with the keys 'connection', 'sql' or 'sql_file' (relative to the manifest),
+    'filename', 'chunk_size' and optionally 'jira_issue' and 'watermark_column'.
+
+    Returns:
+        A list of BatchJob objects.
+
+    Raises:
+        BatchManifestError: The manifest is not a list or one of its entries lacks a key.
+    """
+    with open(filepath, encoding='utf-8') as manifest_file:
+        entries = json.load(manifest_file)
+
+    if not isinstance(entries, list):
+        raise BatchManifestError("The batch manifest {0} must contain a list of exports.".format(filepath))
+
+    jobs = []
+    for position, entry in enumerate(entries, 1):
+        try:
+            if 'sql_file' in entry:
+                sql_filepath = os.path.join(os.path.dirname(os.path.abspath(filepath)), entry['sql_file'])
+                with open(sql_filepath, encoding='utf-8') as sql_file:
+                    sql_statement = sql_file.read()
+            else:
+                sql_statement = entry['sql']
+            jobs.append(BatchJob(entry['connection'], sql_statement, entry['filename'], int(entry['chunk_size']), entry.get('jira_issue'),
+                                 entry.get('watermark_column')))
+        except KeyError as e:
+            raise BatchManifestError("Export no. {0} of the batch manifest {1} lacks the key {2}.".format(position, filepath, e))
+
+    return jobs
+
+
+class BatchExporter(object):
+    """Runs the exports of a batch concurrently, sharing connections and Excel export processes between them.
+
+    One connection pool per database and one process pool for the whole batch are started upfront and kept warm,
+    so the exports do not pay for opening connections and starting processes again and again. At most
+    max_connections_per_database exports run concurrently against the same database.
+
+    Args:
+        connection_settings (dict): The ConnectionSettings objects by connection name.
+        export_folderpath (str): Path to the export folder where the Excel & SQL files will be created.
+        sheet_name (str): Name of the worksheet where the records will occur in the Excel files.
+        overwrite_files (bool): Indicates if already existing Excel files will be overwritten, defaults to False.
+        parallel_processes (int or str): The count of Excel export processes shared by all exports, defaults to 2. 'auto' starts one
+            process per available CPU, each export then limits its chunks in flight by the available memory.
+        max_connections_per_database (int): The maximum count of concurrent exports per database, defaults to 2.
+        jira_config (tuple): The arguments of Krano.set_jira_config, e.g. JIRA base URL, user and password, defaults to None.
+        cache_config (tuple): Folder path, time to live and maximum size of the query result cache, defaults to None (no cache).
+        metrics_config (tuple): The arguments of Krano.set_metrics_config, the folders of the run reports and Prometheus textfiles, defaults to None.
+        decorations_factory (callable): Returns the list of ExcelDecoration objects for a BatchJob, or an awaitable returning it,
+            e.g. a coroutine looking up the JIRA issue title while the query is executed, defaults to None.
+        export_options (dict): Further keyword arguments passed to Krano.export, e.g. stream or xlsx_engine, defaults to None.
+        worker_start_method (str): How the shared worker processes are started: 'forkserver', 'spawn' or 'fork', defaults to 'forkserver'.
+        preflight_config (tuple): The arguments of Krano.set_preflight_config, the limits of exports with preflight=True, defaults to None.
+    """
+    def __init__(self, connection_settings, export_folderpath, sheet_name, overwrite_files=False, parallel_processes=2, max_connections_per_database=2,
+                 jira_config=None, cache_config=None, decorations_factory=None, export_options=None, worker_start_method='forkserver',
+                 metrics_config=None, preflight_config=None):
+        self.connection_settings = connection_settings
+        self.export_folderpath = export_folderpath
+        self.sheet_name = sheet_name
+        self.overwrite_files = overwrite_files
+        self.parallel_processes = parallel_processes
+        self.max_connections_per_database = max_connections_per_database
+        self.jira_config = jira_config
+        self.cache_config = cache_config
+        self.metrics_config = metrics_config
+        self.preflight_config = preflight_config
+        self.decorations_factory = decorations_factory
+        self.export_options = export_options or {}
+        self.worker_start_method = worker_start_method
+
+    def run(self, jobs):
+        """Runs the given exports and returns one BatchJobResult per export, in the order of the jobs.
+
+        Raises:
+            ValueError: An export refers to an unknown connection name.
+        """
+        unknown_connection_names = sorted({job.connection_name for job in jobs} - set(self.connection_settings))
+        if unknown_connection_names:
+            raise ValueError("Unknown connection name(s) in the batch: {0}".format(', '.join(unknown_connection_names)))
+
+        connection_names = sorted({job.connection_name for job in jobs})
+
+        logger.info('+{0}+'.format(60 * '-'))
+        pool_processes = resolve_parallel_processes(self.parallel_processes)
+        logger.info('Batch exporter starting {0} export(s) against {1} database(s) with {2} shared Excel export processes...'.format(len(jobs),
+                                                                                                                                  len(connection_names),
+                                                                                                                                  pool_processes))
+
+        prepare_shared_memory()
+        worker_pool = WorkerPool(pool_processes, self.worker_start_method)
+        worker_pool.start()
+        connection_pools = {name: ConnectionPool(self.connection_settings[name], self.max_connections_per_database) for name in connection_names}
+        database_slots = {name: BoundedSemaphore(self.max_connections_per_database) for name in connection_names}
+
+        batch_start_time = datetime.now().replace(microsecond=0)
+        try:
+            max_workers = max(1, len(connection_names) * self.max_connections_per_database)
+            with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='krano-batch') as executor:
+                futures = [executor.submit(self._run_job, job, connection_pools[job.connection_name], database_slots[job.connection_name], worker_pool)
+                           for job in jobs]
+                results = [future.result() for future in futures]
+        finally:
+            worker_pool.close()
+            for connection_pool in connection_pools.values():
+                connection_pool.closeall()
+
+        batch_duration = datetime.now().replace(microsecond=0) - batch_start_time
+
+        pt = PrettyTable()
+        pt.field_names = ['Export', 'Connection', 'Status', 'Duration']
+        for result in results:
+            status = 'ok' if result.succeeded() else 'failed: {0}'.format(result.error)
+            pt.add_row([result.job.xlsx_filename, result.job.connection_name, status, result.duration])
+        logger.info('{0}{1}'.format('Statistics:\n', pt))
+        logger.info('Batch exporter finished {0} of {1} export(s) successfully in {2}'.format(len([result for result in results if result.succeeded()]),
+                                                                                            len(results), batch_duration))
+
+        return results
+
+    def _run_job(self, job, connection_pool, database_slot, worker_pool):
+        job_start_time = datetime.now().replace(microsecond=0)
+        try:
+            with database_slot:
+                settings = self.connection_settings[job.connection_name]
+                krano = Krano()
+                krano.set_database_config(settings.name, settings.host, settings.database_name, settings.username, settings.password)
+                krano.set_export_config(self.export_folderpath)
+                if self.jira_config:
+                    krano.set_jira_config(*self.jira_config)
+                if self.cache_config:
+                    krano.set_cache_config(*self.cache_config)
+                if self.metrics_config:
+                    krano.set_metrics_config(*self.metrics_config)
+                if self.preflight_config:
+                    krano.set_preflight_config(*self.preflight_config)
+                krano.set_pool_config(connection_pool, worker_pool)
+
+                decorations = self.decorations_factory(job) if self.decorations_factory else None
+                try:
+                    krano.export(job.sql_statement, job.xlsx_filename, self.sheet_name, job.chunk_size, self.overwrite_files, self.parallel_processes,
+                                 decorations, job.jira_issue, watermark_column=job.watermark_column, **self.export_options)
+                finally:
+                    krano.close()
+            error = None
+        except Exception as e:
+            logger.error('Export {0} encountered an error: {1}'.format(job.xlsx_filename, str(e)))
+            error = e
+
+        return BatchJobResult(job, datetime.now().replace(microsecond=0) - job_start_time, error)
@@ -0,0 +1,667 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from decimal import Decimal
+from functools import partial
+from itertools import islice
+from multiprocessing import get_context
+from prettytable import PrettyTable
+import pgtypes
+import writers
+from columnar import ColumnarRecords
+from metrics import STAGE_EXECUTE
+from metrics import STAGE_FETCH
+from metrics import RunMetrics
+from metrics import measure
+from metrics import peak_rss_bytes
+from postgresql import ConnectionSettings
+from postgresql import Database
+from postgresql import FETCH_CURSOR
+from postgresql import COPY_FORMATS
+from postgresql import QueryResult
+from postgresql import StreamingQueryResult
+
+# Modules that must not be imported by the command line interface before an export actually runs
+HEAVY_MODULES = ['psycopg2', 'pandas', 'openpyxl', 'xlsxwriter', 'prettytable', 'requests', 'pyarrow']
+STARTUP_MODULES = ['cli', 'krano']
+
+SYNTHETIC_COLUMN_TYPES = [pgtypes.INT4_OID, pgtypes.TEXT_OID, pgtypes.NUMERIC_OID, pgtypes.TIMESTAMP_OID,
+                          pgtypes.TIMESTAMPTZ_OID, pgtypes.FLOAT8_OID, pgtypes.DATE_OID, pgtypes.BOOL_OID]
+
+# The column types of the synthetic records by type mix, repeated to the requested count of columns
+SYNTHETIC_TYPE_MIXES = {
+    'mixed': SYNTHETIC_COLUMN_TYPES,
+    'text': [pgtypes.TEXT_OID],
+    'numeric': [pgtypes.NUMERIC_OID, pgtypes.INT4_OID, pgtypes.FLOAT8_OID],
+    'timestamptz': [pgtypes.TIMESTAMPTZ_OID, pgtypes.TIMESTAMP_OID, pgtypes.DATE_OID]
+}
+
+SCENARIO_EXPORT = 'export'
+SCENARIO_DECORATION = 'decoration'
+SCENARIO_KRANO = 'krano'
+SCENARIOS = [SCENARIO_EXPORT, SCENARIO_DECORATION, SCENARIO_KRANO]
+
+BASELINE_VERSION = 1
+
+
+def synthetic_records(row_count, column_count, seed=42, column_types=None, null_fraction=0.0):
+    """Builds reproducible synthetic records with a mix of PostgreSQL column types.
+
+    Returns:
+        A tuple of the records (list of tuples), the column names and the column type OIDs.
+    """
+    rows, column_names, column_type_codes = synthetic_rows(row_count, column_count, seed, column_types, null_fraction)
+    return list(rows), column_names, column_type_codes
+
+
+def synthetic_rows(row_count, column_count, seed=42, column_types=None, null_fraction=0.0):
+    """Generates reproducible synthetic records with a mix of PostgreSQL column types one by one.
+
+    Args:
+        row_count (int): The count of records.
+        column_count (int): The count of columns.
+        seed (int): The seed of the random values, defaults to 42.
+        column_types (list): The type OIDs repeated over the columns, defaults to SYNTHETIC_COLUMN_TYPES.
+        null_fraction (float): The share of values replaced by NULL, defaults to 0.0.
+
+    Returns:
+        A tuple of an iterator over the records (tuples), the column names and the column type OIDs.
+    """
+    rnd = random.Random(seed)
+    column_types = column_types or SYNTHETIC_COLUMN_TYPES
+    column_type_codes = [column_types[i % len(column_types)] for i in range(column_count)]
+    column_names = ['column_{0}'.format(i + 1) for i in range(column_count)]
+    base_datetime = datetime(2019, 1, 1)
+    value_factories = {
+        pgtypes.INT4_OID: lambda: rnd.randint(-100000, 100000),
+        pgtypes.TEXT_OID: lambda: 'text value {0}'.format(rnd.randint(0, 10000)),
+        pgtypes.NUMERIC_OID: lambda: Decimal(rnd.randint(0, 10000000)) / 100,
+        pgtypes.TIMESTAMP_OID: lambda: base_datetime + timedelta(seconds=rnd.randint(0, 10 ** 8)),
+        pgtypes.TIMESTAMPTZ_OID: lambda: (base_datetime + timedelta(seconds=rnd.randint(0, 10 ** 8))).replace(tzinfo=timezone.utc),
+        pgtypes.FLOAT8_OID: lambda: rnd.random() * 1000,
+        pgtypes.DATE_OID: lambda: (base_datetime + timedelta(days=rnd.randint(0, 3650))).date(),
+        pgtypes.BOOL_OID: lambda: rnd.random() < 0.5
+    }
+    factories = [value_factories[type_code] for type_code in column_type_codes]
+    if null_fraction > 0:
+        factories = [partial(_nullable_value, rnd, factory, null_fraction) for factory in factories]
+    rows = (tuple(factory() for factory in factories) for _ in range(row_count))
+    return rows, column_names, column_type_codes
+
+
+def _nullable_value(rnd, factory, null_fraction):
+    return None if rnd.random() < null_fraction else factory()
+
+
+def synthetic_query_result(row_count, column_count, type_mix='mixed', null_fraction=0.0, seed=42, columnar=False):
+    """Builds a QueryResult of reproducible synthetic records, see synthetic_records().
+
+    With columnar, the records are encoded into a ColumnarRecords sequence batch by batch, like Database.query() does.
+    """
+    rows, column_names, column_type_codes = synthetic_rows(row_count, column_count, seed, SYNTHETIC_TYPE_MIXES[type_mix], null_fraction)
+    if columnar:
+        records = ColumnarRecords.from_batches(iter(lambda: list(islice(rows, 10000)), []), column_type_codes)
+    else:
+        records = list(rows)
+    return QueryResult('select * from synthetic', records, column_names, timedelta(0), column_type_codes)
+
+
+class FakeDatabase(object):
+    """Stands in for postgresql.Database and returns a synthetic query result for every SQL query.
+
+    Set Krano.database_class to functools.partial(FakeDatabase, query_result=...) to benchmark Krano.export without a database.
+
+    Args:
+        connection_settings (ConnectionSettings): Ignored, accepted for compatibility with postgresql.Database.
+        connection_pool (ConnectionPool): Ignored, accepted for compatibility with postgresql.Database.
+        metrics (metrics.RunMetrics): Receives the execute and fetch spans, defaults to None.
+        query_result (QueryResult): The result returned for every query, its records are copied per query. Columnar records are
+            returned as a view if a columnar result is asked for.
+    """
+    def __init__(self, connection_settings=None, connection_pool=None, metrics=None, query_result=None):
+        self.metrics = metrics
+        self.query_result = query_result
+
+    def query(self, sql_statement, stream=False, fetch_size=10000, fetch_method=FETCH_CURSOR, columnar=False):
+        with measure(STAGE_EXECUTE, self.metrics):
+            if columnar and not stream and isinstance(self.query_result.records, ColumnarRecords):
+                records = self.query_result.records[:]
+            else:
+                records = list(self.query_result.records)
+        if stream:
+            batches = (records[pos:pos + fetch_size] for pos in range(0, len(records), fetch_size))
+            return StreamingQueryResult(sql_statement, batches, self.query_result.column_names, timedelta(0),
+                                        column_type_codes=self.query_result.column_type_codes, metrics=self.metrics)
+        with measure(STAGE_FETCH, self.metrics, rows=len(records)):
+            query_result = QueryResult(sql_statement, records, self.query_result.column_names, timedelta(0), self.query_result.column_type_codes)
+        return query_result
+
+    def query_partitioned(self, sql_statement, partitions, partition_column=None, partition_method=None, stream=False,
+                          fetch_size=10000, fetch_method=FETCH_CURSOR, columnar=False):
+        return self.query(sql_statement, stream, fetch_size, fetch_method, columnar)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def current_rss_bytes():
+    """Returns the current resident set size of the current process in bytes, or the peak where unavailable."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return peak_rss_bytes()
+
+
+def _run_writer(output_format, engine, row_count, column_count, queue):
+    try:
+        records, column_names, column_type_codes = synthetic_records(row_count, column_count)
+        rss_before = current_rss_bytes()
+
+        with tempfile.TemporaryDirectory() as folderpath:
+            filepath = os.path.join(folderpath, 'benchmark.{0}'.format(output_format))
+            start_time = time.perf_counter()
+            writer = writers.get_writer(output_format, engine)(filepath, 'Data', column_names, column_type_codes)
+            writer.write(records)
+            writer.close()
+            duration = time.perf_counter() - start_time
+            file_size = os.path.getsize(filepath)
+
+        queue.put({'duration': duration, 'file_size': file_size, 'peak_rss': peak_rss_bytes(), 'rss_before': rss_before})
+    except Exception as e:
+        queue.put({'error': str(e)})
+
+
+def benchmark_writers(row_count, column_count, variants):
+    """Writes the same synthetic records with every given writer, each in a fresh process to isolate peak memory.
+
+    Args:
+        variants (list): Tuples of a label, the output format and the XLSX engine of each writer.
+    """
+    context = get_context('spawn')
+    results = {}
+    for label, output_format, engine in variants:
+        queue = context.Queue()
+        process = context.Process(target=_run_writer, args=(output_format, engine, row_count, column_count, queue))
+        process.start()
+        results[label] = queue.get()
+        process.join()
+    return results
+
+
+def benchmark_xlsx_engines(row_count, column_count, engines):
+    """Writes the same synthetic records with every given XLSX engine, each in a fresh process to isolate peak memory."""
+    return benchmark_writers(row_count, column_count, [(engine, writers.FORMAT_XLSX, engine) for engine in engines])
+
+
+def print_writer_results(title, label_name, results, row_count):
+    pt = PrettyTable()
+    pt.field_names = [label_name, 'Duration (s)', 'Rows/s', 'File size (MB)', 'Peak RSS (MB)', 'Peak RSS growth (MB)']
+    for label, result in results.items():
+        if 'error' in result:
+            pt.add_row([label, 'failed: {0}'.format(result['error']), '', '', '', ''])
+            continue
+        pt.add_row([label,
+                    round(result['duration'], 2),
+                    int(row_count / result['duration']),
+                    round(result['file_size'] / 1024 ** 2, 2),
+                    round(result['peak_rss'] / 1024 ** 2, 1),
+                    round((result['peak_rss'] - result['rss_before']) / 1024 ** 2, 1)])
+    print('{0}:\n{1}'.format(title, pt))
+
+
+def main_xlsx(args):
+    results = benchmark_xlsx_engines(args.rows, args.columns, args.engines)
+    print_writer_results('XLSX engines, {0} rows x {1} columns'.format(args.rows, args.columns), 'Engine', results, args.rows)
+
+
+def main_formats(args):
+    results = benchmark_writers(args.rows, args.columns, [(output_format, output_format, 'native') for output_format in args.formats])
+    print_writer_results('Output formats, {0} rows x {1} columns'.format(args.rows, args.columns), 'Output format', results, args.rows)
+
+
+def _run_fetch_method(connection_settings, sql_statement, fetch_method, queue):
+    try:
+        rss_before = current_rss_bytes()
+        start_time = time.perf_counter()
+        with Database(connection_settings) as db:
+            result = db.query(sql_statement, fetch_method=fetch_method)
+        duration = time.perf_counter() - start_time
+        queue.put({'duration': duration, 'row_count': result.record_count, 'peak_rss': peak_rss_bytes(), 'rss_before': rss_before})
+    except Exception as e:
+        queue.put({'error': str(e)})
+
+
+def benchmark_fetch_methods(connection_settings, sql_statement, fetch_methods):
+    """Fetches the result of the same SQL query with every given fetch method, each in a fresh process to isolate peak memory."""
+    context = get_context('spawn')
+    results = {}
+    for fetch_method in fetch_methods:
+        queue = context.Queue()
+        process = context.Process(target=_run_fetch_method, args=(connection_settings, sql_statement, fetch_method, queue))
+        process.start()
+        results[fetch_method] = queue.get()
+        process.join()
+    return results
+
+
+def main_fetch(args):
+    connection_settings = ConnectionSettings('benchmark', args.host, args.database, args.user, args.password)
+    results = benchmark_fetch_methods(connection_settings, args.sql, args.fetch_methods)
+
+    pt = PrettyTable()
+    pt.field_names = ['Fetch method', 'Duration (s)', 'Rows', 'Rows/s', 'Peak RSS (MB)', 'Peak RSS growth (MB)']
+    for fetch_method, result in results.items():
+        if 'error' in result:
+            pt.add_row([fetch_method, 'failed: {0}'.format(result['error']), '', '', '', ''])
+            continue
+        pt.add_row([fetch_method,
+                    round(result['duration'], 2),
+                    result['row_count'],
+                    int(result['row_count'] / result['duration']),
+                    round(result['peak_rss'] / 1024 ** 2, 1),
+                    round((result['peak_rss'] - result['rss_before']) / 1024 ** 2, 1)])
+    print('Fetch methods, {0}:\n{1}'.format(args.sql, pt))
+
+
+def _measure_import(module):
+    """Imports the given module in a fresh interpreter.
+
+    Returns:
+        A tuple of the import time in seconds and the list of heavy modules that were imported along.
+    """
+    code = ('import sys, time; start_time = time.perf_counter(); import {0}; duration = time.perf_counter() - start_time; '
+            'print(duration); print(" ".join(m for m in {1!r} if m in sys.modules))').format(module, HEAVY_MODULES)
+    output = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)), check=True,
+                            stdout=subprocess.PIPE, universal_newlines=True).stdout.splitlines()
+    return float(output[0]), output[1].split() if len(output) > 1 else []
+
+
+def _measure_command(arguments):
+    """Runs the given command line interface arguments in a fresh interpreter and returns the wall time in seconds."""
+    start_time = time.perf_counter()
+    subprocess.run([sys.executable, 'cli.py'] + arguments, cwd=os.path.dirname(os.path.abspath(__file__)),
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start_time
+
+
+def main_startup(args):
+    """Checks that the command line interface starts without the heavy modules and within the given time.
+
+    Returns:
+        1 if a heavy module was imported or a measurement exceeded --max-ms, else 0.
+    """
+    failures = []
+    pt = PrettyTable()
+    pt.field_names = ['Measurement', 'Duration (ms)', 'Heavy modules imported']
+    for module in STARTUP_MODULES:
+        duration, heavy_modules = _measure_import(module)
+        pt.add_row(['import {0}'.format(module), round(duration * 1000, 1), ', '.join(heavy_modules) or 'none'])
+        if heavy_modules:
+            failures.append('import {0} loads {1}'.format(module, ', '.join(heavy_modules)))
+        if duration * 1000 > args.max_ms:
+            failures.append('import {0} took {1:.0f}ms'.format(module, duration * 1000))
+
+    commands = [['--help']]
+    if args.sql_file and args.connection:
+        commands.append([args.sql_file, '--connection', args.connection, '--dry-run'])
+    for arguments in commands:
+        duration = min(_measure_command(arguments) for _ in range(args.repeat))
+        pt.add_row(['cli.py {0}'.format(' '.join(arguments)), round(duration * 1000, 1), ''])
+        if duration * 1000 > args.max_ms:
+            failures.append('cli.py {0} took {1:.0f}ms'.format(' '.join(arguments), duration * 1000))
+
+    print('Command line startup, at most {0}ms:\n{1}'.format(args.max_ms, pt))
+    for failure in failures:
+        print('FAILED: {0}'.format(failure))
+    return 1 if failures else 0
+
+
+def _benchmark_decorations():
+    from exporter import ExcelDecoration
+    from exporter import ExcelDecorationElement
+
+    decoration = ExcelDecoration('Info', 'Benchmark')
+    decoration.add_element(ExcelDecorationElement('Created on', 'CURRENT_DATETIME'))
+    decoration.add_element(ExcelDecorationElement('Created by', 'benchmark.py'))
+    return [decoration]
+
+
+def _benchmark_export(query_result, folderpath, options):
+    """Exports the query result with an ExcelExporter starting a pool of its own."""
+    from exporter import ExcelExporter
+
+    run_metrics = RunMetrics(SCENARIO_EXPORT)
+    filepath = os.path.join(folderpath, 'benchmark.{0}'.format(options['format']))
+    start_time = time.perf_counter()
+    result = ExcelExporter(filepath, query_result, options['chunk_size'], 'Data', True, options['parallel_processes'], engine=options['engine'],
+                           output_format=options['format'], metrics=run_metrics).export()
+    duration = time.perf_counter() - start_time
+    if result.has_errros():
+        raise RuntimeError(result.excel_export_process_errors[0].message)
+    return duration, query_result.record_count, sum(res.file_size_bytes for res in result.excel_export_process_results), run_metrics
+
+
+def _benchmark_decoration(query_result, folderpath, options):
+    """Decorates XLSX files of the query result with an ExcelDecorationManager, creating the files is not timed."""
+    from exporter import ExcelDecorationManager
+
+    filepaths = []
+    for file_number, chunk in enumerate(query_result.chunks(options['chunk_size']), 1):
+        filepath = os.path.join(folderpath, 'benchmark_{0}.xlsx'.format(file_number))
+        writer = writers.get_writer(writers.FORMAT_XLSX)(filepath, 'Data', query_result.column_names, query_result.column_type_codes)
+        writer.write(chunk)
+        writer.close()
+        filepaths.append(filepath)
+
+    run_metrics = RunMetrics(SCENARIO_DECORATION)
+    start_time = time.perf_counter()
+    result = ExcelDecorationManager(filepaths, _benchmark_decorations(), options['parallel_processes'], metrics=run_metrics).decorate()
+    duration = time.perf_counter() - start_time
+    if result.has_errros():
+        raise RuntimeError(result.excel_decoration_process_errors[0].message)
+    return duration, query_result.record_count, sum(os.path.getsize(filepath) for filepath in filepaths), run_metrics
+
+
+def _benchmark_krano(query_result, folderpath, options):
+    """Runs a full Krano.export against a FakeDatabase returning the query result, or against PostgreSQL if an SQL query was given."""
+    from krano import Krano
+
+    decorations = _benchmark_decorations() if options['format'] == writers.FORMAT_XLSX else None
+    with Krano() as krano:
+        if options['sql']:
+            krano.set_database_config('benchmark', options['host'], options['database'], options['user'], options['password'])
+        else:
+            krano.set_database_config('benchmark', 'localhost', 'benchmark', 'benchmark', 'benchmark')
+            krano.database_class = partial(FakeDatabase, query_result=query_result)
+        krano.set_export_config(folderpath)
+        start_time = time.perf_counter()
+        krano.export(options['sql'] or query_result.sql_statement, 'benchmark.{0}'.format(options['format']), 'Data', options['chunk_size'], True,
+                     options['parallel_processes'], decorations, stream=options['stream'], xlsx_engine=options['engine'], output_format=options['format'],
+                     columnar=options['columnar'])
+        duration = time.perf_counter() - start_time
+        run_metrics = krano.last_run_metrics
+
+    write_stage = run_metrics.stages().get('write', {})
+    return duration, write_stage.get('rows') or 0, write_stage.get('bytes') or 0, run_metrics
+
+
+SCENARIO_FUNCTIONS = {SCENARIO_EXPORT: _benchmark_export, SCENARIO_DECORATION: _benchmark_decoration, SCENARIO_KRANO: _benchmark_krano}
+
+
+def _run_scenario(scenario, options, queue):
+    try:
+        if scenario == SCENARIO_KRANO and options['sql']:
+            query_result = None
+        else:
+            query_result = synthetic_query_result(options['rows'], options['columns'], options['type_mix'], options['null_fraction'],
+                                                  columnar=options['columnar'])
+        with tempfile.TemporaryDirectory() as folderpath:
+            duration, row_count, size, run_metrics = SCENARIO_FUNCTIONS[scenario](query_result, folderpath, options)
+
+        # The export and decoration processes report their own peak memory in the spans
+        worker_peak_rss = [span.peak_rss for span in run_metrics.spans if span.peak_rss is not None and span.worker != os.getpid()]
+        queue.put({'duration': duration,
+                   'rows': row_count,
+                   'bytes': size,
+                   'rows_per_second': row_count / duration if duration else None,
+                   'peak_rss': peak_rss_bytes(),
+                   'worker_peak_rss': max(worker_peak_rss) if worker_peak_rss else None,
+                   'stages': {name: round(stage['wall_duration'], 3) for name, stage in run_metrics.stages().items()}})
+    except Exception as e:
+        queue.put({'error': '{0}: {1}'.format(type(e).__name__, e)})
+
+
+def scenario_key(scenario, options):
+    """Returns the name of a benchmark result in the baseline, covering all options the result depends on."""
+    if scenario == SCENARIO_KRANO and options['sql']:
+        fixture = 'postgresql sql={0}'.format(hashlib.sha1(options['sql'].encode('utf-8')).hexdigest()[:8])
+    else:
+        fixture = '{0}x{1} {2} nulls={3}'.format(options['rows'], options['columns'], options['type_mix'], options['null_fraction'])
+    output = 'xlsx' if scenario == SCENARIO_DECORATION else '{0}/{1}'.format(options['format'], options['engine'])
+    key = '{0} {1} {2} chunk={3} processes={4}'.format(scenario, output, fixture, options['chunk_size'], options['parallel_processes'])
+    if scenario == SCENARIO_KRANO and options['stream']:
+        key += ' stream'
+    if options['columnar']:
+        key += ' columnar'
+    return key
+
+
+def run_suite(scenarios, options, repeat):
+    """Runs every scenario repeat times, each run in a fresh process to isolate its peak memory.
+
+    Returns:
+        A dictionary of the fastest run per scenario key, with the highest peak memory over all runs.
+    """
+    context = get_context('spawn')
+    results = {}
+    for scenario in scenarios:
+        key = scenario_key(scenario, options)
+        runs = []
+        for _ in range(repeat):
+            queue = context.Queue()
+            process = context.Process(target=_run_scenario, args=(scenario, options, queue))
+            process.start()
+            runs.append(queue.get())
+            process.join()
+
+        failed_runs = [run for run in runs if 'error' in run]
+        if failed_runs:
+            results[key] = failed_runs[0]
+            continue
+        best_run = min(runs, key=lambda run: run['duration'])
+        best_run['peak_rss'] = max(run['peak_rss'] or 0 for run in runs)
+        best_run['worker_peak_rss'] = max(run['worker_peak_rss'] or 0 for run in runs) or None
+        results[key] = best_run
+    return results
+
+
+def load_baseline(filepath):
+    with open(filepath, encoding='utf-8') as baseline_file:
+        return json.load(baseline_file)
+
+
+def save_baseline(filepath, results):
+    """Writes the successful results as the new baseline, together with the machine they were measured on.
+
+    The results of other scenarios already in the baseline file are kept.
+    """
+    baseline_results = load_baseline(filepath)['results'] if os.path.isfile(filepath) else {}
+    baseline_results.update({key: result for key, result in results.items() if 'error' not in result})
+    baseline = {'version': BASELINE_VERSION,
+                'created_at': datetime.now(timezone.utc).isoformat(),
+                'machine': platform.platform(),
+                'python': platform.python_version(),
+                'results': baseline_results}
+    with open(filepath, 'w', encoding='utf-8') as baseline_file:
+        json.dump(baseline, baseline_file, indent=2)
+
+
+def compare_with_baseline(results, baseline, max_slowdown, max_memory_growth):
+    """Compares the results with the baseline.
+
+    Args:
+        results (dict): The results of run_suite().
+        baseline (dict): A baseline written by save_baseline(), or None.
+        max_slowdown (float): The tolerated loss of rows per second, e.g. 0.1 for 10%.
+        max_memory_growth (float): The tolerated growth of the peak memory, e.g. 0.2 for 20%.
+
+    Returns:
+        A tuple of the PrettyTable with the comparison and the list of regressions.
+    """
+    baseline_results = baseline['results'] if baseline else {}
+    regressions = []
+    pt = PrettyTable()
+    pt.field_names = ['Scenario', 'Duration (s)', 'Rows/s', 'Baseline rows/s', 'Rows/s change', 'Peak RSS (MB)', 'Worker peak RSS (MB)',
+                      'Baseline peak RSS (MB)', 'Peak RSS change', 'Status']
+    pt.align['Scenario'] = 'l'
+
+    def megabytes(size):
+        return '' if not size else round(size / 1024 ** 2, 1)
+
+    def change(value, baseline_value):
+        if not value or not baseline_value:
+            return None
+        return value / baseline_value - 1
+
+    for key, result in results.items():
+        if 'error' in result:
+            regressions.append('{0} failed: {1}'.format(key, result['error']))
+            pt.add_row([key, 'failed: {0}'.format(result['error']), '', '', '', '', '', '', '', 'failed'])
+            continue
+
+        peak_rss = max(result['peak_rss'] or 0, result['worker_peak_rss'] or 0)
+        baseline_result = baseline_results.get(key)
+        status = 'ok'
+        speed_change = memory_change = baseline_peak_rss = None
+        if baseline_result is None:
+            status = 'no baseline'
+        else:
+            baseline_peak_rss = max(baseline_result['peak_rss'] or 0, baseline_result['worker_peak_rss'] or 0)
+            speed_change = change(result['rows_per_second'], baseline_result['rows_per_second'])
+            memory_change = change(peak_rss, baseline_peak_rss)
+            problems = []
+            if speed_change is not None and speed_change < -max_slowdown:
+                problems.append('{0:.0%} slower'.format(-speed_change))
+            if memory_change is not None and memory_change > max_memory_growth:
+                problems.append('{0:.0%} more memory'.format(memory_change))
+            if problems:
+                status = 'REGRESSION: {0}'.format(', '.join(problems))
+                regressions.append('{0}: {1}'.format(key, ', '.join(problems)))
+
+        pt.add_row([key,
+                    round(result['duration'], 3),
+                    int(result['rows_per_second'] or 0),
+                    int(baseline_result['rows_per_second'] or 0) if baseline_result else '',
+                    '' if speed_change is None else '{0:+.1%}'.format(speed_change),
+                    megabytes(result['peak_rss']),
+                    megabytes(result['worker_peak_rss']),
+                    megabytes(baseline_peak_rss),
+                    '' if memory_change is None else '{0:+.1%}'.format(memory_change),
+                    status])
+    return pt, regressions
+
+
+def main_suite(args):
+    """Runs the benchmark suite, compares it with the baseline and optionally stores the results as the new baseline.
+
+    Returns:
+        1 if a scenario failed or regressed beyond the thresholds, else 0.
+    """
+    options = {'rows': args.rows, 'columns': args.columns, 'type_mix': args.type_mix, 'null_fraction': args.null_fraction,
+               'format': args.format, 'engine': args.engine, 'chunk_size': args.chunk_size, 'parallel_processes': args.parallel_processes,
+               'stream': args.stream, 'columnar': args.columnar, 'sql': args.sql, 'host': args.host, 'database': args.database, 'user': args.user, 'password': args.password}
+    if args.sql and not (args.database and args.user and args.password):
+        print('--sql requires --database, --user and --password')
+        return 2
+
+    baseline = load_baseline(args.baseline) if args.baseline and os.path.isfile(args.baseline) else None
+    if baseline and baseline.get('machine') != platform.platform():
+        print('Warning: the baseline was measured on {0}, not on {1}'.format(baseline.get('machine'), platform.platform()))
+
+    results = run_suite(args.scenarios, options, args.repeat)
+    pt, regressions = compare_with_baseline(results, baseline, args.max_slowdown, args.max_memory_growth)
+    print('Benchmark suite, fastest of {0} run(s), tolerating {1:.0%} fewer rows/s and {2:.0%} more memory:\n{3}'.format(
+        args.repeat, args.max_slowdown, args.max_memory_growth, pt))
+
+    for key, result in results.items():
+        if 'stages' in result:
+            print('{0}: {1}'.format(key, ', '.join('{0} {1:.3f}s'.format(name, duration) for name, duration in result['stages'].items())))
+
+    if args.save_baseline:
+        save_baseline(args.save_baseline, results)
+        print('Baseline written to {0}'.format(args.save_baseline))
+
+    for regression in regressions:
+        print('FAILED: {0}'.format(regression))
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks parts of the krano export pipeline.')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    xlsx_parser = subparsers.add_parser('xlsx', help='compare the Excel export engines on synthetic records')
+    xlsx_parser.add_argument('--rows', type=int, default=100000, help='count of synthetic rows')
+    xlsx_parser.add_argument('--columns', type=int, default=16, help='count of synthetic columns')
+    xlsx_parser.add_argument('--engines', nargs='+', default=list(writers.XLSX_WRITERS), help='XLSX engines to compare')
+
+    formats_parser = subparsers.add_parser('formats', help='compare the output formats on synthetic records')
+    formats_parser.add_argument('--rows', type=int, default=100000, help='count of synthetic rows')
+    formats_parser.add_argument('--columns', type=int, default=16, help='count of synthetic columns')
+    formats_parser.add_argument('--formats', nargs='+', default=writers.OUTPUT_FORMATS, help='output formats to compare')
+
+    fetch_parser = subparsers.add_parser('fetch', help='compare the fetch methods of the Database class on a real PostgreSQL database')
+    fetch_parser.add_argument('--host', default='localhost', help='host of the database server')
+    fetch_parser.add_argument('--database', required=True, help='name of the database')
+    fetch_parser.add_argument('--user', required=True, help='name of the database user')
+    fetch_parser.add_argument('--password', required=True, help='password of the database user')
+    fetch_parser.add_argument('--sql', required=True, help='SQL query to fetch')
+    fetch_parser.add_argument('--fetch-methods', nargs='+', default=[FETCH_CURSOR] + list(COPY_FORMATS), help='fetch methods to compare')
+
+    startup_parser = subparsers.add_parser('startup', help='check the import time of the command line interface, exits with 1 if it is too slow')
+    startup_parser.add_argument('--max-ms', type=float, default=500, help='maximum milliseconds per import or command')
+    startup_parser.add_argument('--repeat', type=int, default=3, help='runs per command, the fastest one counts')
+    startup_parser.add_argument('--sql-file', help='SQL file for a timed --dry-run, needs a valid config.py')
+    startup_parser.add_argument('--connection', help='connection name for the timed --dry-run')
+
+    suite_parser = subparsers.add_parser('suite', help='run the export, decoration and full krano export on synthetic records and compare them '
+                                                        'with a baseline, exits with 1 on a regression')
+    suite_parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS, help='scenarios to run')
+    suite_parser.add_argument('--rows', type=int, default=100000, help='count of synthetic rows')
+    suite_parser.add_argument('--columns', type=int, default=16, help='count of synthetic columns')
+    suite_parser.add_argument('--type-mix', choices=sorted(SYNTHETIC_TYPE_MIXES), default='mixed', help='column types of the synthetic records')
+    suite_parser.add_argument('--null-fraction', type=float, default=0.0, help='share of NULL values in the synthetic records')
+    suite_parser.add_argument('--format', choices=writers.OUTPUT_FORMATS, default=writers.FORMAT_XLSX, help='output format')
+    suite_parser.add_argument('--engine', choices=list(writers.XLSX_WRITERS), default='native', help='XLSX engine')
+    suite_parser.add_argument('--chunk-size', type=int, default=25000, help='rows per file')
+    suite_parser.add_argument('--parallel-processes', type=int, default=2, help='count of parallel processes')
+    suite_parser.add_argument('--stream', action='store_true', help='stream the records in the krano scenario')
+    suite_parser.add_argument('--columnar', action='store_true', help='keep the records column by column in typed arrays instead of tuples')
+    suite_parser.add_argument('--repeat', type=int, default=3, help='runs per scenario, the fastest one counts')
+    suite_parser.add_argument('--baseline', help='JSON file with the baseline to compare with')
+    suite_parser.add_argument('--save-baseline', help='write the results as the new baseline to this JSON file')
+    suite_parser.add_argument('--max-slowdown', type=float, default=0.1, help='tolerated loss of rows per second (default: %(default)s)')
+    suite_parser.add_argument('--max-memory-growth', type=float, default=0.2, help='tolerated growth of the peak memory (default: %(default)s)')
+    suite_parser.add_argument('--sql', help='run the krano scenario against PostgreSQL with this SQL query instead of a fake database')
+    suite_parser.add_argument('--host', default='localhost', help='host of the database server for --sql')
+    suite_parser.add_argument('--database', help='name of the database for --sql')
+    suite_parser.add_argument('--user', help='name of the database user for --sql')
+    suite_parser.add_argument('--password', help='password of the database user for --sql')
+
+    args = parser.parse_args()
+    if args.benchmark == 'suite':
+        return main_suite(args)
+    elif args.benchmark == 'startup':
+        return main_startup(args)
+    elif args.benchmark == 'fetch':
+        main_fetch(args)
+    elif args.benchmark == 'formats':
+        main_formats(args)
+    else:
+        main_xlsx(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,332 @@
+#/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+import hashlib
+import json
+import os
+import re
+import struct
+import tempfile
+import time
+import uuid
+from datetime import datetime
+from datetime import timedelta
+from columnar import COLUMN_KINDS
+from columnar import KIND_PICKLE
+from columnar import ColumnarRecords
+from columnar import decode_block
+from columnar import encode_column
+from postgresql import QueryResult
+from postgresql import StreamingQueryResult
+from postgresql import strip_statement
+
+CACHE_USE = 'use'
+CACHE_BYPASS = 'bypass'
+CACHE_REFRESH = 'refresh'
+CACHE_MODES = [CACHE_USE, CACHE_BYPASS, CACHE_REFRESH]
+
+CACHE_STATUS_HIT = 'hit'
+CACHE_STATUS_MISS = 'miss'
+CACHE_STATUS_BYPASSED = 'bypassed'
+CACHE_STATUS_REFRESHED = 'refreshed'
+
+BLOCK_HEADER = struct.Struct('<I')
+SQL_STRING_LITERAL = re.compile(r"('(?:[^']|'')*')")
+WHITESPACE = re.compile(r'\s+')
+
+
+def normalise_sql(sql_statement):
+    """Returns the SQL statement with trailing semicolons removed and whitespace outside of string literals collapsed."""
+    parts = SQL_STRING_LITERAL.split(strip_statement(sql_statement))
+    return ''.join(part if index % 2 else WHITESPACE.sub(' ', part) for index, part in enumerate(parts))
+
+
+def cache_key(connection_name, sql_statement):
+    """Returns the cache key for an SQL statement executed against the database with the given connection name."""
+    return hashlib.sha256('{0}\n{1}'.format(connection_name, normalise_sql(sql_statement)).encode('utf-8')).hexdigest()
+
+
+def _seconds(duration):
+    return None if duration is None else duration.total_seconds()
+
+
+def _duration(seconds):
+    return None if seconds is None else timedelta(seconds=seconds)
+
+
+class _CacheEntryWriter(object):
+    """Writes the records of a query result block by block into a new data file of the cache."""
+    def __init__(self, cache, key, column_type_codes):
+        self.cache = cache
+        self.key = key
+        self.kinds = [COLUMN_KINDS.get(type_code, KIND_PICKLE) for type_code in column_type_codes or []]
+        self.data_filename = '{0}-{1}.data'.format(key, uuid.uuid4().hex)
+        handle, self.temp_filepath = tempfile.mkstemp(suffix='.tmp', dir=cache.folderpath)
+        self.data_file = os.fdopen(handle, 'wb')
+        self.record_count = 0
+        self.finished = False
+
+    def write_block(self, records):
+        if not records:
+            return
+        if not self.kinds:
+            self.kinds = [KIND_PICKLE] * len(records[0])
+
+        columns = []
+        buffers = []
+        for column_values, kind in zip(zip(*records), self.kinds):
+            used_kind, column_buffers = encode_column(column_values, kind)
+            columns.append([used_kind, [memoryview(buffer).nbytes for buffer in column_buffers]])
+            buffers.extend(column_buffers)
+
+        header = json.dumps({'rows': len(records), 'columns': columns}).encode('utf-8')
+        self.data_file.write(BLOCK_HEADER.pack(len(header)))
+        self.data_file.write(header)
+        for buffer in buffers:
+            self.data_file.write(buffer)
+        self.record_count += len(records)
+
+    def commit(self, sql_statement, column_names, column_type_codes, query_duration, fetch_duration):
+        self.data_file.close()
+        self.finished = True
+        os.replace(self.temp_filepath, os.path.join(self.cache.folderpath, self.data_filename))
+        meta = {'sql_statement': sql_statement,
+                'column_names': column_names,
+                'column_type_codes': column_type_codes,
+                'query_duration': _seconds(query_duration),
+                'fetch_duration': _seconds(fetch_duration),
+                'record_count': self.record_count,
+                'stored_at': time.time(),
+                'data_filename': self.data_filename,
+                'data_size': os.path.getsize(os.path.join(self.cache.folderpath, self.data_filename))}
+        self.cache._write_meta(self.key, meta)
+
+    def discard(self):
+        if self.finished:
+            return
+        self.finished = True
+        self.data_file.close()
+        os.remove(self.temp_filepath)
+
+
+class QueryResultCache(object):
+    """Stores query results on disk, keyed by the connection name and the normalised SQL statement.
+
+    The records are stored column by column in blocks, using the same encoding as the shared memory hand-off
+    (see columnar.py), next to a small JSON file with the column information, the query duration and the
+    fetch duration. Entries expire after ttl seconds. Once the cache grows beyond max_size bytes, the least
+    recently used entries are evicted.
+
+    Args:
+        folderpath (str): Path to the folder storing the cache entries, it is created if it does not exist.
+        ttl (int): Time to live of an entry in seconds, defaults to 86400 (one day).
+        max_size (int): Maximum size of all entries in bytes, defaults to 10 GB.
+        block_size (int): Count of rows per stored block, defaults to 10000.
+    """
+    def __init__(self, folderpath, ttl=86400, max_size=10 * 1024 ** 3, block_size=10000):
+        self.folderpath = folderpath
+        self.ttl = ttl
+        self.max_size = max_size
+        self.block_size = block_size
+
+        os.makedirs(self.folderpath, exist_ok=True)
+
+    def query(self, connection_name, sql_statement, run_query, stream=False, mode=CACHE_USE, columnar=False):
+        """Returns the cached result of an SQL statement, or runs the query and stores its result.
+
+        Args:
+            connection_name (str): Name of the database connection the SQL statement is executed against.
+            sql_statement (str): The SQL query.
+            run_query (callable): Executes the SQL query and returns a QueryResult or StreamingQueryResult.
+            stream (bool): Return a cached result as a StreamingQueryResult, reading the blocks lazily, defaults to False.
+            mode (str): 'use' returns a cached result if there is a valid one, 'refresh' always runs the query and
+                replaces the cached result, 'bypass' runs the query without touching the cache, defaults to 'use'.
+            columnar (bool): Return a cached result with its records still encoded column by column, see load(), defaults to False.
+
+        Returns:
+            The query result, its cache_status attribute tells whether it was a 'hit', a 'miss', 'refreshed' or 'bypassed'.
+
+        Raises:
+            ValueError: The given mode is unknown.
+        """
+        if mode not in CACHE_MODES:
+            raise ValueError("Unknown cache mode '{0}', choose one of: {1}".format(mode, ', '.join(CACHE_MODES)))
+
+        if mode == CACHE_BYPASS:
+            result = run_query()
+            result.cache_status = CACHE_STATUS_BYPASSED
+            return result
+
+        key = cache_key(connection_name, sql_statement)
+        if mode == CACHE_USE:
+            result = self.load(key, stream, columnar)
+            if result is not None:
+                return result
+            logger.info("Query result cache miss for {0}".format(key[:12]))
+
+        result = run_query()
+        if isinstance(result, StreamingQueryResult):
+            result = self._store_streaming(key, result)
+        else:
+            self.store(key, result)
+        result.cache_status = CACHE_STATUS_MISS if mode == CACHE_USE else CACHE_STATUS_REFRESHED
+        return result
+
+    def store(self, key, result):
+        """Stores a completely fetched QueryResult under the given key."""
+        writer = _CacheEntryWriter(self, key, result.column_type_codes)
+        try:
+            for block in result.chunks(self.block_size):
+                writer.write_block(block)
+            writer.commit(result.sql_statement, result.column_names, result.column_type_codes, result.query_duration,
+                          getattr(result, 'fetch_duration', None))
+        except Exception:
+            writer.discard()
+            raise
+        self.evict()
+
+    def _store_streaming(self, key, result):
+        """Wraps a StreamingQueryResult, so its batches are stored while they are consumed.
+
+        The entry is only committed once all batches were consumed, an early closed result is not stored.
+        """
+        writer = _CacheEntryWriter(self, key, result.column_type_codes)
+        batches = result.batches()
+
+        def caching_batches():
+            for batch in batches:
+                writer.write_block(batch)
+                yield batch
+            writer.commit(result.sql_statement, result.column_names, result.column_type_codes, result.query_duration, result.fetch_duration)
+            self.evict()
+
+        def close_result():
+            writer.discard()
+            batches.close()
+            result.close()
+
+        return StreamingQueryResult(result.sql_statement, caching_batches(), result.column_names, result.query_duration,
+                                    close_callback=close_result, column_type_codes=result.column_type_codes)
+
+    def load(self, key, stream=False, columnar=False):
+        """Returns the cached result stored under the given key, None if there is no valid entry.
+
+        Args:
+            key (str): The cache key, see cache_key().
+            stream (bool): Return a StreamingQueryResult reading the blocks lazily instead of a QueryResult, defaults to False.
+            columnar (bool): Keep the records of a QueryResult encoded as they are stored, in a columnar.ColumnarRecords sequence,
+                instead of decoding them into a list of tuples. Defaults to False.
+        """
+        meta = self._read_meta(key)
+        if meta is None:
+            return None
+
+        if time.time() - meta['stored_at'] > self.ttl:
+            logger.info("Query result cache entry {0} expired".format(key[:12]))
+            self._remove(key, meta)
+            return None
+
+        data_filepath = os.path.join(self.folderpath, meta['data_filename'])
+        try:
+            data_file = open(data_filepath, 'rb')
+        except FileNotFoundError:
+            return None
+        os.utime(self._meta_filepath(key))
+
+        query_duration = _duration(meta['query_duration'])
+        if stream:
+            result = StreamingQueryResult(meta['sql_statement'], self._read_blocks(data_file), meta['column_names'], query_duration,
+                                          close_callback=data_file.close, column_type_codes=meta['column_type_codes'])
+        else:
+            with data_file:
+                if columnar:
+                    records = ColumnarRecords(list(self._read_encoded_blocks(data_file)))
+                else:
+                    records = [record for block in self._read_blocks(data_file) for record in block]
+            result = QueryResult(meta['sql_statement'], records, meta['column_names'], query_duration, meta['column_type_codes'])
+            result.fetch_duration = _duration(meta['fetch_duration'])
+
+        result.cache_status = CACHE_STATUS_HIT
+        result.cached_at = datetime.fromtimestamp(meta['stored_at']).replace(microsecond=0)
+        logger.info("Query result cache hit for {0}, {1} records stored at {2}".format(key[:12], meta['record_count'], result.cached_at))
+        return result
+
+    def _read_encoded_blocks(self, data_file):
+        """Yields the stored blocks as tuples of the row count and the encoded columns, see columnar.encode_block()."""
+        while True:
+            header_size_data = data_file.read(BLOCK_HEADER.size)
+            if not header_size_data:
+                return
+            header = json.loads(data_file.read(BLOCK_HEADER.unpack(header_size_data)[0]).decode('utf-8'))
+            columns = [(kind, [data_file.read(size) for size in buffer_sizes]) for kind, buffer_sizes in header['columns']]
+            yield header['rows'], columns
+
+    def _read_blocks(self, data_file):
+        for row_count, columns in self._read_encoded_blocks(data_file):
+            yield list(decode_block(columns, 0, row_count))
+
+    def evict(self):
+        """Removes expired entries and the least recently used ones until the cache fits into max_size."""
+        entries = []
+        for filename in os.listdir(self.folderpath):
+            if not filename.endswith('.json'):
+                continue
+            key = filename[:-len('.json')]
+            meta = self._read_meta(key)
+            if meta is None:
+                continue
+            if time.time() - meta['stored_at'] > self.ttl:
+                self._remove(key, meta)
+                continue
+            try:
+                last_used = os.path.getmtime(self._meta_filepath(key))
+            except FileNotFoundError:
+                continue
+            entries.append((last_used, key, meta))
+
+        total_size = sum(meta['data_size'] for _, _, meta in entries)
+        for _, key, meta in sorted(entries, key=lambda entry: entry[0]):
+            if total_size <= self.max_size:
+                break
+            logger.info("Evicting query result cache entry {0} ({1} bytes)".format(key[:12], meta['data_size']))
+            self._remove(key, meta)
+            total_size -= meta['data_size']
+
+    def clear(self):
+        """Removes all entries of the cache."""
+        for filename in os.listdir(self.folderpath):
+            if filename.endswith('.json'):
+                key = filename[:-len('.json')]
+                self._remove(key, self._read_meta(key))
+
+    def _meta_filepath(self, key):
+        return os.path.join(self.folderpath, '{0}.json'.format(key))
+
+    def _read_meta(self, key):
+        try:
+            with open(self._meta_filepath(key), encoding='utf-8') as meta_file:
+                return json.load(meta_file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_meta(self, key, meta):
+        previous_meta = self._read_meta(key)
+        handle, temp_filepath = tempfile.mkstemp(suffix='.tmp', dir=self.folderpath)
+        with os.fdopen(handle, 'w', encoding='utf-8') as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(temp_filepath, self._meta_filepath(key))
+        if previous_meta and previous_meta['data_filename'] != meta['data_filename']:
+            self._remove_file(previous_meta['data_filename'])
+
+    def _remove(self, key, meta):
+        self._remove_file('{0}.json'.format(key))
+        if meta:
+            self._remove_file(meta['data_filename'])
+
+    def _remove_file(self, filename):
+        try:
+            os.remove(os.path.join(self.folderpath, filename))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,266 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+import asyncio
+import getpass
+import logging
+import os
+import re
+import sys
+from logconfig import configure_logging
+from manifest import manifest_filepath
+from writers import FORMAT_XLSX
+from writers import OUTPUT_FORMATS
+from writers import XLSX_MAX_ROWS
+from writers import output_format_for_filename
+from writers import split_output_extension
+
+# Only light modules are imported above, the database driver, the writers and the JIRA client are imported
+# by run_export() once the arguments and the configuration are valid, so --help and --dry-run start quickly.
+
+JIRA_ISSUE_PATTERN = re.compile(r'^[A-Z][A-Z0-9_]*-[0-9]+$')
+# The header row takes one row of the worksheet
+MAX_XLSX_RECORDS = XLSX_MAX_ROWS - 1
+
+
+def parallel_processes_argument(value):
+    """Parses the count of parallel processes, a positive number or 'auto'."""
+    if value == 'auto':
+        return value
+    try:
+        processes = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("must be a positive number or 'auto', not '{0}'".format(value))
+    if processes < 1:
+        raise argparse.ArgumentTypeError("must be a positive number or 'auto', not '{0}'".format(value))
+    return processes
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='krano',
+                                     description='Exports the result of an SQL query from a PostgreSQL database into Excel, CSV or Parquet files '
+                                                 'and optionally attaches them to a JIRA issue. The database connections and all further '
+                                                 'settings are taken from config.py.')
+    parser.add_argument('sql_file', help='file containing the SQL query')
+    parser.add_argument('-c', '--connection', required=True, help='name of the database connection in DATABASE_CONNECTION_SETTINGS')
+    parser.add_argument('-n', '--chunk-size', type=int, default=250000, help='maximum number of rows per file (default: %(default)s)')
+    parser.add_argument('-f', '--format', choices=OUTPUT_FORMATS, help='output format (default: the extension of --filename, else EXPORT_OUTPUT_FORMAT or xlsx)')
+    parser.add_argument('-j', '--jira-issue', help='JIRA issue the created files are attached to, e.g. ITD-122')
+    parser.add_argument('-o', '--filename', help='filename of the file(s) to be created (default: the name of the SQL file)')
+    parser.add_argument('--export-folder', help='folder the files are created in (default: EXPORT_FOLDERPATH)')
+    parser.add_argument('-p', '--parallel-processes', type=parallel_processes_argument,
+                        help="number of parallel export processes or 'auto' (default: EXPORT_PARALLEL_PROCESSES)")
+    parser.add_argument('--max-file-size', type=int, help='maximum size of a file in bytes (default: EXPORT_MAX_FILE_SIZE_BYTES)')
+    parser.add_argument('--stream', action='store_true', help='fetch the records in batches while exporting them (default: EXPORT_STREAM_RECORDS)')
+    parser.add_argument('--overwrite', action='store_true', help='overwrite existing files (default: EXPORT_OVERWRITE_FILES)')
+    parser.add_argument('-w', '--watermark-column', help='export only the rows whose value in this increasing column, e.g. an id or '
+                                                          'updated_at, is above the one exported last, into additional numbered files')
+    parser.add_argument('--exact-decimal', action='append', metavar='COLUMN', help='write this NUMERIC column into XLSX files as text with '
+                                                                                     'all its digits, can be repeated (default: EXPORT_EXACT_DECIMAL_COLUMNS)')
+    parser.add_argument('--single-file', action='store_true', help='write all rows into one XLSX file, its worksheet in parts of --chunk-size '
+                                                                    'rows in parallel processes (default: EXPORT_SINGLE_FILE)')
+    parser.add_argument('--preflight', action='store_true', help='estimate the result with EXPLAIN first, plan the files, processes and memory '
+                        'with it and log the progress against it (default: EXPORT_PREFLIGHT)')
+    parser.add_argument('--no-resume', action='store_true', help='create all files again instead of resuming a failed run (default: EXPORT_RESUME)')
+    parser.add_argument('--no-decorations', action='store_true', help='do not add the info and SQL worksheets to Excel files')
+    parser.add_argument('--creator', default=getpass.getuser(), help='name shown as creator in the info worksheet (default: %(default)s)')
+    parser.add_argument('--dry-run', action='store_true', help='validate the arguments and the configuration and show the planned export '
+                                                                 'without connecting to the database')
+    parser.add_argument('-q', '--quiet', action='store_true', help='only log warnings and errors')
+    return parser
+
+
+def load_config():
+    """Imports config.py.
+
+    Returns:
+        A tuple of the config module and an error message, one of them is None.
+    """
+    try:
+        import config
+    except Exception as e:
+        return None, 'config.py could not be loaded: {0}: {1}'.format(type(e).__name__, e)
+    return config, None
+
+
+def resolve_options(args, config):
+    """Completes the arguments with the defaults of the configuration."""
+    filename = args.filename or os.path.splitext(os.path.basename(args.sql_file))[0]
+    filename_format = output_format_for_filename(filename, default=None)
+    if filename_format:
+        filename = split_output_extension(filename)[0]
+    args.format = args.format or filename_format or getattr(config, 'EXPORT_OUTPUT_FORMAT', None) or FORMAT_XLSX
+    args.filename = '{0}.{1}'.format(filename, args.format)
+    if not args.export_folder:
+        args.export_folder = getattr(config, 'EXPORT_FOLDERPATH', None)
+    if args.parallel_processes is None:
+        args.parallel_processes = getattr(config, 'EXPORT_PARALLEL_PROCESSES', 2)
+    if args.max_file_size is None:
+        args.max_file_size = getattr(config, 'EXPORT_MAX_FILE_SIZE_BYTES', None)
+    args.stream = args.stream or getattr(config, 'EXPORT_STREAM_RECORDS', False)
+    args.overwrite = args.overwrite or getattr(config, 'EXPORT_OVERWRITE_FILES', False)
+    args.resume = not args.no_resume and getattr(config, 'EXPORT_RESUME', False)
+    args.single_file = args.single_file or getattr(config, 'EXPORT_SINGLE_FILE', False)
+    args.preflight = args.preflight or getattr(config, 'EXPORT_PREFLIGHT', False)
+    if args.exact_decimal is None:
+        args.exact_decimal = getattr(config, 'EXPORT_EXACT_DECIMAL_COLUMNS', [])
+
+
+def validate(args, config):
+    """Checks the arguments and the configuration without connecting to the database.
+
+    Returns:
+        A list of error messages, empty if the export can be started.
+    """
+    errors = []
+
+    if not os.path.isfile(args.sql_file):
+        errors.append("No such SQL file: '{0}'".format(args.sql_file))
+    else:
+        with open(args.sql_file, encoding='utf-8') as sql_file:
+            if not sql_file.read().strip():
+                errors.append("The SQL file '{0}' is empty".format(args.sql_file))
+
+    connection_settings = getattr(config, 'DATABASE_CONNECTION_SETTINGS', {})
+    if args.connection not in connection_settings:
+        errors.append("Unknown connection '{0}', choose one of: {1}".format(args.connection, ', '.join(connection_settings) or 'none configured'))
+    else:
+        missing_keys = [key for key in ['connection_name', 'host', 'database_name', 'user', 'password'] if key not in connection_settings[args.connection]]
+        if missing_keys:
+            errors.append("The connection '{0}' lacks the setting(s): {1}".format(args.connection, ', '.join(missing_keys)))
+
+    if args.chunk_size < 1:
+        errors.append('The chunk size must be positive')
+    elif args.format == FORMAT_XLSX and args.chunk_size > MAX_XLSX_RECORDS:
+        errors.append('The chunk size must not exceed {0}, the maximum number of rows in an XLSX file less the header row'.format(MAX_XLSX_RECORDS))
+
+    if args.single_file and args.format != FORMAT_XLSX:
+        errors.append('A single file with parts written in parallel can only be created in the XLSX format')
+
+    if args.max_file_size is not None and args.max_file_size < 1:
+        errors.append('The maximum file size must be positive')
+
+    if not args.export_folder:
+        errors.append('No export folder given and EXPORT_FOLDERPATH is not set')
+    elif not os.path.isdir(args.export_folder):
+        errors.append("The export folder does not exist or is not a directory: '{0}'".format(args.export_folder))
+
+    if args.jira_issue:
+        if not JIRA_ISSUE_PATTERN.match(args.jira_issue):
+            errors.append("'{0}' does not look like a JIRA issue, e.g. ITD-122".format(args.jira_issue))
+        for setting in ['JIRA_BASE_URL', 'JIRA_USER', 'JIRA_PASSWORD']:
+            if not getattr(config, setting, None):
+                errors.append('Attaching files to JIRA requires {0} in config.py'.format(setting))
+
+    return errors
+
+
+def describe_export(args):
+    """Returns the lines describing the planned export."""
+    filepath = os.path.join(args.export_folder, args.filename)
+    if args.single_file:
+        rows_per_file = 'all rows in one file, written in parts of {0} rows'.format(args.chunk_size)
+    else:
+        rows_per_file = 'at most {0}{1}'.format(args.chunk_size, ', files below {0} bytes'.format(args.max_file_size) if args.max_file_size else '')
+    lines = ['SQL file:            {0}'.format(args.sql_file),
+             'Connection:          {0}'.format(args.connection),
+             'Output:              {0} ({1})'.format(filepath, args.format),
+             'Rows per file:       {0}'.format(rows_per_file),
+             'Parallel processes:  {0}'.format(args.parallel_processes),
+             'Streaming:           {0}'.format('yes' if args.stream else 'no'),
+             'Pre-flight estimate: {0}'.format('yes' if args.preflight else 'no'),
+             'Incremental:         {0}'.format('rows above the last exported {0}'.format(args.watermark_column) if args.watermark_column else 'no'),
+             'JIRA issue:          {0}'.format(args.jira_issue or 'none, files are not uploaded')]
+    export_manifest_filepath = manifest_filepath(split_output_extension(filepath)[0])
+    if args.resume and os.path.exists(export_manifest_filepath):
+        lines.append('Note:                resuming the failed run recorded in {0}'.format(export_manifest_filepath))
+    elif os.path.exists(filepath) and not args.overwrite:
+        lines.append('Note:                {0} already exists and will not be overwritten'.format(filepath))
+    return lines
+
+
+def run_export(args, config):
+    """Runs the export, importing the heavy modules only now.
+
+    Returns:
+        The exit code, 0 if the export succeeded.
+    """
+    from krano import Krano
+    from krano import KranoDecorationError
+    from krano import KranoExportError
+    from krano import KranoPreflightError
+    from krano import KranoUploadError
+    from valvo import get_export_options
+    from valvo import get_info_decoration
+
+    with open(args.sql_file, encoding='utf-8') as sql_file:
+        sql_statement = sql_file.read()
+
+    db_config = config.DATABASE_CONNECTION_SETTINGS[args.connection]
+    options = get_export_options()
+    options.update(stream=args.stream, output_format=args.format, max_file_size=args.max_file_size, resume=args.resume,
+                   watermark_column=args.watermark_column, exact_decimal_columns=args.exact_decimal,
+                   single_file=args.single_file, preflight=args.preflight)
+
+    krano = Krano()
+    krano.set_worker_config(getattr(config, 'EXPORT_WORKER_START_METHOD', 'forkserver'))
+    krano.set_database_config(db_config['connection_name'], db_config['host'], db_config['database_name'], db_config['user'], db_config['password'])
+    krano.set_export_config(args.export_folder)
+    if getattr(config, 'CACHE_FOLDERPATH', None):
+        krano.set_cache_config(config.CACHE_FOLDERPATH, config.CACHE_TTL_SECONDS, config.CACHE_MAX_SIZE_BYTES)
+    krano.set_metrics_config(getattr(config, 'METRICS_REPORT_FOLDERPATH', None), getattr(config, 'METRICS_PROMETHEUS_FOLDERPATH', None))
+    krano.set_preflight_config(getattr(config, 'EXPORT_PREFLIGHT_MAX_ROWS', None), getattr(config, 'EXPORT_PREFLIGHT_MAX_SIZE_BYTES', None),
+                               getattr(config, 'EXPORT_PREFLIGHT_REFUSE', False))
+
+    with krano:
+        excel_decorations = None
+        if args.jira_issue:
+            krano.set_jira_config(config.JIRA_BASE_URL, config.JIRA_USER, config.JIRA_PASSWORD, config.JIRA_PARALLEL_UPLOADS, config.JIRA_MAX_RETRIES,
+                                  config.JIRA_UPLOAD_BLOCK_SIZE)
+        if not args.no_decorations:
+            async def get_decorations():
+                if args.jira_issue:
+                    import jira
+                    # looked up while the query is executed
+                    title = await asyncio.get_running_loop().run_in_executor(None, lambda: jira.getissuetitle(
+                        config.JIRA_BASE_URL, args.jira_issue, config.JIRA_USER, config.JIRA_PASSWORD, client=krano.jira_client))
+                else:
+                    title = args.filename
+                return [get_info_decoration(args.creator, db_config, args.jira_issue, title)]
+            excel_decorations = get_decorations()
+
+        try:
+            krano.export(sql_statement, args.filename, config.XLSX_SHEET_NAME, args.chunk_size, args.overwrite, args.parallel_processes,
+                         excel_decorations, args.jira_issue, **options)
+        except (KranoExportError, KranoDecorationError, KranoUploadError, KranoPreflightError) as e:
+            logging.getLogger(__name__).error(str(e))
+            return 1
+    return 0
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    configure_logging(logging.WARNING if args.quiet else logging.INFO)
+
+    config, error = load_config()
+    if error:
+        print('krano: error: {0}'.format(error), file=sys.stderr)
+        return 2
+
+    resolve_options(args, config)
+    errors = validate(args, config)
+    for error in errors:
+        print('krano: error: {0}'.format(error), file=sys.stderr)
+    if errors:
+        return 2
+
+    if args.dry_run:
+        print('\n'.join(describe_export(args)))
+        return 0
+
+    return run_export(args, config)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,401 @@
+#/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+import pickle
+from array import array
+from bisect import bisect_right
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from decimal import Decimal
+try:
+    from multiprocessing.shared_memory import SharedMemory
+except ImportError:
+    SharedMemory = None
+try:
+    from multiprocessing import resource_tracker
+except ImportError:
+    resource_tracker = None
+import pgtypes
+
+EPOCH = datetime(1970, 1, 1)
+ONE_MICROSECOND = timedelta(microseconds=1)
+
+# Column kinds of the columnar layout, chosen from the PostgreSQL type OIDs
+KIND_INT64 = 'int64'
+KIND_FLOAT64 = 'float64'
+KIND_BOOL = 'bool'
+KIND_TEXT = 'text'
+KIND_DICTIONARY = 'dictionary'
+KIND_DECIMAL = 'decimal'
+KIND_DATE = 'date'
+KIND_TIMESTAMP = 'timestamp'
+KIND_TIMESTAMPTZ = 'timestamptz'
+KIND_PICKLE = 'pickle'
+
+COLUMN_KINDS = {
+    pgtypes.INT2_OID: KIND_INT64,
+    pgtypes.INT4_OID: KIND_INT64,
+    pgtypes.INT8_OID: KIND_INT64,
+    pgtypes.OID_OID: KIND_INT64,
+    pgtypes.FLOAT4_OID: KIND_FLOAT64,
+    pgtypes.FLOAT8_OID: KIND_FLOAT64,
+    pgtypes.BOOL_OID: KIND_BOOL,
+    pgtypes.TEXT_OID: KIND_TEXT,
+    pgtypes.VARCHAR_OID: KIND_TEXT,
+    pgtypes.BPCHAR_OID: KIND_TEXT,
+    pgtypes.NUMERIC_OID: KIND_DECIMAL,
+    pgtypes.DATE_OID: KIND_DATE,
+    pgtypes.TIMESTAMP_OID: KIND_TIMESTAMP,
+    pgtypes.TIMESTAMPTZ_OID: KIND_TIMESTAMPTZ
+}
+
+# Fixed width kinds: array typecode and the functions converting a non-NULL value to and from the stored number
+FIXED_WIDTH_KINDS = {
+    KIND_INT64: ('q', int, int),
+    KIND_FLOAT64: ('d', float, float),
+    KIND_BOOL: ('b', int, bool),
+    KIND_DATE: ('q', date.toordinal, date.fromordinal),
+    KIND_TIMESTAMP: ('q', lambda value: (value - EPOCH) // ONE_MICROSECOND, lambda number: EPOCH + timedelta(microseconds=number))
+}
+
+# Variable length kinds: the functions converting a non-NULL value to and from bytes
+VARIABLE_LENGTH_KINDS = {
+    KIND_TEXT: (lambda value: value.encode('utf-8'), lambda data: str(data, 'utf-8')),
+    KIND_DECIMAL: (lambda value: str(value).encode('ascii'), lambda data: Decimal(str(data, 'ascii'))),
+    KIND_PICKLE: (lambda value: pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), pickle.loads)
+}
+
+
+# A text column is dictionary encoded if it has at most this share of distinct values
+DICTIONARY_MAX_DISTINCT_SHARE = 0.5
+
+
+class ColumnarChunkError(Exception):
+    """Raised when a chunk cannot be handed off via shared memory."""
+    pass
+
+
+def _validity_bitmap(values):
+    """Returns a bitmap with one bit per value, set if the value is not NULL."""
+    bitmap = bytearray((len(values) + 7) // 8)
+    for index, value in enumerate(values):
+        if value is not None:
+            bitmap[index >> 3] |= 1 << (index & 7)
+    return bitmap
+
+
+def _encode_fixed_width(values, kind):
+    typecode, to_number, _ = FIXED_WIDTH_KINDS[kind]
+    return [array(typecode, [0 if value is None else to_number(value) for value in values])]
+
+
+def _encode_variable_length(values, kind):
+    to_bytes, _ = VARIABLE_LENGTH_KINDS[kind]
+    pieces = [b'' if value is None else to_bytes(value) for value in values]
+    offsets = array('q', [0])
+    position = 0
+    for piece in pieces:
+        position += len(piece)
+        offsets.append(position)
+    return [offsets, b''.join(pieces)]
+
+
+def _encode_dictionary(values):
+    """Encodes a text column as indices into its distinct values, None if it has too many distinct values."""
+    max_distinct = len(values) * DICTIONARY_MAX_DISTINCT_SHARE
+    dictionary = {}
+    indices = array('i')
+    for value in values:
+        if value is None:
+            indices.append(0)
+            continue
+        index = dictionary.get(value)
+        if index is None:
+            if len(dictionary) >= max_distinct:
+                return None
+            index = dictionary[value] = len(dictionary)
+        indices.append(index)
+    return [indices] + _encode_variable_length(list(dictionary), KIND_TEXT)
+
+
+def _encode_timestamptz(values):
+    wall_times = [None if value is None else value.replace(tzinfo=None) for value in values]
+    utc_offsets = array('i', [0 if value is None else int(value.utcoffset().total_seconds()) for value in values])
+    return _encode_fixed_width(wall_times, KIND_TIMESTAMP) + [utc_offsets]
+
+
+def encode_column(values, kind):
+    """Encodes the values of a column into a list of buffers, the first one being the validity bitmap.
+
+    Returns:
+        A tuple of the kind actually used and the list of buffers. Text columns with few distinct values are
+        dictionary encoded, columns whose values do not fit the requested kind are pickled value by value instead.
+    """
+    try:
+        if kind in FIXED_WIDTH_KINDS:
+            buffers = _encode_fixed_width(values, kind)
+        elif kind == KIND_TIMESTAMPTZ:
+            buffers = _encode_timestamptz(values)
+        elif kind == KIND_TEXT:
+            buffers = _encode_dictionary(values)
+            if buffers is None:
+                buffers = _encode_variable_length(values, kind)
+            else:
+                kind = KIND_DICTIONARY
+        else:
+            buffers = _encode_variable_length(values, kind)
+    except (TypeError, ValueError, AttributeError, OverflowError, UnicodeError):
+        kind = KIND_PICKLE
+        buffers = _encode_variable_length(values, kind)
+    return kind, [_validity_bitmap(values)] + buffers
+
+
+def decode_column(buffers, kind, row_start, row_stop):
+    """Decodes the rows row_start to row_stop of a column from its buffers (memoryviews) into a list of values."""
+    bitmap = buffers[0]
+    is_valid = [bool(bitmap[index >> 3] & (1 << (index & 7))) for index in range(row_start, row_stop)]
+
+    if kind in FIXED_WIDTH_KINDS or kind == KIND_TIMESTAMPTZ:
+        typecode, _, from_number = FIXED_WIDTH_KINDS[KIND_TIMESTAMP if kind == KIND_TIMESTAMPTZ else kind]
+        with buffers[1].cast(typecode) as numbers_view:
+            numbers = numbers_view[row_start:row_stop].tolist()
+        values = [from_number(number) if valid else None for number, valid in zip(numbers, is_valid)]
+        if kind == KIND_TIMESTAMPTZ:
+            with buffers[2].cast('i') as utc_offsets_view:
+                utc_offsets = utc_offsets_view[row_start:row_stop].tolist()
+            values = [None if value is None else value.replace(tzinfo=timezone(timedelta(seconds=utc_offset)))
+                      for value, utc_offset in zip(values, utc_offsets)]
+        return values
+
+    if kind == KIND_DICTIONARY:
+        with buffers[1].cast('i') as indices_view:
+            indices = indices_view[row_start:row_stop].tolist()
+        with buffers[2].cast('q') as offsets_view:
+            offsets = offsets_view.tolist()
+        data = buffers[3]
+        # A few rows, e.g. a sample, only decode the distinct values they refer to
+        entries = range(len(offsets) - 1) if len(indices) >= len(offsets) - 1 else set(indices)
+        dictionary = {index: str(data[offsets[index]:offsets[index + 1]], 'utf-8') for index in entries}
+        return [dictionary[index] if valid else None for index, valid in zip(indices, is_valid)]
+
+    _, from_bytes = VARIABLE_LENGTH_KINDS[kind]
+    with buffers[1].cast('q') as offsets_view:
+        offsets = offsets_view[row_start:row_stop + 1].tolist()
+    data = buffers[2]
+    return [from_bytes(data[offsets[index]:offsets[index + 1]]) if valid else None for index, valid in enumerate(is_valid)]
+
+
+def prepare_shared_memory():
+    """Starts the resource tracker of the current process, must be called before the worker processes are created.
+
+    Worker processes forked before the tracker is running start trackers of their own, which then consider
+    every segment attached by the worker as leaked.
+    """
+    if resource_tracker is not None:
+        resource_tracker.ensure_running()
+
+
+class SharedColumnarChunk(object):
+    """Describes a chunk of records encoded column by column into a shared memory segment.
+
+    Only the segment name, the column metadata and the row offsets are pickled when the chunk is passed to another
+    process. Iterating over the chunk attaches to the segment and decodes the rows on the fly.
+
+    Args:
+        segment_name (str): Name of the shared memory segment containing the encoded columns.
+        columns (list): Column metadata, one tuple of the column kind and the (offset, length) of its buffers each.
+        row_start (int): Index of the first row of the chunk within the segment.
+        row_stop (int): Index after the last row of the chunk within the segment.
+    """
+    def __init__(self, segment_name, columns, row_start, row_stop):
+        self.segment_name = segment_name
+        self.columns = columns
+        self.row_start = row_start
+        self.row_stop = row_stop
+
+    @classmethod
+    def create(cls, records, column_type_codes):
+        """Encodes the records into a new shared memory segment.
+
+        Args:
+            records (list): The rows (tuples) to be encoded.
+            column_type_codes (list): The PostgreSQL type OIDs of the columns, used to choose the column kinds.
+
+        Returns:
+            A tuple of the SharedColumnarChunk and the SharedMemory segment. The caller owns the segment and has to
+            close and unlink it once the chunk was consumed.
+
+        Raises:
+            ColumnarChunkError: Shared memory is not available in this Python version.
+        """
+        if SharedMemory is None:
+            raise ColumnarChunkError('Handing off chunks via shared memory requires Python 3.8 or higher.')
+
+        if records and not column_type_codes:
+            column_type_codes = [None] * len(records[0])
+
+        encoded_columns = []
+        for column_values, type_code in zip(zip(*records), column_type_codes or []):
+            encoded_columns.append(encode_column(column_values, COLUMN_KINDS.get(type_code, KIND_PICKLE)))
+
+        segment_size = sum(memoryview(buffer).nbytes for _, buffers in encoded_columns for buffer in buffers)
+        segment = SharedMemory(create=True, size=max(segment_size, 1))
+
+        columns = []
+        position = 0
+        for kind, buffers in encoded_columns:
+            buffer_positions = []
+            for buffer in buffers:
+                with memoryview(buffer) as view, view.cast('B') as byte_view:
+                    segment.buf[position:position + byte_view.nbytes] = byte_view
+                    buffer_positions.append((position, byte_view.nbytes))
+                    position += byte_view.nbytes
+            columns.append((kind, buffer_positions))
+
+        return cls(segment.name, columns, 0, len(records)), segment
+
+    def __len__(self):
+        return self.row_stop - self.row_start
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def load(self):
+        """Attaches to the shared memory segment and decodes the rows of the chunk.
+
+        Returns:
+            A list of rows (tuples).
+        """
+        segment = SharedMemory(name=self.segment_name)
+        try:
+            decoded_columns = []
+            for kind, buffer_positions in self.columns:
+                buffers = [segment.buf[offset:offset + length] for offset, length in buffer_positions]
+                try:
+                    decoded_columns.append(decode_column(buffers, kind, self.row_start, self.row_stop))
+                finally:
+                    for buffer in buffers:
+                        buffer.release()
+        finally:
+            segment.close()
+
+        if not decoded_columns:
+            return [()] * len(self)
+        return list(zip(*decoded_columns))
+
+
+def encode_block(records, kinds):
+    """Encodes a block of records column by column.
+
+    Args:
+        records (list): The rows (tuples) to be encoded.
+        kinds (list): The requested kind of every column, see COLUMN_KINDS.
+
+    Returns:
+        A tuple of the row count and the list of (kind, buffers) of the columns, see encode_column().
+    """
+    if records and not kinds:
+        kinds = [KIND_PICKLE] * len(records[0])
+    return len(records), [encode_column(column_values, kind) for column_values, kind in zip(zip(*records), kinds)]
+
+
+def decode_block(columns, row_start, row_stop):
+    """Returns an iterator over the rows row_start to row_stop of a block encoded by encode_block()."""
+    if not columns:
+        return iter([()] * (row_stop - row_start))
+    return zip(*[decode_column([memoryview(buffer).cast('B') for buffer in buffers], kind, row_start, row_stop) for kind, buffers in columns])
+
+
+class ColumnarRecords(object):
+    """A sequence of records (tuples) stored column by column in typed arrays instead of Python objects.
+
+    The records are kept in blocks as they arrive from the database. Every column of a block is encoded by encode_column():
+    numbers, booleans, dates and timestamps as arrays of machine values, texts with few distinct values dictionary encoded,
+    NULLs in a validity bitmap. This takes a fraction of the memory of a list of tuples. Slicing without a step returns a
+    view sharing the blocks, the rows are only decoded while iterating over them. A pickled view only contains its rows.
+
+    Args:
+        blocks (list): The blocks, one tuple of the row count and the encoded columns each, see encode_block().
+        row_start (int): Index of the first row of the view, defaults to 0.
+        row_stop (int): Index after the last row of the view, defaults to None (all rows).
+    """
+    def __init__(self, blocks, row_start=0, row_stop=None):
+        self.blocks = blocks
+        self.block_starts = [0]
+        for row_count, _ in blocks:
+            self.block_starts.append(self.block_starts[-1] + row_count)
+        self.row_start = row_start
+        self.row_stop = self.block_starts[-1] if row_stop is None else row_stop
+
+    @classmethod
+    def from_batches(cls, batches, column_type_codes=None):
+        """Encodes the records batch by batch, so they are never held as a whole list of tuples.
+
+        Args:
+            batches (iterable): Lists of rows (tuples), e.g. as fetched from the database.
+            column_type_codes (list): The PostgreSQL type OIDs of the columns, used to choose the column kinds, defaults to None.
+        """
+        kinds = [COLUMN_KINDS.get(type_code, KIND_PICKLE) for type_code in column_type_codes or []]
+        return cls([encode_block(batch, kinds) for batch in batches if batch])
+
+    def _view(self, row_start, row_stop):
+        view = ColumnarRecords.__new__(ColumnarRecords)
+        view.blocks = self.blocks
+        view.block_starts = self.block_starts
+        view.row_start = row_start
+        view.row_stop = row_stop
+        return view
+
+    def _block_ranges(self, row_start, row_stop):
+        """Yields the blocks holding the rows row_start to row_stop, together with the range of these rows within each block."""
+        block_index = bisect_right(self.block_starts, row_start) - 1
+        while row_start < row_stop:
+            block_start = self.block_starts[block_index]
+            row_count, columns = self.blocks[block_index]
+            stop = min(row_stop, block_start + row_count)
+            yield row_count, columns, row_start - block_start, stop - block_start
+            row_start = stop
+            block_index += 1
+
+    def __len__(self):
+        return self.row_stop - self.row_start
+
+    def __iter__(self):
+        for _, columns, start, stop in self._block_ranges(self.row_start, self.row_stop):
+            yield from decode_block(columns, start, stop)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                return self._view(self.row_start + start, self.row_start + max(start, stop))
+            return [self[position] for position in range(start, stop, step)]
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('ColumnarRecords index out of range')
+        row = self.row_start + index
+        return next(iter(self._view(row, row + 1)))
+
+    @property
+    def nbytes(self):
+        """The size of the encoded blocks in bytes, including the rows outside of a view."""
+        return sum(memoryview(buffer).nbytes for _, columns in self.blocks for _, buffers in columns for buffer in buffers)
+
+    def __getstate__(self):
+        blocks = []
+        for row_count, columns, start, stop in self._block_ranges(self.row_start, self.row_stop):
+            if stop - start == row_count:
+                blocks.append((row_count, columns))
+            else:
+                kinds = [KIND_TEXT if kind == KIND_DICTIONARY else kind for kind, _ in columns]
+                blocks.append(encode_block(list(decode_block(columns, start, stop)), kinds))
+        return {'blocks': blocks}
+
+    def __setstate__(self, state):
+        self.__init__(state['blocks'])
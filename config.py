@@ -1,22 +1,55 @@
-#/usr/bin/python
-# -*- coding: utf-8 -*-
-
-import secrets
-
-DATABASE_CONNECTION_SETTINGS = {
-    'Database DEV': {'connection_name': 'Database DEV', 'host': 'db_dev.evilcompany.local',
-                    'database_name': 'some_database', 'user': 'someone', 'password': secrets.DB_PASSWORDS['Database DEV']},
-    'Database TEST': {'connection_name': 'Database TEST', 'host': 'db_test.evilcompany.local',
-                    'database_name': 'some_database', 'user': 'someone', 'password': secrets.DB_PASSWORDS['Database TEST']},
-    'Database PROD': {'connection_name': 'Database REF', 'host': 'db_prod.evilcompany.local',
-                    'database_name': 'some_database', 'user': 'someone', 'password': secrets.DB_PASSWORDS['Database PROD']}
-}
-
-EXPORT_FOLDERPATH = '/Users/someone/Desktop/krano_export/'
-EXPORT_OVERWRITE_FILES = True
-EXPORT_PARALLEL_PROCESSES = 3
-XLSX_SHEET_NAME = 'Data'
-
-JIRA_BASE_URL = 'jira.evilcompany.com'
-JIRA_USER = 'Someone'
-JIRA_PASSWORD = secrets.JIRA_PASSWORD
\ No newline at end of file
+#/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import secrets
+
+DATABASE_CONNECTION_SETTINGS = {
+    'Database DEV': {'connection_name': 'Database DEV', 'host': 'db_dev.evilcompany.local',
+                    'database_name': 'some_database', 'user': 'someone', 'password': secrets.DB_PASSWORDS['Database DEV']},
+    'Database TEST': {'connection_name': 'Database TEST', 'host': 'db_test.evilcompany.local',
+                    'database_name': 'some_database', 'user': 'someone', 'password': secrets.DB_PASSWORDS['Database TEST']},
+    'Database PROD': {'connection_name': 'Database REF', 'host': 'db_prod.evilcompany.local',
+                    'database_name': 'some_database', 'user': 'someone', 'password': secrets.DB_PASSWORDS['Database PROD']}
+}
+
+EXPORT_FOLDERPATH = '/Users/someone/Desktop/krano_export/'
+EXPORT_OVERWRITE_FILES = True
+EXPORT_PARALLEL_PROCESSES = 'auto'
+EXPORT_STREAM_RECORDS = False
+EXPORT_XLSX_ENGINE = 'native'
+EXPORT_CHUNK_HANDOFF = 'pickle'
+EXPORT_FETCH_METHOD = 'cursor'
+EXPORT_PARTITIONS = 1
+EXPORT_PARTITION_COLUMN = None
+EXPORT_PARTITION_METHOD = 'hash'
+EXPORT_OUTPUT_FORMAT = None
+EXPORT_MAX_FILE_SIZE_BYTES = None
+EXPORT_WORKER_START_METHOD = 'forkserver'
+EXPORT_RESUME = True
+EXPORT_PROCESS_RETRIES = 2
+EXPORT_EXACT_DECIMAL_COLUMNS = []
+EXPORT_COLUMNAR_RESULTS = False
+EXPORT_SINGLE_FILE = False
+EXPORT_PREFLIGHT = False
+EXPORT_PREFLIGHT_MAX_ROWS = None
+EXPORT_PREFLIGHT_MAX_SIZE_BYTES = None
+EXPORT_PREFLIGHT_REFUSE = False
+XLSX_SHEET_NAME = 'Data'
+
+CACHE_FOLDERPATH = None
+CACHE_TTL_SECONDS = 86400
+CACHE_MAX_SIZE_BYTES = 10 * 1024 ** 3
+CACHE_MODE = 'use'
+
+METRICS_REPORT_FOLDERPATH = None
+METRICS_PROMETHEUS_FOLDERPATH = None
+
+BATCH_MAX_CONNECTIONS_PER_DATABASE = 2
+
+JIRA_BASE_URL = 'jira.evilcompany.com'
+JIRA_USER = 'Someone'
+JIRA_PASSWORD = secrets.JIRA_PASSWORD
+JIRA_PARALLEL_UPLOADS = 4
+JIRA_MAX_RETRIES = 3
+JIRA_UPLOAD_BLOCK_SIZE = 1024 ** 2
+JIRA_UPLOAD_FROM_MEMORY = False
\ No newline at end of file
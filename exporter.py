@@ -1,422 +1,1409 @@
-#/usr/bin/python
-# -*- coding: utf-8 -*-
-
-import logging
-logging.basicConfig(level=logging.INFO,
-                    format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
-logger = logging.getLogger(__name__)
-import os
-from multiprocessing import Pool
-from datetime import datetime
-from pandas import DataFrame
-from pandas import ExcelWriter
-from openpyxl import load_workbook
-from openpyxl.styles import Font, Alignment
-from prettytable import PrettyTable
-
-
-class ExcelExporterChunkSizeError(Exception):
-    """"Raised when the given chunk size exceeds 1048576, the maximum number of rows in an XLSX file."""
-    pass
-
-
-class ExcelExportProcessError(Exception):
-    """Raised when an Excel export process fails."""
-    def __init__(self, message, excel_export_process):
-        self.message = message
-        self.excel_export_process = excel_export_process
-
-
-class ExcelDecoratorError(Exception):
-    """Raised when an Excel decoration process fails."""
-    def __init__(self, message, excel_decorator):
-        self.message = message
-        self.excel_decorator = excel_decorator
-
-
-class ExcelExportProcessResult(object):
-    """Contains the results of a successful Excel export process.
-
-    Args:
-        filepath (str): File path of the created Excel file.
-        file_size (str): Human readable size of the created Excel file.
-        creation_duration (str): The duration needed to create the Excel file.
-        row_count (int): The count of rows exported to the Excel file.
-    """
-    def __init__(self, filepath, file_size, creation_duration, row_count):
-        self.filepath = filepath
-        self.file_size = file_size
-        self.creation_duration = creation_duration
-        self.row_count = row_count
-
-
-class ExcelExportProcess(object):
-    """Exports a chunk of records into one Excel document.
-
-    Args:
-        process_name (str): Name of the process (e.g. 'Excel exporter no. 1').
-        filepath (str): File path of the Excel file to be created.
-        records (list): The records to be saved in the Excel file.
-        column_names (list): The column names used as header information.
-        sheet_name (str): The name of the worksheet to be created in the Excel file.
-        overwrite (bool): Flag to indicate whether an already existing Excel file should be overwritten or not.
-    """
-    def __init__(self, process_name, filepath, records, column_names, sheet_name, overwrite):
-        self.process_name = process_name
-        self.filepath = filepath
-        self.records = records
-        self.column_names = column_names
-        self.sheet_name = sheet_name
-        self.overwrite = overwrite
-
-    def run(self):
-        try:
-            logger.info("{0} starting to export {1} rows to XLSX file {2} ...".format(self.process_name,
-                                                                                  len(self.records),
-                                                                                  self.filepath))
-            export_start_time = datetime.now().replace(microsecond=0)
-
-            df = DataFrame(self.records, columns=self.column_names)
-            writer = ExcelWriter(self.filepath, engine='xlsxwriter', options={'encoding': 'utf-8',
-                                                                              'remove_timezone': True,
-                                                                              'strings_to_formulas': False})
-            df.to_excel(writer, self.sheet_name)
-            writer.save()
-
-            export_end_time = datetime.now().replace(microsecond=0)
-            export_duration = export_end_time - export_start_time
-
-            file_size = self._human_readable_size(os.path.getsize(self.filepath), 2)
-
-            logger.info("{0} exported {1} rows to XLSX file {2} ({3}) in {4}".format(self.process_name,
-                                                                                     len(self.records),
-                                                                                     self.filepath,
-                                                                                     file_size,
-                                                                                     export_duration))
-
-            result = ExcelExportProcessResult(self.filepath, file_size, export_duration, len(self.records))
-            return result
-        except Exception as e:
-            logger.error('{0} encountered an error: {1}'.format(self.process_name, str(e)))
-            return ExcelExportProcessError(str(e), self)
-
-    def _human_readable_size(self, size, decimal_places):
-        """"Return a human readable file size."""
-        for unit in ['','KB','MB','GB','TB']:
-            if size < 1024.0:
-                break
-            size /= 1024.0
-        return f"{size:.{decimal_places}f}{unit}"
-
-
-class ExcelExporterResult(object):
-    """Contains the results of an Excel export."""
-    def __init__(self, excel_export_process_results, excel_export_process_errors):
-        self.excel_export_process_results = excel_export_process_results
-        self.excel_export_process_errors = excel_export_process_errors
-
-    def has_errros(self):
-        """Indicates whether the Excel export encountered errors."""
-        return len(self.excel_export_process_errors) > 0
-
-
-class ExcelDcorationManagerResult(object):
-    """Contains the results of an Excel export."""
-    def __init__(self, excel_decoration_process_results, excel_decoration_process_errors):
-        self.excel_decoration_process_results = excel_decoration_process_results
-        self.excel_decoration_process_errors = excel_decoration_process_errors
-
-    def has_errros(self):
-        """Indicates whether the Excel export encountered errors."""
-        return len(self.excel_decoration_process_errors) > 0
-
-
-class ExcelExporter(object):
-    """"Exports records fetched from a PostgreSQL database into one or several Excel documents.
-
-    Args:
-        filepath (str): File path of the Excel file to be created.
-        query_result (QueryResult): The query result to be exported to one or several Excel file(s).
-        chunk_size (int): The maximum count of rows exported to a single Excel file.
-        sheet_name (str): The name of the worksheet to be created in the Excel file(s).
-        overwrite (bool): Flag to indicate whether an already existing Excel file should be overwritten or not.
-        parallel_processes (int): The maximum count of parallel Excel export processes to be started, defaults to 2.
-    """
-    def __init__(self, filepath, query_result, chunk_size, sheet_name, overwrite=False, parallel_processes=2):
-        self.filepath = filepath
-        self.query_result = query_result
-        self.chunk_size = chunk_size
-        self.sheet_name = sheet_name
-        self.overwrite = overwrite
-        self.parallel_processes = parallel_processes
-        self.filepath_part, self.filepath_extension = os.path.splitext(self.filepath)
-
-        if self.chunk_size > 1048576:
-            raise ExcelExporterChunkSizeError("The chunk size must not exceed 1048576, the maximum number of rows in an XLSX file.")
-
-    def export(self):
-        total_file_count = self._calculate_total_file_count()
-        pool = Pool(processes=self.parallel_processes)
-        process_results = []
-
-        logger.info('+{0}+'.format(60 * '-'))
-        logger.info('Excel exporter initializing a pool with {0} parallel processes for creating {1} XLSX file(s)...'.format(self.parallel_processes,
-                                                                                                                             total_file_count))
-
-        total_export_start_time = datetime.now().replace(microsecond=0)
-        file_counter = 0
-        for chunk_records in self._chunker(self.query_result.records, self.chunk_size):
-            file_counter += 1
-
-            if total_file_count == 1:
-                xlsx_filepath = "{0}{1}".format(self.filepath_part, self.filepath_extension)
-            else:
-                xlsx_filepath = "{0}_{1}{2}".format(self.filepath_part, file_counter, self.filepath_extension)
-
-            if not self.overwrite:
-                if os.path.isfile(xlsx_filepath):
-                    logger.info("Excel file at {0} already exists, will not overwrite it".format(xlsx_filepath))
-                    continue
-
-            excel_export_process = ExcelExportProcess('Excel export process no. {0}'.format(file_counter), xlsx_filepath,
-                                                      chunk_records, self.query_result.column_names, self.sheet_name, False)
-
-            process_result = pool.apply_async(excel_export_process.run)
-            process_results.append(process_result)
-
-        pool.close()
-        pool.join()
-
-        total_export_end_time = datetime.now().replace(microsecond=0)
-        total_export_duration = total_export_end_time - total_export_start_time
-
-        logger.info('Excel exporter finished, gathering results...')
-
-        excel_export_process_results = []
-        excel_export_process_errors = []
-
-        for process_result in process_results:
-            if isinstance(process_result.get(), ExcelExportProcessError):
-                excel_export_process_error = process_result.get()
-                excel_export_process_errors.append(excel_export_process_error)
-            else:
-                excel_export_process_result = process_result.get()
-                excel_export_process_results.append(excel_export_process_result)
-
-        excel_export_result = ExcelExporterResult(excel_export_process_results, excel_export_process_errors)
-
-        pt = PrettyTable()
-        pt.field_names = ['Statistic label', 'Statistic content']
-        pt.add_row(['Excel export errors', len(excel_export_process_errors)])
-        pt.add_row(['Successsfully exported files', len(excel_export_process_results)])
-        pt.add_row(['Total export time', total_export_duration])
-        logger.info('{0}{1}'.format('Statistics:\n', pt))
-
-        return excel_export_result
-
-    def _chunker(self, seq, size):
-        """Chunk a sequence by the given size."""
-        return (seq[pos:pos + size] for pos in range(0, len(seq), size))
-
-    def _calculate_total_file_count(self):
-        """Calculates the total count of Excel files to be created."""
-        mod = self.query_result.record_count % self.chunk_size
-        if mod > 0:
-            total_file_count = int(self.query_result.record_count / self.chunk_size) + 1
-        else:
-            total_file_count = int(self.query_result.record_count / self.chunk_size)
-        return total_file_count
-
-
-class ExcelDecorationElement(object):
-    """Stores the label and content for a single Excel decoration element.
-
-    Args:
-        label (str): The label of the decoration element, e.g. 'Created by'.
-        content (str): The content of the decoration element, e.g. 'Darth Vader'.
-    """
-    def __init__(self, label, content):
-        self.label = label
-        self.content = content
-
-
-class ExcelDecoration(object):
-    """Stores all elements for an Excel decoration.
-
-    Args:
-        sheet_name (str): The name of the worksheet to be created.
-        title (str): The title of the decoration, e.g. 'Details' or 'Info'.
-    """
-    def __init__(self, sheet_name, title):
-        self.sheet_name = sheet_name
-        self.title = title
-        self.elements = []
-
-    def add_element(self, element):
-        """Adds an excel decoration element."""
-        self.elements.append(element)
-
-
-class ExcelDecorator(object):
-    """Decorates a given Excel file with one or more decorations.
-
-    Args:
-        process_name (str): Name of the excel decoration process, e.g. 'Excel decoration process no. 1'.
-        filepath (str): File path of the Excel file to be decorated.
-        decorations (list): The decorations to be applied to the Excel file.
-    """
-    def __init__(self, process_name, filepath, decorations):
-        self.process_name = process_name
-        self.filepath = filepath
-        self.decorations = decorations
-
-    def add_decoration(self, decoration):
-        self.decorations.append(decoration)
-
-    def _replace_placeholders(self, content):
-        if content == 'CURRENT_DATETIME':
-            return datetime.now()
-        else:
-            return content
-
-    def decorate(self):
-        try:
-            title_font = Font(name='Calibri',
-                              size=22,
-                              bold=False,
-                              italic=False,
-                              vertAlign=None,
-                              underline='none',
-                              strike=False,
-                              color='FF000000')
-
-            key_font = Font(name='Calibri',
-                            size=11,
-                            bold=True,
-                            italic=False,
-                            vertAlign=None,
-                            underline='none',
-                            strike=False,
-                            color='FF000000')
-
-            value_font = Font(name='Calibri',
-                              size=11,
-                              bold=False,
-                              italic=False,
-                              vertAlign=None,
-                              underline='none',
-                              strike=False,
-                              color='FF000000')
-
-            decoration_start_time = datetime.now().replace(microsecond=0)
-
-            logger.info("{0} writing additional informations to Excel file at {1}...".format(self.process_name, self.filepath))
-            wb = load_workbook(filename=self.filepath)
-
-            for decoration in self.decorations:
-                logger.info("{0} adding work sheet named '{1}' with title '{2}'".format(self.process_name, decoration.sheet_name, decoration.title))
-                ws = wb.create_sheet(title=decoration.sheet_name)
-                ws['B3'] = decoration.title
-                ws['B3'].font = title_font
-
-                cell_index = 6
-                for element in decoration.elements:
-                    key_cell = "B{0}".format(cell_index)
-                    value_cell = "C{0}".format(cell_index)
-
-                    ws[key_cell] = element.label
-                    ws[key_cell].font = key_font
-                    ws[key_cell].alignment = Alignment(horizontal='right')
-                    ws[value_cell] = self._replace_placeholders(element.content)
-                    ws[value_cell].font = value_font
-                    ws[value_cell].alignment = Alignment(horizontal='left')
-
-                    cell_index += 1
-
-            logger.info("{0} saving Excel file at {1}...".format(self.process_name, self.filepath))
-            wb.save(self.filepath)
-
-            decoration_end_time = datetime.now().replace(microsecond=0)
-            decoration_duration = decoration_end_time - decoration_start_time
-            logger.info("{0} successfully decorated Excel file at {1} in {2}".format(self.process_name, self.filepath, decoration_duration))
-
-            return self.filepath
-        except Exception as e:
-            logger.error('{0} encountered an error: {1}'.format(self.process_name, str(e)))
-            return ExcelDecoratorError(str(e), self)
-
-
-class ExcelDecorationManager(object):
-    """Applies the given decorations to the given Excel files.
-
-    Args:
-        filepaths (list): A list of Excel file paths to be decorated.
-        decorations (list): A list of Excel decorations to be applied to each Excel file.
-        parallel_processes (int): The maximum count of parallel Excel decoration processes to be started, defaults to 2.
-    """
-    def __init__(self, filepaths, decorations, parallel_processes=2):
-        self.filepaths = filepaths
-        self.decorations = decorations
-        self.parallel_processes = parallel_processes
-
-    def decorate(self):
-        logger.info('+{0}+'.format(60 * '-'))
-        logger.info('Excel decoration manager initializing a pool with {0} parallel processes for decorating {1} XLSX file(s)...'.format(self.parallel_processes,
-                                                                                                                             len(self.filepaths)))
-
-        pool = Pool(processes=self.parallel_processes)
-        process_results = []
-
-        total_decoration_start_time = datetime.now().replace(microsecond=0)
-        file_counter = 0
-        for filepath in self.filepaths:
-            file_counter += 1
-            process_name = 'Excel decoration process {0}'.format(file_counter)
-            excel_decorator = ExcelDecorator(process_name, filepath, self.decorations)
-            process_result = pool.apply_async(excel_decorator.decorate)
-            process_results.append(process_result)
-
-        pool.close()
-        pool.join()
-
-        total_decoration_end_time = datetime.now().replace(microsecond=0)
-        total_decoration_duration = total_decoration_end_time - total_decoration_start_time
-
-        logger.info('Excel decoration finished, gathering results...')
-
-        excel_decoration_process_results = []
-        excel_decoration_process_errors = []
-
-        for process_result in process_results:
-            if isinstance(process_result.get(), ExcelDecoratorError):
-                excel_decoration_process_error = process_result.get()
-                excel_decoration_process_errors.append(excel_decoration_process_error)
-            else:
-                excel_decoration_process_result = process_result.get()
-                excel_decoration_process_results.append(excel_decoration_process_result)
-
-        pt = PrettyTable()
-        pt.field_names = ['Statistic label', 'Statistic content']
-        pt.add_row(['Excel decoration errors', len(excel_decoration_process_errors)])
-        pt.add_row(['Successsfully decorated files', len(excel_decoration_process_results)])
-        pt.add_row(['Total decoration time', total_decoration_duration])
-        logger.info('{0}{1}'.format('Statistics:\n', pt))
-
-        return ExcelDcorationManagerResult(excel_decoration_process_results, excel_decoration_process_errors)
-
-
-class SQLFileWriter(object):
-    """Write an SQL query to a text file.
-
-    Args:
-        filepath (str): File path of the SQL file to be created.
-        query (str): SQL query to be written to the file.
-    """
-    def __init__(self, filepath, sql_statement):
-        self.filepath = filepath
-        self.sql_statement = sql_statement
-
-    def write(self):
-        """Write SQL query to a file."""
-        with open(self.filepath, mode='w', encoding='utf-8') as a_file:
+#/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+import io
+import math
+import os
+import time
+from collections import deque
+from multiprocessing import Pool
+from queue import Queue
+from queue import Full
+from threading import BoundedSemaphore
+from threading import Event
+from threading import Lock
+from threading import Thread
+from datetime import datetime
+from datetime import timedelta
+from prettytable import PrettyTable
+from writers import FORMAT_XLSX
+from writers import get_writer
+from writers import is_complete_file
+from writers import split_output_extension
+from columnar import SharedColumnarChunk
+from columnar import prepare_shared_memory
+from resources import PARALLEL_AUTO
+from resources import MemoryAdmission
+from resources import auto_parallel_processes
+from resources import estimate_decoration_memory
+from resources import estimate_export_memory
+from resources import memory_reserve
+from metrics import STAGE_DECORATE
+from metrics import STAGE_FRAME_BUILD
+from metrics import STAGE_HANDOFF
+from metrics import STAGE_NORMALISE
+from metrics import STAGE_WRITE
+from metrics import Span
+from metrics import elapsed
+from metrics import measure
+from manifest import file_checksum
+from normalise import ColumnNormaliser
+from xlsxparts import XLSX_MAX_ROWS
+from xlsxparts import SheetPartWriter
+from xlsxparts import StitchedXlsxWriter
+
+
+HANDOFF_PICKLE = 'pickle'
+HANDOFF_SHARED_MEMORY = 'shared_memory'
+
+
+def human_readable_size(size, decimal_places):
+    """"Return a human readable file size."""
+    for unit in ['','KB','MB','GB','TB']:
+        if size < 1024.0:
+            break
+        size /= 1024.0
+    return f"{size:.{decimal_places}f}{unit}"
+
+
+def pool_startup_statistic(pool, own_pool_startup_duration, was_warm):
+    """Returns the startup time of a process pool for the statistics, None if it is not known.
+
+    Args:
+        pool: The process pool, e.g. a workers.WorkerPool.
+        own_pool_startup_duration (float): The seconds needed to start a pool of its own, None if a shared pool was used.
+        was_warm (bool): Indicates whether the shared pool already ran tasks before.
+    """
+    if own_pool_startup_duration is not None:
+        return '{0:.3f}s'.format(own_pool_startup_duration)
+    startup_duration = getattr(pool, 'startup_duration', None)
+    if startup_duration is None:
+        return None
+    if was_warm:
+        return 'warm (started in {0:.3f}s)'.format(startup_duration)
+    return '{0:.3f}s'.format(startup_duration)
+
+
+class ExcelExporterChunkSizeError(Exception):
+    """"Raised when the given chunk size exceeds 1048575, the maximum number of rows in an XLSX file less the header row."""
+    pass
+
+
+class ExcelExportProcessError(Exception):
+    """Raised when an Excel export process fails."""
+    def __init__(self, message, excel_export_process):
+        self.message = message
+        self.excel_export_process = excel_export_process
+
+
+class ExcelDecoratorError(Exception):
+    """Raised when an Excel decoration process fails."""
+    def __init__(self, message, excel_decorator):
+        self.message = message
+        self.excel_decorator = excel_decorator
+
+
+class ExcelExportProcessResult(object):
+    """Contains the results of a successful Excel export process.
+
+    Args:
+        filepath (str): File path of the created Excel file.
+        file_size (str): Human readable size of the created Excel file.
+        creation_duration (str): The duration needed to create the Excel file.
+        row_count (int): The count of rows exported to the Excel file.
+        data (bytes): The content of the file if it was created in memory, defaults to None.
+        file_size_bytes (int): Size of the created Excel file in bytes, defaults to None.
+        spans (list): The metrics.Span objects measured by the export process, defaults to None.
+        checksum (str): The SHA-256 checksum of the created Excel file, if it was requested, defaults to None.
+        reused (bool): Indicates whether the file was created by an earlier run and reused, see manifest.ExportManifest. Defaults to False.
+    """
+    def __init__(self, filepath, file_size, creation_duration, row_count, data=None, file_size_bytes=None, spans=None, checksum=None,
+                 reused=False):
+        self.filepath = filepath
+        self.file_size = file_size
+        self.creation_duration = creation_duration
+        self.row_count = row_count
+        self.data = data
+        self.file_size_bytes = file_size_bytes
+        self.spans = spans or []
+        self.checksum = checksum
+        self.reused = reused
+
+
+class ExcelExportProcess(object):
+    """Exports a chunk of records into one Excel document, or one file of another output format.
+
+    Args:
+        process_name (str): Name of the process (e.g. 'Excel exporter no. 1').
+        filepath (str): File path of the Excel file to be created.
+        records (list): The records to be saved in the Excel file.
+        column_names (list): The column names used as header information.
+        sheet_name (str): The name of the worksheet to be created in the Excel file.
+        overwrite (bool): Flag to indicate whether an already existing Excel file should be overwritten or not.
+        column_type_codes (list): The PostgreSQL type OIDs of the columns, defaults to None.
+        engine (str): The XLSX writer engine, either 'native' (constant memory) or 'pandas', defaults to 'native'.
+        decorations (list): ExcelDecoration objects written as additional worksheets while the Excel file is created, defaults to None.
+        output_format (str): The output format, one of writers.OUTPUT_FORMATS, defaults to 'xlsx'.
+        in_memory (bool): Create the file in memory and return its content instead of writing it to the file path, defaults to False.
+        file_number (int): The number of the file, recorded as chunk in the metrics spans, defaults to None.
+        checksum (bool): Compute the SHA-256 checksum of the created file, e.g. for an export manifest, defaults to False.
+        normaliser (normalise.ColumnNormaliser): Converts the columns of the records before they are written, defaults to None.
+    """
+    def __init__(self, process_name, filepath, records, column_names, sheet_name, overwrite, column_type_codes=None, engine='native',
+                 decorations=None, output_format=FORMAT_XLSX, in_memory=False, file_number=None, checksum=False, normaliser=None):
+        self.process_name = process_name
+        self.filepath = filepath
+        self.records = records
+        self.column_names = column_names
+        self.sheet_name = sheet_name
+        self.overwrite = overwrite
+        self.column_type_codes = column_type_codes
+        self.engine = engine
+        self.decorations = decorations or []
+        self.output_format = output_format
+        self.in_memory = in_memory
+        self.file_number = file_number
+        self.checksum = checksum
+        self.normaliser = normaliser
+
+    def run(self):
+        try:
+            logger.info("{0} starting to export {1} rows to {2} file {3} ...".format(self.process_name,
+                                                                                 len(self.records),
+                                                                                 self.output_format.upper(),
+                                                                                 self.filepath))
+            spans = []
+            records = self.records
+            column_type_codes = self.column_type_codes
+            if self.normaliser:
+                with measure(STAGE_NORMALISE, rows=len(records), chunk=self.file_number) as normalise_span:
+                    records = self.normaliser.normalise(records)
+                    column_type_codes = self.normaliser.converted_type_codes()
+                spans.append(normalise_span.span)
+
+            with measure(STAGE_WRITE, rows=len(records), chunk=self.file_number) as write_span:
+                writer_class = get_writer(self.output_format, self.engine)
+                target = io.BytesIO() if self.in_memory else self.filepath
+                writer = writer_class(target, self.sheet_name, self.column_names, column_type_codes)
+                writer.write(records)
+                if self.decorations:
+                    logger.info("{0} adding {1} decoration work sheet(s) to XLSX file {2}".format(self.process_name, len(self.decorations), self.filepath))
+                    writer.write_decorations(self.decorations)
+                writer.close()
+
+                data = target.getvalue() if self.in_memory else None
+                file_size_bytes = len(data) if self.in_memory else os.path.getsize(self.filepath)
+                write_span.size = file_size_bytes
+
+            export_duration = timedelta(seconds=round(write_span.span.duration, 3))
+            file_size = self._human_readable_size(file_size_bytes, 2)
+
+            # The write span covers the whole file, a DataFrame built by the pandas engine is reported separately as well
+            spans.append(write_span.span)
+            frame_build_duration = getattr(writer, 'frame_build_duration', None)
+            if frame_build_duration is not None:
+                spans.append(Span(STAGE_FRAME_BUILD, frame_build_duration, rows=len(self.records), chunk=self.file_number,
+                                  started=write_span.span.started))
+
+            logger.info("{0} exported {1} rows to {2} file {3}{4} ({5}) in {6}".format(self.process_name,
+                                                                                       len(self.records),
+                                                                                       self.output_format.upper(),
+                                                                                       self.filepath,
+                                                                                       ' in memory' if self.in_memory else '',
+                                                                                       file_size,
+                                                                                       export_duration))
+
+            checksum = file_checksum(self.filepath) if self.checksum and not self.in_memory else None
+            result = ExcelExportProcessResult(self.filepath, file_size, export_duration, len(self.records), data, file_size_bytes, spans,
+                                              checksum)
+            return result
+        except Exception as e:
+            logger.error('{0} encountered an error: {1}'.format(self.process_name, str(e)))
+            return ExcelExportProcessError(str(e), self)
+
+    def _human_readable_size(self, size, decimal_places):
+        """"Return a human readable file size."""
+        return human_readable_size(size, decimal_places)
+
+
+class ExcelDecoratorResult(object):
+    """Contains the results of a successful Excel decoration process.
+
+    Args:
+        filepath (str): File path of the decorated Excel file.
+        decoration_duration (datetime.timedelta): The duration needed to decorate the Excel file.
+        spans (list): The metrics.Span objects measured by the decoration process, defaults to None.
+    """
+    def __init__(self, filepath, decoration_duration, spans=None):
+        self.filepath = filepath
+        self.decoration_duration = decoration_duration
+        self.spans = spans or []
+
+
+class ExcelExporterResult(object):
+    """Contains the results of an Excel export.
+
+    The last file number is the highest number given to a file, also if that file was skipped because it already existed,
+    None if no file was numbered.
+    """
+    def __init__(self, excel_export_process_results, excel_export_process_errors, last_file_number=None):
+        self.excel_export_process_results = excel_export_process_results
+        self.excel_export_process_errors = excel_export_process_errors
+        self.last_file_number = last_file_number
+
+    def has_errros(self):
+        """Indicates whether the Excel export encountered errors."""
+        return len(self.excel_export_process_errors) > 0
+
+
+class ExcelDcorationManagerResult(object):
+    """Contains the results of an Excel export."""
+    def __init__(self, excel_decoration_process_results, excel_decoration_process_errors):
+        self.excel_decoration_process_results = excel_decoration_process_results
+        self.excel_decoration_process_errors = excel_decoration_process_errors
+
+    def has_errros(self):
+        """Indicates whether the Excel export encountered errors."""
+        return len(self.excel_decoration_process_errors) > 0
+
+
+class ChunkPrefetcherError(object):
+    """Wraps an exception raised while fetching chunks, to be re-raised by the consuming thread."""
+    def __init__(self, error):
+        self.error = error
+
+
+class ChunkPrefetcher(object):
+    """Fetches chunks of records in a background thread into a bounded queue.
+
+    The database keeps fetching the next chunks while the already fetched ones are being exported. The bounded
+    queue provides backpressure, so at most queue_size fetched chunks are waiting for a free Excel export process.
+
+    Args:
+        chunks (iterator): An iterator yielding the chunks of records, e.g. from QueryResult.chunks().
+        queue_size (int): The maximum count of fetched chunks waiting to be exported, defaults to 1.
+    """
+    _end_of_chunks = object()
+
+    def __init__(self, chunks, queue_size=1):
+        self.chunks = chunks
+        self.queue = Queue(maxsize=queue_size)
+        self.stopped = Event()
+        self.wait_duration = 0.0
+        self.thread = Thread(target=self._fetch, name='krano-chunk-prefetcher', daemon=True)
+
+    def _fetch(self):
+        try:
+            for chunk in self.chunks:
+                if not self._put(chunk):
+                    return
+        except Exception as e:
+            self._put(ChunkPrefetcherError(e))
+        else:
+            self._put(self._end_of_chunks)
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.5)
+                return True
+            except Full:
+                continue
+        return False
+
+    def __iter__(self):
+        self.thread.start()
+        try:
+            while True:
+                wait_start_time = time.monotonic()
+                item = self.queue.get()
+                self.wait_duration += time.monotonic() - wait_start_time
+
+                if item is self._end_of_chunks:
+                    return
+                if isinstance(item, ChunkPrefetcherError):
+                    raise item.error
+                yield item
+        finally:
+            self.stopped.set()
+
+
+class FileSizeEstimator(object):
+    """Chooses the count of rows per file, so that the created files stay below a maximum file size.
+
+    The bytes per row are first estimated by writing a sample of the records into memory with the writer of the
+    output format, which takes the column types, the compression and the decorations into account. The estimate is
+    refined with the actual sizes of the files as their export processes finish. If the record count is known, the
+    records are spread evenly over the files, so the export processes get chunks of similar size instead of several
+    full chunks and a small remainder.
+
+    Args:
+        max_file_size (int): The maximum size of a file in bytes.
+        query_result (QueryResult): The query result to be exported.
+        writer_class (class): The writer of the output format, see writers.get_writer().
+        sheet_name (str): The name of the worksheet to be created in the Excel file(s).
+        max_rows (int): The maximum count of rows per file, e.g. the chunk size.
+        decorations (list): ExcelDecoration objects written into every file, defaults to None.
+        sample_size (int): The count of records written to estimate the bytes per row, defaults to 1000.
+        normaliser (normalise.ColumnNormaliser): Converts the columns of the sample like the export processes do, defaults to None.
+    """
+    headroom = 0.95
+
+    def __init__(self, max_file_size, query_result, writer_class, sheet_name, max_rows, decorations=None, sample_size=1000, normaliser=None):
+        self.max_file_size = max_file_size
+        self.query_result = query_result
+        self.writer_class = writer_class
+        self.sheet_name = sheet_name
+        self.max_rows = max_rows
+        self.decorations = decorations
+        self.normaliser = normaliser
+        self.remaining_count = query_result.record_count
+        self.observed_rows = 0
+        self.observed_bytes = 0
+        self.observed_files = 0
+        self.lock = Lock()
+
+        sample = query_result.sample(sample_size)
+        if normaliser:
+            sample = normaliser.normalise(sample)
+        self.file_overhead = self._write_size([])
+        self.sample_bytes_per_row = max(1.0, (self._write_size(sample) - self.file_overhead) / max(len(sample), 1))
+        logger.info("Estimated {0:.1f} bytes per row from a sample of {1} rows, {2} rows per file to stay below {3}".format(self.sample_bytes_per_row,
+                                                                                                                          len(sample),
+                                                                                                                          self.rows_per_file(),
+                                                                                                                          human_readable_size(max_file_size, 2)))
+
+    def _write_size(self, records):
+        """Returns the size of a file containing the given records, written into memory."""
+        buffer = io.BytesIO()
+        column_type_codes = self.normaliser.converted_type_codes() if self.normaliser else self.query_result.column_type_codes
+        writer = self.writer_class(buffer, self.sheet_name, self.query_result.column_names, column_type_codes)
+        writer.write(records)
+        if self.decorations:
+            writer.write_decorations(self.decorations)
+        writer.close()
+        return len(buffer.getvalue())
+
+    @property
+    def bytes_per_row(self):
+        """The estimated bytes per row, based on the finished files once there are any."""
+        if self.observed_rows:
+            return max(1.0, (self.observed_bytes - self.observed_files * self.file_overhead) / self.observed_rows)
+        return self.sample_bytes_per_row
+
+    def rows_per_file(self):
+        """Returns the count of rows expected to fill a file up to the maximum file size, less some headroom."""
+        rows = int((self.max_file_size - self.file_overhead) * self.headroom / self.bytes_per_row)
+        return max(1, min(self.max_rows, rows))
+
+    def estimated_file_count(self):
+        """Returns the estimated count of files, None if the record count is not known yet."""
+        if self.query_result.record_count is None:
+            return None
+        return math.ceil(self.query_result.record_count / self.rows_per_file())
+
+    def next_chunk_size(self):
+        """Returns the count of rows of the next chunk, to be passed to QueryResult.chunks()."""
+        with self.lock:
+            rows = self.rows_per_file()
+            if self.remaining_count:
+                rows = math.ceil(self.remaining_count / math.ceil(self.remaining_count / rows))
+                self.remaining_count -= rows
+            return rows
+
+    def observe(self, row_count, file_size):
+        """Refines the estimate with the row count and the size in bytes of a finished file."""
+        with self.lock:
+            self.observed_rows += row_count
+            self.observed_bytes += file_size
+            self.observed_files += 1
+            logger.info("Refined the estimate to {0:.1f} bytes per row after {1} file(s), {2} rows per file".format(self.bytes_per_row,
+                                                                                                                self.observed_files,
+                                                                                                                self.rows_per_file()))
+
+
+class ExcelExporter(object):
+    """"Exports records fetched from a PostgreSQL database into one or several Excel documents.
+
+    Args:
+        filepath (str): File path of the Excel file to be created.
+        query_result (QueryResult): The query result to be exported to one or several Excel file(s).
+        chunk_size (int): The maximum count of rows exported to a single Excel file.
+        sheet_name (str): The name of the worksheet to be created in the Excel file(s).
+        overwrite (bool): Flag to indicate whether an already existing Excel file should be overwritten or not.
+        parallel_processes (int or str): The maximum count of parallel Excel export processes to be started, defaults to 2. 'auto' chooses
+            it from the available CPUs and memory and the estimated memory per chunk, and holds back new chunks while memory is short.
+        prefetch_chunks (int): The maximum count of chunks fetched ahead in a background thread while streaming
+            records from the database, defaults to 1. Set it to 0 to fetch and export strictly one after the other.
+        engine (str): The XLSX writer engine, either 'native' (constant memory) or 'pandas', defaults to 'native'.
+        decorations (list): ExcelDecoration objects written into every Excel file while it is created, defaults to None.
+        handoff (str): How the chunks are passed to the Excel export processes: 'pickle' sends the records through a pipe,
+            'shared_memory' encodes them once column by column into a shared memory segment and only sends its name, defaults to 'pickle'.
+        pool (workers.WorkerPool): A process pool to be used instead of starting one, e.g. shared by successive exports or by the
+            exports of a batch. It is neither closed nor joined, parallel_processes still limits the chunks in flight. Defaults to None.
+        output_format (str): The output format, one of writers.OUTPUT_FORMATS. Decorations are only written into XLSX files,
+            the chunk size is only limited for them. Defaults to 'xlsx'.
+        in_memory (bool): Create the files in memory instead of the export folder, their content is returned in the data
+            attribute of the results. Only meant for small exports, every file is held in memory as a whole. Defaults to False.
+        max_file_size (int): The maximum size of a file in bytes. If given, the rows per file are chosen by a FileSizeEstimator
+            and the chunk size only caps them. Defaults to None (chunk size rows per file).
+        metrics (metrics.RunMetrics): Receives the spans measured by the export processes and the shared memory hand-off, defaults to None.
+        retries (int): How often a failed Excel export process is dispatched again before its chunk counts as failed, defaults to 0.
+        manifest (manifest.ExportManifest): Records the chunks and their files, so a rerun reuses the valid files of an earlier run,
+            follows its chunk boundaries and creates the missing or corrupt files again, even if overwrite is False. Defaults to None.
+        first_file_number (int): Number all files, even a single one, starting with this number, e.g. to continue the files of an
+            earlier incremental export. Defaults to None (a single file is not numbered).
+        exact_decimal_columns (list): Names of NUMERIC columns written into XLSX files as text with all their digits instead of
+            as numbers, which Excel keeps with 15 significant digits only. Defaults to None.
+        file_callback (callable): Called with the ExcelExportProcessResult of every file as soon as it was written or reused, e.g. to
+            upload it while the other files are still being written. It is called from the thread handling the results of the
+            process pool and must return quickly. Defaults to None.
+        progress (preflight.ExportProgress): Receives the rows of every written or reused file and reports them against the estimate
+            of the planner, which also tells the count of files of a streamed result. Defaults to None.
+    """
+    def __init__(self, filepath, query_result, chunk_size, sheet_name, overwrite=False, parallel_processes=2, prefetch_chunks=1, engine='native',
+                 decorations=None, handoff=HANDOFF_PICKLE, pool=None, output_format=FORMAT_XLSX, in_memory=False, max_file_size=None, metrics=None,
+                 retries=0, manifest=None, first_file_number=None, exact_decimal_columns=None, file_callback=None, progress=None):
+        self.filepath = filepath
+        self.query_result = query_result
+        self.chunk_size = chunk_size
+        self.sheet_name = sheet_name
+        self.overwrite = overwrite
+        self.parallel_processes = parallel_processes
+        self.prefetch_chunks = prefetch_chunks
+        self.engine = engine
+        self.decorations = decorations
+        self.handoff = handoff
+        self.pool = pool
+        self.output_format = output_format
+        self.in_memory = in_memory
+        self.max_file_size = max_file_size
+        self.metrics = metrics
+        self.retries = retries
+        self.manifest = manifest
+        self.first_file_number = first_file_number
+        self.exact_decimal_columns = exact_decimal_columns
+        self.file_callback = file_callback
+        self.progress = progress
+        self.filepath_part, self.filepath_extension = split_output_extension(self.filepath)
+
+        if self.output_format == FORMAT_XLSX and self.chunk_size >= XLSX_MAX_ROWS:
+            raise ExcelExporterChunkSizeError("The chunk size must not exceed {0}, the maximum number of rows in an XLSX file less the "
+                                              "header row.".format(XLSX_MAX_ROWS - 1))
+
+        if self.handoff not in (HANDOFF_PICKLE, HANDOFF_SHARED_MEMORY):
+            raise ValueError("Unknown chunk hand-off '{0}', choose '{1}' or '{2}'.".format(self.handoff, HANDOFF_PICKLE, HANDOFF_SHARED_MEMORY))
+
+    def export(self):
+        """Exports the records chunk by chunk, keeping at most one chunk per parallel process in flight.
+
+        The records are consumed through QueryResult.chunks(), so a streaming query result never has to be
+        held in memory as a whole. While streaming, each chunk is dispatched to an Excel export process as soon
+        as it arrives from the database, and the next chunks are already fetched in the background.
+        """
+        if self.handoff == HANDOFF_SHARED_MEMORY:
+            prepare_shared_memory()
+
+        process_results = []
+        reused_results = []
+        failed_segments = {}
+        process_slot_wait_duration = 0.0
+        handoff_duration = 0.0
+        handoff_size = 0
+        prefetcher = None
+        estimator = None
+        admission = None
+        chunk_size = self.chunk_size
+        parallel_processes = self.parallel_processes
+        normaliser = ColumnNormaliser.for_output(self.output_format, self.query_result.column_names, self.query_result.column_type_codes,
+                                                 self.exact_decimal_columns)
+
+        if self.max_file_size:
+            estimator = FileSizeEstimator(self.max_file_size, self.query_result, get_writer(self.output_format, self.engine), self.sheet_name,
+                                          self.chunk_size, decorations=self.decorations, normaliser=normaliser)
+            chunk_size = estimator.next_chunk_size
+
+        if self.manifest:
+            self.manifest.start(self.query_result.record_count)
+            if self.manifest.chunk_sizes():
+                chunk_size = self._recorded_chunk_size(self.manifest.chunk_sizes(), chunk_size, estimator)
+
+        if parallel_processes == PARALLEL_AUTO:
+            rows_per_chunk = estimator.rows_per_file() if estimator else self.chunk_size
+            file_count = None
+            if self.query_result.record_count is not None:
+                rows_per_chunk = min(rows_per_chunk, self.query_result.record_count)
+                file_count = math.ceil(self.query_result.record_count / rows_per_chunk)
+            elif self.progress:
+                file_count = self.progress.estimated_file_count(rows_per_chunk)
+            process_memory = estimate_export_memory(self.query_result.sample(1000), rows_per_chunk, self.output_format, self.engine)
+            parallel_processes = auto_parallel_processes(process_memory, file_count)
+            admission = MemoryAdmission(process_memory + memory_reserve())
+
+        was_warm = self.pool is not None and getattr(self.pool, 'is_warm', lambda: False)()
+        own_pool_startup_duration = None
+        if self.pool:
+            pool = self.pool
+        else:
+            pool_start_time = time.monotonic()
+            pool = Pool(processes=parallel_processes)
+            own_pool_startup_duration = time.monotonic() - pool_start_time
+        process_slots = BoundedSemaphore(parallel_processes)
+
+        if self.query_result.record_count is None and self.progress:
+            total_file_count = 'about {0}'.format(self.progress.estimated_file_count(estimator.rows_per_file() if estimator else self.chunk_size))
+        elif self.query_result.record_count is None:
+            total_file_count = 'an unknown number of'
+        elif estimator:
+            total_file_count = 'about {0}'.format(estimator.estimated_file_count())
+        else:
+            total_file_count = self._calculate_total_file_count()
+
+        logger.info('+{0}+'.format(60 * '-'))
+        if self.pool:
+            logger.info('Excel exporter using the shared pool with up to {0} parallel processes for creating {1} {2} file(s)...'.format(parallel_processes,
+                                                                                                                                   total_file_count,
+                                                                                                                                   self.output_format.upper()))
+        else:
+            logger.info('Excel exporter initializing a pool with {0} parallel processes for creating {1} {2} file(s)...'.format(parallel_processes,
+                                                                                                                                total_file_count,
+                                                                                                                                self.output_format.upper()))
+
+        chunks = self.query_result.chunks(chunk_size)
+        if self.query_result.records is None and self.prefetch_chunks > 0:
+            prefetcher = ChunkPrefetcher(chunks, self.prefetch_chunks)
+            chunks = iter(prefetcher)
+
+        total_export_start_time = time.perf_counter()
+        file_count = 0
+        row_start = 0
+        for file_counter, single_file, chunk_records in self._numbered_chunks(chunks):
+            file_count = file_counter
+            row_start += len(chunk_records)
+            if single_file:
+                xlsx_filepath = "{0}{1}".format(self.filepath_part, self.filepath_extension)
+            else:
+                xlsx_filepath = "{0}_{1}{2}".format(self.filepath_part, file_counter, self.filepath_extension)
+
+            if self.manifest:
+                if self.manifest.is_chunk_valid(file_counter, xlsx_filepath, len(chunk_records)):
+                    logger.info("{0} file at {1} was already created by an earlier run, reusing it".format(self.output_format.upper(), xlsx_filepath))
+                    reused_results.append(self._reused_result(file_counter, estimator))
+                    if self.progress:
+                        self.progress.add(len(chunk_records))
+                    if self.file_callback:
+                        self.file_callback(reused_results[-1])
+                    continue
+            if not self.overwrite and not self.in_memory and os.path.isfile(xlsx_filepath) and not (self.manifest and self.manifest.owns(xlsx_filepath)):
+                # without a manifest only a truncated leftover of a crashed export is known to be no file of its own
+                if self.manifest or is_complete_file(xlsx_filepath, self.output_format):
+                    logger.info("Excel file at {0} already exists, will not overwrite it".format(xlsx_filepath))
+                    continue
+                logger.warning("{0} file at {1} is incomplete, probably left over by a crashed export, creating it again".format(
+                    self.output_format.upper(), xlsx_filepath))
+            if self.manifest:
+                self.manifest.plan_chunk(file_counter, row_start - len(chunk_records), len(chunk_records), xlsx_filepath)
+
+            segment = None
+            if self.handoff == HANDOFF_SHARED_MEMORY:
+                with measure(STAGE_HANDOFF, self.metrics, rows=len(chunk_records), chunk=file_counter) as handoff_span:
+                    chunk_records, segment = SharedColumnarChunk.create(chunk_records, self.query_result.column_type_codes)
+                    handoff_span.size = segment.size
+                handoff_duration += handoff_span.span.duration
+                handoff_size += segment.size
+
+            excel_export_process = ExcelExportProcess('Excel export process no. {0}'.format(file_counter), xlsx_filepath,
+                                                      chunk_records, self.query_result.column_names, self.sheet_name, False,
+                                                      column_type_codes=self.query_result.column_type_codes, engine=self.engine,
+                                                      decorations=self.decorations, output_format=self.output_format,
+                                                      in_memory=self.in_memory, file_number=file_counter,
+                                                      checksum=self.manifest is not None, normaliser=normaliser)
+            del chunk_records
+
+            wait_start_time = time.monotonic()
+            process_slots.acquire()
+            process_slot_wait_duration += time.monotonic() - wait_start_time
+            if admission:
+                admission.admit()
+            process_finished = self._process_finished_callback(process_slots, segment, estimator, admission, file_counter,
+                                                               failed_segments if self.retries else None)
+            process_result = pool.apply_async(excel_export_process.run, callback=process_finished, error_callback=process_finished)
+            process_results.append(process_result)
+
+        for process_result in process_results:
+            process_result.wait()
+        retried_count = self._retry_failed_processes(pool, process_slots, process_results, estimator, admission, failed_segments)
+        if not self.pool:
+            pool.close()
+            pool.join()
+
+        total_export_duration = elapsed(total_export_start_time)
+
+        logger.info('Excel exporter finished, gathering results...')
+
+        excel_export_process_results = list(reused_results)
+        excel_export_process_errors = []
+
+        for process_result in process_results:
+            if isinstance(process_result.get(), ExcelExportProcessError):
+                excel_export_process_error = process_result.get()
+                excel_export_process_errors.append(excel_export_process_error)
+            else:
+                excel_export_process_result = process_result.get()
+                excel_export_process_results.append(excel_export_process_result)
+                if self.metrics is not None:
+                    self.metrics.extend(excel_export_process_result.spans)
+
+        excel_export_result = ExcelExporterResult(excel_export_process_results, excel_export_process_errors, file_count or None)
+        if self.manifest and not excel_export_process_errors:
+            self.manifest.finish_export(file_count, self.query_result.query_duration)
+
+        pt = PrettyTable()
+        pt.field_names = ['Statistic label', 'Statistic content']
+        pt.add_row(['Excel export errors', len(excel_export_process_errors)])
+        pt.add_row(['Successsfully exported files', len(excel_export_process_results)])
+        if self.manifest:
+            pt.add_row(['Files reused from an earlier run', len(reused_results)])
+        if self.retries:
+            pt.add_row(['Retried export processes', retried_count])
+        pt.add_row(['Total export time', total_export_duration])
+        pool_startup = pool_startup_statistic(pool, own_pool_startup_duration, was_warm)
+        if pool_startup:
+            pt.add_row(['Worker pool startup time', pool_startup])
+        if prefetcher:
+            pt.add_row(['Time waited for the database', timedelta(seconds=round(prefetcher.wait_duration, 3))])
+        pt.add_row(['Time waited for export processes', timedelta(seconds=round(process_slot_wait_duration, 3))])
+        if admission:
+            pt.add_row(['Parallel processes', 'auto: {0}'.format(parallel_processes)])
+            pt.add_row(['Chunks held back for memory', admission.held_back])
+            pt.add_row(['Time waited for free memory', timedelta(seconds=round(admission.wait_duration, 3))])
+        if self.query_result.cache_status:
+            if self.query_result.cached_at:
+                pt.add_row(['Query result cache', '{0} (stored at {1})'.format(self.query_result.cache_status, self.query_result.cached_at)])
+            else:
+                pt.add_row(['Query result cache', self.query_result.cache_status])
+        if estimator:
+            pt.add_row(['Maximum file size', human_readable_size(self.max_file_size, 2)])
+            pt.add_row(['Estimated bytes per row', '{0:.1f}'.format(estimator.bytes_per_row)])
+            if excel_export_process_results:
+                pt.add_row(['Largest file', human_readable_size(max(result.file_size_bytes for result in excel_export_process_results), 2)])
+        if self.handoff == HANDOFF_SHARED_MEMORY:
+            pt.add_row(['Shared memory hand-off time', '{0:.3f}s'.format(handoff_duration)])
+            pt.add_row(['Shared memory hand-off volume', human_readable_size(handoff_size, 2)])
+        logger.info('{0}{1}'.format('Statistics:\n', pt))
+
+        return excel_export_result
+
+    def _process_finished_callback(self, process_slots, segment, estimator=None, admission=None, file_number=None, failed_segments=None):
+        """Returns a callback freeing the process slot and the shared memory segment of a finished Excel export process.
+
+        The size of the created file is passed on to the estimator, if the files are limited by size, the outcome is recorded
+        in the manifest and a created file is passed to the file callback. If failed_segments is given, the shared memory segment of a failed process is kept in it for a retry.
+        """
+        def process_finished(result):
+            succeeded = isinstance(result, ExcelExportProcessResult)
+            if estimator and succeeded:
+                estimator.observe(result.row_count, result.file_size_bytes)
+            if self.manifest:
+                if succeeded:
+                    self.manifest.chunk_written(file_number, result.file_size_bytes, result.checksum, decorated=bool(self.decorations))
+                else:
+                    self.manifest.chunk_failed(file_number, getattr(result, 'message', str(result)))
+            if segment:
+                if succeeded or failed_segments is None:
+                    segment.close()
+                    segment.unlink()
+                else:
+                    failed_segments[file_number] = segment
+            if admission:
+                admission.release()
+            process_slots.release()
+            if self.progress and succeeded:
+                self.progress.add(result.row_count)
+            if self.file_callback and succeeded:
+                try:
+                    self.file_callback(result)
+                except Exception as e:
+                    # an exception would stop the thread handling the results of the process pool
+                    logger.error('The file callback failed for {0}: {1}'.format(result.filepath, str(e)))
+        return process_finished
+
+    def _retry_failed_processes(self, pool, process_slots, process_results, estimator, admission, failed_segments):
+        """Dispatches the failed Excel export processes again, up to retries times, replacing their process results.
+
+        Returns:
+            The count of retried Excel export processes.
+        """
+        retried_count = 0
+        for attempt in range(1, self.retries + 1):
+            failed_indexes = [index for index, process_result in enumerate(process_results)
+                              if isinstance(process_result.get(), ExcelExportProcessError)]
+            if not failed_indexes:
+                break
+
+            for index in failed_indexes:
+                excel_export_process = process_results[index].get().excel_export_process
+                logger.warning('Retrying {0} for {1} (attempt {2} of {3})'.format(excel_export_process.process_name, excel_export_process.filepath,
+                                                                                 attempt, self.retries))
+                process_slots.acquire()
+                if admission:
+                    admission.admit()
+                segment = failed_segments.pop(excel_export_process.file_number, None)
+                process_finished = self._process_finished_callback(process_slots, segment, estimator, admission, excel_export_process.file_number,
+                                                                   failed_segments if attempt < self.retries else None)
+                process_results[index] = pool.apply_async(excel_export_process.run, callback=process_finished, error_callback=process_finished)
+                retried_count += 1
+
+            for index in failed_indexes:
+                process_results[index].wait()
+        return retried_count
+
+    def _recorded_chunk_size(self, recorded_sizes, chunk_size, estimator=None):
+        """Returns a chunk size callable repeating the chunk boundaries of an earlier run, then falling back to the given chunk size."""
+        recorded_sizes = iter(recorded_sizes)
+
+        def next_chunk_size():
+            row_count = next(recorded_sizes, None)
+            if row_count is None:
+                return chunk_size() if callable(chunk_size) else chunk_size
+            if estimator and estimator.remaining_count:
+                estimator.remaining_count = max(0, estimator.remaining_count - row_count)
+            return row_count
+        return next_chunk_size
+
+    def _reused_result(self, file_number, estimator=None):
+        """Returns the result of a chunk whose file was created by an earlier run, as recorded in the manifest."""
+        chunk = self.manifest.chunk(file_number)
+        if estimator:
+            estimator.observe(chunk['row_count'], chunk['size'])
+        return ExcelExportProcessResult(chunk['filepath'], human_readable_size(chunk['size'], 2), timedelta(0), chunk['row_count'],
+                                        file_size_bytes=chunk['size'], checksum=chunk['checksum'], reused=True)
+
+    def _numbered_chunks(self, chunks):
+        """Yields the file number, a single file flag and the records for each chunk.
+
+        Looks one chunk ahead to find out whether all records fit into a single Excel file. If a first file number is given,
+        the files are numbered from it and a single file is numbered as well.
+        """
+        first_file_number = self.first_file_number or 1
+        first_chunk = next(chunks, None)
+        if first_chunk is None:
+            return
+
+        second_chunk = next(chunks, None)
+        if second_chunk is None:
+            yield first_file_number, self.first_file_number is None, first_chunk
+            return
+
+        yield first_file_number, False, first_chunk
+        del first_chunk
+
+        file_counter = first_file_number + 1
+        chunk_records = second_chunk
+        del second_chunk
+        while chunk_records is not None:
+            yield file_counter, False, chunk_records
+            chunk_records = next(chunks, None)
+            file_counter += 1
+
+    def _calculate_total_file_count(self):
+        """Calculates the total count of Excel files to be created."""
+        mod = self.query_result.record_count % self.chunk_size
+        if mod > 0:
+            total_file_count = int(self.query_result.record_count / self.chunk_size) + 1
+        else:
+            total_file_count = int(self.query_result.record_count / self.chunk_size)
+        return total_file_count
+
+
+class SheetPartResult(object):
+    """Contains the results of a successful sheet part process.
+
+    Args:
+        part_number (int): The number of the part, counted from 1 in the order of the rows.
+        part (xlsxparts.SheetPart): The compressed rows of the part.
+        spans (list): The metrics.Span objects measured by the sheet part process, defaults to None.
+    """
+    def __init__(self, part_number, part, spans=None):
+        self.part_number = part_number
+        self.part = part
+        self.spans = spans or []
+
+
+class SheetPartProcess(object):
+    """Writes a range of rows of the worksheet of a single Excel file, see SingleFileExcelExporter.
+
+    Args:
+        process_name (str): Name of the process (e.g. 'Sheet part process no. 1').
+        filepath (str): File path of the Excel file the rows belong to.
+        records (list): The records of the range.
+        first_row_number (int): The row number of the first record in the worksheet, counted from 1 including the header row.
+        column_type_codes (list): The PostgreSQL type OIDs of the columns.
+        styles (dict): The cell format indexes of the date, datetime and time columns, see xlsxparts.StitchedXlsxWriter.
+        part_number (int): The number of the part, recorded as chunk in the metrics spans.
+        normaliser (normalise.ColumnNormaliser): Converts the columns of the records before they are written, defaults to None.
+    """
+    def __init__(self, process_name, filepath, records, first_row_number, column_type_codes, styles, part_number, normaliser=None):
+        self.process_name = process_name
+        self.filepath = filepath
+        self.records = records
+        self.first_row_number = first_row_number
+        self.column_type_codes = column_type_codes
+        self.styles = styles
+        self.part_number = part_number
+        self.normaliser = normaliser
+
+    def run(self):
+        try:
+            spans = []
+            records = self.records
+            column_type_codes = self.column_type_codes
+            if self.normaliser:
+                with measure(STAGE_NORMALISE, rows=len(records), chunk=self.part_number) as normalise_span:
+                    records = self.normaliser.normalise(records)
+                    column_type_codes = self.normaliser.converted_type_codes()
+                spans.append(normalise_span.span)
+
+            with measure(STAGE_WRITE, rows=len(records), chunk=self.part_number) as write_span:
+                part = SheetPartWriter(column_type_codes, self.styles).write(records, self.first_row_number)
+                write_span.size = len(part.data)
+            spans.append(write_span.span)
+
+            logger.info("{0} wrote the rows {1} to {2} of XLSX file {3} ({4} compressed) in {5}".format(self.process_name,
+                                                                                                   self.first_row_number,
+                                                                                                   self.first_row_number + part.row_count - 1,
+                                                                                                   self.filepath,
+                                                                                                   human_readable_size(len(part.data), 2),
+                                                                                                   timedelta(seconds=round(write_span.span.duration, 3))))
+            return SheetPartResult(self.part_number, part, spans)
+        except Exception as e:
+            logger.error('{0} encountered an error: {1}'.format(self.process_name, str(e)))
+            return ExcelExportProcessError(str(e), self)
+
+
+class SingleFileExcelExporter(object):
+    """Exports records fetched from a PostgreSQL database into a single XLSX file, writing its worksheet on several cores.
+
+    The records are split into parts of part_size rows. Worker processes write the worksheet XML of the parts and compress
+    it, while the main process stitches the compressed parts in row order together with the header row, the styles and
+    the decorations into the zip container of the XLSX file (see xlsxparts.StitchedXlsxWriter). At most parallel_processes
+    parts are in flight, so only a few parts are held in memory at once, also while streaming the records. The file is
+    limited to 1048575 records, the maximum number of rows of an XLSX file less the header row.
+
+    Args:
+        filepath (str): File path of the Excel file to be created.
+        query_result (QueryResult): The query result to be exported.
+        sheet_name (str): The name of the worksheet to be created in the Excel file.
+        overwrite (bool): Flag to indicate whether an already existing Excel file should be overwritten or not.
+        parallel_processes (int or str): The maximum count of parallel sheet part processes, defaults to 2. 'auto' chooses it from
+            the available CPUs and memory and the estimated memory per part.
+        part_size (int): The count of rows written by one sheet part process, defaults to 50000.
+        prefetch_chunks (int): The maximum count of parts fetched ahead in a background thread while streaming records from
+            the database, defaults to 1.
+        decorations (list): ExcelDecoration objects written into the Excel file while it is created, defaults to None.
+        handoff (str): How the parts are passed to the sheet part processes, either 'pickle' or 'shared_memory', defaults to 'pickle'.
+        pool (workers.WorkerPool): A process pool to be used instead of starting one, defaults to None.
+        in_memory (bool): Create the file in memory, its content is returned in the data attribute of the result. Defaults to False.
+        metrics (metrics.RunMetrics): Receives the spans measured by the sheet part processes, defaults to None.
+        retries (int): How often a failed sheet part process is started again before the export fails, defaults to 0.
+        manifest (manifest.ExportManifest): Records the file as single chunk, so a rerun reuses it if it is still valid. Defaults to None.
+        first_file_number (int): Number the file with this number, e.g. to continue the files of an earlier incremental export.
+            Defaults to None (the file is not numbered).
+        exact_decimal_columns (list): Names of NUMERIC columns written as text with all their digits, defaults to None.
+        file_callback (callable): Called with the ExcelExportProcessResult of the file once it was written or reused, see ExcelExporter.
+            Defaults to None.
+        progress (preflight.ExportProgress): Receives the rows of every appended worksheet part, see ExcelExporter. Defaults to None.
+    """
+    def __init__(self, filepath, query_result, sheet_name, overwrite=False, parallel_processes=2, part_size=50000, prefetch_chunks=1,
+                 decorations=None, handoff=HANDOFF_PICKLE, pool=None, in_memory=False, metrics=None, retries=0, manifest=None,
+                 first_file_number=None, exact_decimal_columns=None, file_callback=None, progress=None):
+        self.filepath = filepath
+        self.query_result = query_result
+        self.sheet_name = sheet_name
+        self.overwrite = overwrite
+        self.parallel_processes = parallel_processes
+        self.part_size = part_size
+        self.prefetch_chunks = prefetch_chunks
+        self.decorations = decorations
+        self.handoff = handoff
+        self.pool = pool
+        self.in_memory = in_memory
+        self.metrics = metrics
+        self.retries = retries
+        self.manifest = manifest
+        self.first_file_number = first_file_number
+        self.exact_decimal_columns = exact_decimal_columns
+        self.file_callback = file_callback
+        self.progress = progress
+        self.filepath_part, self.filepath_extension = split_output_extension(self.filepath)
+
+        record_count = self.query_result.record_count
+        if record_count is not None and record_count >= XLSX_MAX_ROWS:
+            raise ExcelExporterChunkSizeError("{0} records do not fit into a single XLSX file, its maximum number of rows is 1048576 "
+                                              "including the header row.".format(record_count))
+
+        if self.handoff not in (HANDOFF_PICKLE, HANDOFF_SHARED_MEMORY):
+            raise ValueError("Unknown chunk hand-off '{0}', choose '{1}' or '{2}'.".format(self.handoff, HANDOFF_PICKLE, HANDOFF_SHARED_MEMORY))
+
+    def export(self):
+        """Exports all records into the single Excel file, keeping at most one part per parallel process in flight.
+
+        Returns:
+            An ExcelExporterResult with the result of the file, or the error of the sheet part process that failed. It has
+            no results if the file already exists and is not to be overwritten.
+        """
+        file_number = self.first_file_number or 1
+        if self.first_file_number is None:
+            xlsx_filepath = "{0}{1}".format(self.filepath_part, self.filepath_extension)
+        else:
+            xlsx_filepath = "{0}_{1}{2}".format(self.filepath_part, file_number, self.filepath_extension)
+        record_count = self.query_result.record_count
+
+        if self.manifest:
+            self.manifest.start(record_count)
+            if record_count is not None and self.manifest.is_chunk_valid(file_number, xlsx_filepath, record_count):
+                logger.info("XLSX file at {0} was already created by an earlier run, reusing it".format(xlsx_filepath))
+                chunk = self.manifest.chunk(file_number)
+                self.manifest.finish_export(file_number, self.query_result.query_duration)
+                result = ExcelExportProcessResult(xlsx_filepath, human_readable_size(chunk['size'], 2), timedelta(0), record_count,
+                                                  file_size_bytes=chunk['size'], checksum=chunk['checksum'], reused=True)
+                if self.progress:
+                    self.progress.add(record_count)
+                if self.file_callback:
+                    self.file_callback(result)
+                return ExcelExporterResult([result], [], file_number)
+        if not self.overwrite and not self.in_memory and os.path.isfile(xlsx_filepath) and not (self.manifest and self.manifest.owns(xlsx_filepath)):
+            if self.manifest or is_complete_file(xlsx_filepath, FORMAT_XLSX):
+                logger.info("Excel file at {0} already exists, will not overwrite it".format(xlsx_filepath))
+                return ExcelExporterResult([], [], file_number)
+            logger.warning("XLSX file at {0} is incomplete, probably left over by a crashed export, creating it again".format(xlsx_filepath))
+        if self.manifest:
+            self.manifest.plan_chunk(file_number, 0, record_count, xlsx_filepath)
+
+        if self.handoff == HANDOFF_SHARED_MEMORY:
+            prepare_shared_memory()
+
+        normaliser = ColumnNormaliser.for_output(FORMAT_XLSX, self.query_result.column_names, self.query_result.column_type_codes,
+                                                 self.exact_decimal_columns)
+        part_count = None if record_count is None else max(1, math.ceil(record_count / self.part_size))
+        if part_count is not None:
+            part_count_label = part_count
+        elif self.progress:
+            part_count = self.progress.estimated_file_count(self.part_size)
+            part_count_label = 'about {0}'.format(part_count)
+        else:
+            part_count_label = 'an unknown number of'
+        parallel_processes = self.parallel_processes
+        if parallel_processes == PARALLEL_AUTO:
+            process_memory = estimate_export_memory(self.query_result.sample(1000), self.part_size, FORMAT_XLSX, 'native')
+            parallel_processes = auto_parallel_processes(process_memory, part_count)
+
+        was_warm = self.pool is not None and getattr(self.pool, 'is_warm', lambda: False)()
+        own_pool_startup_duration = None
+        if self.pool:
+            pool = self.pool
+        else:
+            pool_start_time = time.monotonic()
+            pool = Pool(processes=parallel_processes)
+            own_pool_startup_duration = time.monotonic() - pool_start_time
+
+        logger.info('+{0}+'.format(60 * '-'))
+        logger.info('Single file Excel exporter writing {0} part(s) of the worksheet with up to {1} parallel processes into XLSX file {2}...'.format(
+            part_count_label, parallel_processes, xlsx_filepath))
+
+        chunks = self.query_result.chunks(self.part_size)
+        prefetcher = None
+        if self.query_result.records is None and self.prefetch_chunks > 0:
+            prefetcher = ChunkPrefetcher(chunks, self.prefetch_chunks)
+            chunks = iter(prefetcher)
+
+        total_export_start_time = time.perf_counter()
+        target = io.BytesIO() if self.in_memory else xlsx_filepath
+        writer = None
+        in_flight = deque()
+        spans = []
+        error = None
+        row_count = 0
+        written_part_count = 0
+        retried_count = 0
+        part_wait_duration = 0.0
+        handoff_duration = 0.0
+        try:
+            writer = StitchedXlsxWriter(target, self.sheet_name, self.query_result.column_names, self.query_result.column_type_codes,
+                                        decorations=self.decorations, row_count=record_count)
+            for part_number, part_records in enumerate(chunks, start=1):
+                if row_count + len(part_records) >= XLSX_MAX_ROWS:
+                    raise ExcelExporterChunkSizeError("The records do not fit into a single XLSX file, its maximum number of rows is 1048576 "
+                                                      "including the header row.")
+                segment = None
+                if self.handoff == HANDOFF_SHARED_MEMORY:
+                    with measure(STAGE_HANDOFF, self.metrics, rows=len(part_records), chunk=part_number) as handoff_span:
+                        part_records, segment = SharedColumnarChunk.create(part_records, self.query_result.column_type_codes)
+                        handoff_span.size = segment.size
+                    handoff_duration += handoff_span.span.duration
+
+                sheet_part_process = SheetPartProcess('Sheet part process no. {0}'.format(part_number), xlsx_filepath, part_records, row_count + 2,
+                                                      self.query_result.column_type_codes, writer.styles, part_number, normaliser)
+                row_count += len(part_records)
+                del part_records
+                in_flight.append((sheet_part_process, segment, pool.apply_async(sheet_part_process.run)))
+
+                if len(in_flight) >= parallel_processes:
+                    wait_start_time = time.monotonic()
+                    error, retries = self._add_part(writer, pool, spans, *in_flight.popleft())
+                    part_wait_duration += time.monotonic() - wait_start_time
+                    retried_count += retries
+                    if error:
+                        break
+                    written_part_count += 1
+
+            while in_flight and not error:
+                wait_start_time = time.monotonic()
+                error, retries = self._add_part(writer, pool, spans, *in_flight.popleft())
+                part_wait_duration += time.monotonic() - wait_start_time
+                retried_count += retries
+                if not error:
+                    written_part_count += 1
+
+            if not error:
+                writer.close()
+        except BaseException:
+            self._abort(writer, xlsx_filepath, in_flight)
+            raise
+        finally:
+            if not self.pool:
+                pool.close()
+                pool.join()
+
+        if error:
+            self._abort(writer, xlsx_filepath, in_flight)
+            if self.manifest:
+                self.manifest.chunk_failed(file_number, error.message)
+            return ExcelExporterResult([], [error])
+
+        total_export_duration = elapsed(total_export_start_time)
+        data = target.getvalue() if self.in_memory else None
+        file_size_bytes = len(data) if self.in_memory else os.path.getsize(xlsx_filepath)
+        checksum = file_checksum(xlsx_filepath) if self.manifest else None
+        if self.metrics is not None:
+            self.metrics.extend(spans)
+        if self.manifest:
+            if record_count is None:
+                self.manifest.plan_chunk(file_number, 0, row_count, xlsx_filepath)
+            self.manifest.chunk_written(file_number, file_size_bytes, checksum, decorated=bool(self.decorations))
+            self.manifest.finish_export(file_number, self.query_result.query_duration)
+
+        logger.info("Single file Excel exporter wrote {0} rows in {1} part(s) to XLSX file {2}{3} ({4}) in {5}".format(row_count,
+                                                                                                                   written_part_count,
+                                                                                                                   xlsx_filepath,
+                                                                                                                   ' in memory' if self.in_memory else '',
+                                                                                                                   human_readable_size(file_size_bytes, 2),
+                                                                                                                   total_export_duration))
+
+        pt = PrettyTable()
+        pt.field_names = ['Statistic label', 'Statistic content']
+        pt.add_row(['Exported rows', row_count])
+        pt.add_row(['Worksheet parts', written_part_count])
+        if self.retries:
+            pt.add_row(['Retried sheet part processes', retried_count])
+        pt.add_row(['Total export time', total_export_duration])
+        pool_startup = pool_startup_statistic(pool, own_pool_startup_duration, was_warm)
+        if pool_startup:
+            pt.add_row(['Worker pool startup time', pool_startup])
+        if prefetcher:
+            pt.add_row(['Time waited for the database', timedelta(seconds=round(prefetcher.wait_duration, 3))])
+        pt.add_row(['Time waited for sheet part processes', timedelta(seconds=round(part_wait_duration, 3))])
+        if self.parallel_processes == PARALLEL_AUTO:
+            pt.add_row(['Parallel processes', 'auto: {0}'.format(parallel_processes)])
+        if self.query_result.cache_status:
+            pt.add_row(['Query result cache', self.query_result.cache_status])
+        if self.handoff == HANDOFF_SHARED_MEMORY:
+            pt.add_row(['Shared memory hand-off time', '{0:.3f}s'.format(handoff_duration)])
+        pt.add_row(['File size', human_readable_size(file_size_bytes, 2)])
+        logger.info('{0}{1}'.format('Statistics:\n', pt))
+
+        result = ExcelExportProcessResult(xlsx_filepath, human_readable_size(file_size_bytes, 2), total_export_duration, row_count, data,
+                                          file_size_bytes, spans, checksum)
+        if self.file_callback:
+            self.file_callback(result)
+        return ExcelExporterResult([result], [], file_number)
+
+    def _add_part(self, writer, pool, spans, sheet_part_process, segment, process_result):
+        """Waits for a sheet part process and appends its part to the worksheet, starting it again up to retries times if it failed.
+
+        Returns:
+            The ExcelExportProcessError of the sheet part process if it failed every time, otherwise None, and the count of retries.
+        """
+        attempt = 0
+        try:
+            result = process_result.get()
+            while isinstance(result, ExcelExportProcessError) and attempt < self.retries:
+                attempt += 1
+                logger.warning('Retrying {0} for {1} (attempt {2} of {3})'.format(sheet_part_process.process_name, sheet_part_process.filepath,
+                                                                                 attempt, self.retries))
+                result = pool.apply_async(sheet_part_process.run).get()
+        finally:
+            if segment:
+                segment.close()
+                segment.unlink()
+
+        if isinstance(result, ExcelExportProcessError):
+            return result, attempt
+        writer.add_part(result.part)
+        spans.extend(result.spans)
+        if self.progress:
+            self.progress.add(result.part.row_count)
+        return None, attempt
+
+    def _abort(self, writer, filepath, in_flight):
+        """Waits for the sheet part processes still in flight, frees their shared memory and deletes the unfinished file."""
+        while in_flight:
+            _, segment, process_result = in_flight.popleft()
+            process_result.wait()
+            if segment:
+                segment.close()
+                segment.unlink()
+        if writer:
+            writer.abort()
+        if not self.in_memory and os.path.isfile(filepath):
+            os.remove(filepath)
+
+
+class ExcelDecorationElement(object):
+    """Stores the label and content for a single Excel decoration element.
+
+    Args:
+        label (str): The label of the decoration element, e.g. 'Created by'.
+        content (str): The content of the decoration element, e.g. 'Darth Vader'.
+    """
+    def __init__(self, label, content):
+        self.label = label
+        self.content = content
+
+    def get_content(self):
+        """Returns the content with placeholders like 'CURRENT_DATETIME' replaced."""
+        if self.content == 'CURRENT_DATETIME':
+            return datetime.now()
+        else:
+            return self.content
+
+
+class ExcelDecoration(object):
+    """Stores all elements for an Excel decoration.
+
+    Args:
+        sheet_name (str): The name of the worksheet to be created.
+        title (str): The title of the decoration, e.g. 'Details' or 'Info'.
+    """
+    def __init__(self, sheet_name, title):
+        self.sheet_name = sheet_name
+        self.title = title
+        self.elements = []
+
+    def add_element(self, element):
+        """Adds an excel decoration element."""
+        self.elements.append(element)
+
+
+class ExcelDecorator(object):
+    """Decorates a given, already existing Excel file with one or more decorations.
+
+    Loading and saving the whole workbook with openpyxl is slow and memory hungry for big files. Prefer passing
+    the decorations to the ExcelExporter, which writes them while the Excel file is created.
+
+    Args:
+        process_name (str): Name of the excel decoration process, e.g. 'Excel decoration process no. 1'.
+        filepath (str): File path of the Excel file to be decorated.
+        decorations (list): The decorations to be applied to the Excel file.
+        file_number (int): The number of the file, recorded as chunk in the metrics span, defaults to None.
+    """
+    def __init__(self, process_name, filepath, decorations, file_number=None):
+        self.process_name = process_name
+        self.filepath = filepath
+        self.decorations = decorations
+        self.file_number = file_number
+
+    def add_decoration(self, decoration):
+        self.decorations.append(decoration)
+
+    def decorate(self):
+        from openpyxl import load_workbook
+        from openpyxl.styles import Font, Alignment
+
+        try:
+            title_font = Font(name='Calibri',
+                              size=22,
+                              bold=False,
+                              italic=False,
+                              vertAlign=None,
+                              underline='none',
+                              strike=False,
+                              color='FF000000')
+
+            key_font = Font(name='Calibri',
+                            size=11,
+                            bold=True,
+                            italic=False,
+                            vertAlign=None,
+                            underline='none',
+                            strike=False,
+                            color='FF000000')
+
+            value_font = Font(name='Calibri',
+                              size=11,
+                              bold=False,
+                              italic=False,
+                              vertAlign=None,
+                              underline='none',
+                              strike=False,
+                              color='FF000000')
+
+            with measure(STAGE_DECORATE, chunk=self.file_number) as decoration_span:
+                logger.info("{0} writing additional informations to Excel file at {1}...".format(self.process_name, self.filepath))
+                wb = load_workbook(filename=self.filepath)
+
+                for decoration in self.decorations:
+                    logger.info("{0} adding work sheet named '{1}' with title '{2}'".format(self.process_name, decoration.sheet_name, decoration.title))
+                    ws = wb.create_sheet(title=decoration.sheet_name)
+                    ws['B3'] = decoration.title
+                    ws['B3'].font = title_font
+
+                    cell_index = 6
+                    for element in decoration.elements:
+                        key_cell = "B{0}".format(cell_index)
+                        value_cell = "C{0}".format(cell_index)
+
+                        ws[key_cell] = element.label
+                        ws[key_cell].font = key_font
+                        ws[key_cell].alignment = Alignment(horizontal='right')
+                        ws[value_cell] = element.get_content()
+                        ws[value_cell].font = value_font
+                        ws[value_cell].alignment = Alignment(horizontal='left')
+
+                        cell_index += 1
+
+                logger.info("{0} saving Excel file at {1}...".format(self.process_name, self.filepath))
+                wb.save(self.filepath)
+                decoration_span.size = os.path.getsize(self.filepath)
+
+            decoration_duration = timedelta(seconds=round(decoration_span.span.duration, 3))
+            logger.info("{0} successfully decorated Excel file at {1} in {2}".format(self.process_name, self.filepath, decoration_duration))
+
+            return ExcelDecoratorResult(self.filepath, decoration_duration, [decoration_span.span])
+        except Exception as e:
+            logger.error('{0} encountered an error: {1}'.format(self.process_name, str(e)))
+            return ExcelDecoratorError(str(e), self)
+
+
+class ExcelDecorationManager(object):
+    """Applies the given decorations to the given Excel files.
+
+    Args:
+        filepaths (list): A list of Excel file paths to be decorated.
+        decorations (list): A list of Excel decorations to be applied to each Excel file.
+        parallel_processes (int or str): The maximum count of parallel Excel decoration processes to be started, defaults to 2. 'auto'
+            chooses it from the available CPUs and memory and the size of the largest file, and holds back new files while memory is short.
+        pool (workers.WorkerPool): A process pool to be used instead of starting one, e.g. the one of the Excel export, defaults to None.
+        metrics (metrics.RunMetrics): Receives the spans measured by the decoration processes, defaults to None.
+    """
+    def __init__(self, filepaths, decorations, parallel_processes=2, pool=None, metrics=None):
+        self.filepaths = filepaths
+        self.decorations = decorations
+        self.parallel_processes = parallel_processes
+        self.pool = pool
+        self.metrics = metrics
+
+    def decorate(self):
+        parallel_processes = self.parallel_processes
+        process_slots = None
+        admission = None
+        if parallel_processes == PARALLEL_AUTO:
+            process_memory = estimate_decoration_memory(self.filepaths)
+            parallel_processes = auto_parallel_processes(process_memory, len(self.filepaths))
+            process_slots = BoundedSemaphore(parallel_processes)
+            admission = MemoryAdmission(process_memory + memory_reserve())
+
+        logger.info('+{0}+'.format(60 * '-'))
+        logger.info('Excel decoration manager initializing a pool with {0} parallel processes for decorating {1} XLSX file(s)...'.format(parallel_processes,
+                                                                                                                             len(self.filepaths)))
+
+        was_warm = self.pool is not None and getattr(self.pool, 'is_warm', lambda: False)()
+        own_pool_startup_duration = None
+        if self.pool:
+            pool = self.pool
+        else:
+            pool_start_time = time.monotonic()
+            pool = Pool(processes=parallel_processes)
+            own_pool_startup_duration = time.monotonic() - pool_start_time
+        process_results = []
+
+        total_decoration_start_time = time.perf_counter()
+        file_counter = 0
+        for filepath in self.filepaths:
+            file_counter += 1
+            process_name = 'Excel decoration process {0}'.format(file_counter)
+            excel_decorator = ExcelDecorator(process_name, filepath, self.decorations, file_counter)
+            if admission:
+                process_slots.acquire()
+                admission.admit()
+                process_finished = self._process_finished_callback(process_slots, admission)
+                process_result = pool.apply_async(excel_decorator.decorate, callback=process_finished, error_callback=process_finished)
+            else:
+                process_result = pool.apply_async(excel_decorator.decorate)
+            process_results.append(process_result)
+
+        if self.pool:
+            for process_result in process_results:
+                process_result.wait()
+        else:
+            pool.close()
+            pool.join()
+
+        total_decoration_duration = elapsed(total_decoration_start_time)
+
+        logger.info('Excel decoration finished, gathering results...')
+
+        excel_decoration_process_results = []
+        excel_decoration_process_errors = []
+
+        for process_result in process_results:
+            if isinstance(process_result.get(), ExcelDecoratorError):
+                excel_decoration_process_error = process_result.get()
+                excel_decoration_process_errors.append(excel_decoration_process_error)
+            else:
+                excel_decoration_process_result = process_result.get()
+                excel_decoration_process_results.append(excel_decoration_process_result)
+                if self.metrics is not None:
+                    self.metrics.extend(excel_decoration_process_result.spans)
+
+        pt = PrettyTable()
+        pt.field_names = ['Statistic label', 'Statistic content']
+        pt.add_row(['Excel decoration errors', len(excel_decoration_process_errors)])
+        pt.add_row(['Successsfully decorated files', len(excel_decoration_process_results)])
+        pt.add_row(['Total decoration time', total_decoration_duration])
+        pool_startup = pool_startup_statistic(pool, own_pool_startup_duration, was_warm)
+        if pool_startup:
+            pt.add_row(['Worker pool startup time', pool_startup])
+        if admission:
+            pt.add_row(['Parallel processes', 'auto: {0}'.format(parallel_processes)])
+            pt.add_row(['Files held back for memory', admission.held_back])
+            pt.add_row(['Time waited for free memory', timedelta(seconds=round(admission.wait_duration, 3))])
+        logger.info('{0}{1}'.format('Statistics:\n', pt))
+
+        return ExcelDcorationManagerResult(excel_decoration_process_results, excel_decoration_process_errors)
+
+    def _process_finished_callback(self, process_slots, admission):
+        """Returns a callback freeing the process slot of a finished Excel decoration process."""
+        def process_finished(_):
+            admission.release()
+            process_slots.release()
+        return process_finished
+
+
+class SQLFileWriter(object):
+    """Write an SQL query to a text file.
+
+    Args:
+        filepath (str): File path of the SQL file to be created.
+        query (str): SQL query to be written to the file.
+    """
+    def __init__(self, filepath, sql_statement):
+        self.filepath = filepath
+        self.sql_statement = sql_statement
+
+    def write(self):
+        """Write SQL query to a file."""
+        with open(self.filepath, mode='w', encoding='utf-8') as a_file:
             a_file.write(self.sql_statement)
\ No newline at end of file
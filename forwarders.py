@@ -1,83 +1,433 @@
-#/usr/bin/python
-# -*- coding: utf-8 -*-
-
-import logging
-logging.basicConfig(level=logging.INFO,
-                    format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
-logger = logging.getLogger(__name__)
-import requests
-import json
-
-
-class JIRAForwarder(object):
-    """Uploads files as attachments to a JIRA issue.
-
-    Args:
-        base_url (str): JIRA base URL, e.g. 'jira.domain.com'.
-        login (str): Name of the JIRA user.
-        password (str): Password of the JIRA user.
-    """
-    def __init__(self, base_url, login, password):
-        self.base_url = base_url
-        self.login = login
-        self.password = password
-
-    def upload(self, issue, filepaths):
-        """Uploads files as attachments to a specific JIRA issue.
-
-        Args:
-            issue (str): Code of the JIRA issue, e.g. 'ITD-122'
-            filepaths (list): A list of filepaths to upload as attachments to the JIRA issue.
-        """
-        url = 'https://{0}/rest/api/2/issue/{1}/attachments'.format(self.base_url, issue)
-        headers = {"X-Atlassian-Token": "nocheck"}
-
-        logger.info('+{0}+'.format(60 * '-'))
-
-        for filepath in filepaths:
-            logger.info("Uploading file at {0} to {1}...".format(filepath, url))
-            try:
-                openfile = open(filepath, 'rb')
-                files = {'file': openfile}
-                r = requests.post(url, auth=(self.login, self.password), files=files, headers=headers)
-                logger.info("HTTP status code: {0}".format(r.status_code))
-                r.raise_for_status()
-            except Exception as e:
-                logger.warning("Upload failed: {0}".format(str(e)))
-            finally:
-                openfile.close()
-
-
-class JIRACommenter(object):
-    """Adds comments to a JIRA issue.
-
-    Args:
-        base_url (str): JIRA base URL, e.g. 'jira.domain.com'.
-        login (str): Name of the JIRA user.
-        password (str): Password of the JIRA user.
-    """
-    def __init__(self, base_url, login, password):
-        self.base_url = base_url
-        self.login = login
-        self.password = password
-
-    def comment(self, issue, comment):
-        """Adds a comment to a specific JIRA issue.
-
-        Args:
-            issue (str): Code of the JIRA issue, e.g. 'ITD-122'
-            comment (str): A comment to be added to the JIRA issue.
-        """
-        url = 'https://{0}/rest/api/2/issue/{1}/comment'.format(self.base_url, issue)
-        headers = {'Content-Type':'application/json'}
-        data = json.dumps({'body': comment})
-
-        logger.info('+{0}+'.format(60 * '-'))
-
-        logger.info("Adding comment to {0}...".format(url))
-        try:
-            r = requests.post(url, auth=(self.login, self.password), data=data, headers=headers)
-            logger.info("HTTP status code: {0}".format(r.status_code))
-            r.raise_for_status()
-        except Exception as e:
-            logger.warning("Adding the comment failed: {0}".format(str(e)))
\ No newline at end of file
+#/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+import asyncio
+import io
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import requests
+from requests.adapters import HTTPAdapter
+import json
+from metrics import STAGE_UPLOAD
+from metrics import Span
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# A read timeout of these requests may come after JIRA already processed them, sending them again would e.g. duplicate an attachment
+NON_IDEMPOTENT_METHODS = ('POST', 'PATCH')
+
+
+class JIRARequestError(Exception):
+    """Raised when a request to JIRA still fails after all retries."""
+    def __init__(self, message, attempts):
+        super().__init__(message)
+        self.message = message
+        self.attempts = attempts
+
+
+class UploadSource(object):
+    """A file to be uploaded, either from disk or from memory.
+
+    Args:
+        filename (str): The filename of the attachment.
+        filepath (str): File path of the file on disk, defaults to None.
+        data (bytes): The content of the file, used instead of a file on disk, defaults to None.
+    """
+    def __init__(self, filename, filepath=None, data=None):
+        self.filename = filename
+        self.filepath = filepath
+        self.data = data
+
+        if (filepath is None) == (data is None):
+            raise ValueError('You must provide either a filepath or the data of the file to be uploaded.')
+
+    @classmethod
+    def from_path(cls, filepath):
+        return cls(os.path.basename(filepath), filepath=filepath)
+
+    @property
+    def size(self):
+        if self.data is not None:
+            return len(self.data)
+        return os.path.getsize(self.filepath)
+
+    def open(self):
+        """Returns a new binary file object reading the content from the start."""
+        if self.data is not None:
+            return io.BytesIO(self.data)
+        return open(self.filepath, 'rb')
+
+    def __str__(self):
+        return self.filepath or self.filename
+
+
+class MultipartEncoder(object):
+    """Encodes one file as a multipart/form-data request body, reading the file block by block while it is sent.
+
+    requests streams iterables with a known length, so at most one block of the file is held in memory.
+
+    Args:
+        field_name (str): The name of the form field, e.g. 'file'.
+        source (UploadSource): The file to be encoded.
+        block_size (int): The count of bytes read from the file at a time, defaults to 1 MB.
+        boundary (str): The multipart boundary, defaults to None (a random one).
+    """
+    def __init__(self, field_name, source, block_size=1048576, boundary=None):
+        self.source = source
+        self.block_size = block_size
+        self.boundary = boundary or uuid.uuid4().hex
+        filename = source.filename.replace('"', '%22').replace('\r', '').replace('\n', '')
+        self.preamble = ('--{0}\r\nContent-Disposition: form-data; name="{1}"; filename="{2}"\r\n'
+                         'Content-Type: application/octet-stream\r\n\r\n').format(self.boundary, field_name, filename).encode('utf-8')
+        self.epilogue = '\r\n--{0}--\r\n'.format(self.boundary).encode('ascii')
+        self.file_size = source.size
+        self.file = None
+        self.send_duration = None
+
+    def __len__(self):
+        return len(self.preamble) + self.file_size + len(self.epilogue)
+
+    def __iter__(self):
+        self.file = self.source.open()
+        send_start_time = time.monotonic()
+        try:
+            yield self.preamble
+            for block in iter(lambda: self.file.read(self.block_size), b''):
+                yield block
+            yield self.epilogue
+            self.send_duration = time.monotonic() - send_start_time
+        finally:
+            self.close()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+class JIRAUploadResult(object):
+    """Contains the outcome of uploading one file to a JIRA issue.
+
+    Args:
+        filepath (str): File path of the uploaded file, or its filename if it was uploaded from memory.
+        file_size (int): Size of the file in bytes.
+        status_code (int): HTTP status code of the last attempt, None if no response was received.
+        attempts (int): The count of attempts made.
+        duration (datetime.timedelta): The time needed for all attempts.
+        error (str): The error of the last attempt, None if the upload succeeded.
+        throughput (float): Upload throughput of the successful attempt in MB/s, defaults to None.
+        span (metrics.Span): The upload span for the run metrics, defaults to None.
+    """
+    def __init__(self, filepath, file_size, status_code, attempts, duration, error=None, throughput=None, span=None):
+        self.filepath = filepath
+        self.file_size = file_size
+        self.status_code = status_code
+        self.attempts = attempts
+        self.duration = duration
+        self.error = error
+        self.throughput = throughput
+        self.span = span
+
+    def succeeded(self):
+        """Indicates whether the upload succeeded."""
+        return self.error is None
+
+
+class JIRAClient(object):
+    """Talks to the REST API of JIRA over a shared session, keeping the connections alive between requests.
+
+    Requests failing with a connection error or one of the status codes in RETRY_STATUS_CODES are retried with
+    exponential backoff, requests timing out while waiting on the response only if they are not in NON_IDEMPOTENT_METHODS (backoff_factor * 2 ** attempt seconds), a Retry-After header of the response takes precedence.
+    The session is safe to be used by the threads uploading files concurrently.
+
+    Args:
+        base_url (str): JIRA base URL, e.g. 'jira.domain.com'. HTTPS is used unless the URL starts with a scheme.
+        login (str): Name of the JIRA user.
+        password (str): Password of the JIRA user.
+        max_connections (int): The maximum count of connections kept alive and of concurrent uploads, defaults to 4.
+        max_retries (int): The count of retries after a failed attempt, defaults to 3.
+        backoff_factor (float): The delay before the first retry in seconds, doubled with every further retry, defaults to 1.0.
+        timeout (float): Timeout for connecting and for waiting on the server in seconds, defaults to 300.
+        block_size (int): The count of bytes of a file read and sent at a time while uploading, defaults to 1 MB.
+    """
+    def __init__(self, base_url, login, password, max_connections=4, max_retries=3, backoff_factor=1.0, timeout=300, block_size=1048576):
+        if '://' in base_url:
+            self.base_url = base_url.rstrip('/')
+        else:
+            self.base_url = 'https://{0}'.format(base_url.rstrip('/'))
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.block_size = block_size
+
+        self.session = requests.Session()
+        self.session.auth = (login, password)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def url(self, path):
+        """Returns the URL of a path of the REST API, e.g. 'issue/ITD-122'."""
+        return '{0}/rest/api/2/{1}'.format(self.base_url, path)
+
+    def request(self, method, path, prepare=None, **kwargs):
+        """Sends a request to the REST API, retrying it on connection errors, 429 and 5xx responses and read timeouts of idempotent requests.
+
+        Args:
+            method (str): The HTTP method, e.g. 'GET'.
+            path (str): The path of the REST API, e.g. 'issue/ITD-122'.
+            prepare (callable): Called before every attempt, returns further keyword arguments for the request, e.g. a fresh
+                MultipartEncoder as data. Values with a close method are closed after the attempt. Defaults to None.
+
+        Returns:
+            A tuple of the successful response and the count of attempts.
+
+        Raises:
+            JIRARequestError: The request failed with a status code not worth retrying, or all retries failed.
+        """
+        url = self.url(path)
+        attempt = 0
+        while True:
+            attempt += 1
+            request_kwargs = dict(kwargs)
+            prepared = {}
+            if prepare:
+                prepared = prepare()
+                request_kwargs.update(prepared)
+
+            retry_after = None
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **request_kwargs)
+                if response.status_code < 400:
+                    return response, attempt
+                error = '{0} {1} for {2} {3}'.format(response.status_code, response.reason, method, url)
+                retryable = response.status_code in RETRY_STATUS_CODES
+                retry_after = response.headers.get('Retry-After')
+            except requests.ConnectionError as e:
+                # including a connect timeout, the request did not reach JIRA
+                error = str(e)
+                retryable = True
+            except requests.Timeout as e:
+                error = str(e)
+                retryable = method.upper() not in NON_IDEMPOTENT_METHODS
+            finally:
+                for value in prepared.values():
+                    if hasattr(value, 'close'):
+                        value.close()
+
+            if not retryable or attempt > self.max_retries:
+                raise JIRARequestError('{0} (after {1} attempt(s))'.format(error, attempt), attempt)
+
+            delay = self.backoff_factor * 2 ** (attempt - 1)
+            if retry_after and retry_after.isdigit():
+                delay = int(retry_after)
+            logger.warning("Request to JIRA failed: {0}, retrying in {1}s...".format(error, delay))
+            time.sleep(delay)
+
+    def get_issue_title(self, issue):
+        """Fetches the title/summary of a given JIRA issue."""
+        response, _ = self.request('GET', 'issue/{0}'.format(issue))
+        return response.json()['fields']['summary']
+
+    def comment(self, issue, comment):
+        """Adds a comment to a specific JIRA issue."""
+        headers = {'Content-Type': 'application/json'}
+        data = json.dumps({'body': comment})
+        response, _ = self.request('POST', 'issue/{0}/comment'.format(issue), data=data, headers=headers)
+        return response
+
+    def upload(self, issue, source):
+        """Uploads a file as an attachment to a specific JIRA issue, streaming it in blocks of block_size bytes.
+
+        Args:
+            issue (str): Code of the JIRA issue, e.g. 'ITD-122'
+            source (str or UploadSource): File path of the file, or an UploadSource to upload a file from memory.
+
+        Returns:
+            A JIRAUploadResult object, failures are reported in it instead of being raised.
+        """
+        if not isinstance(source, UploadSource):
+            source = UploadSource.from_path(source)
+        boundary = uuid.uuid4().hex
+        headers = {"X-Atlassian-Token": "nocheck", "Content-Type": 'multipart/form-data; boundary={0}'.format(boundary)}
+        file_size = None
+        encoders = []
+
+        def encode_file():
+            # every attempt needs a fresh encoder, the body of the previous attempt was consumed
+            encoders.append(MultipartEncoder('file', source, self.block_size, boundary))
+            return {'data': encoders[-1]}
+
+        logger.info("Uploading file at {0} to {1}...".format(source, issue))
+        upload_started = time.time()
+        upload_start_time = time.perf_counter()
+        throughput = None
+        try:
+            file_size = source.size
+            response, attempts = self.request('POST', 'issue/{0}/attachments'.format(issue), prepare=encode_file, headers=headers)
+            status_code, error = response.status_code, None
+            throughput = file_size / 1024 ** 2 / max(encoders[-1].send_duration or 0, 0.001)
+        except JIRARequestError as e:
+            status_code, error, attempts = None, e.message, e.attempts
+        except OSError as e:
+            # e.g. the file was removed or cannot be read
+            status_code, error, attempts = None, str(e), max(1, len(encoders))
+        upload_seconds = time.perf_counter() - upload_start_time
+        duration = timedelta(seconds=round(upload_seconds, 3))
+        span = Span(STAGE_UPLOAD, upload_seconds, size=file_size, error=error, started=upload_started)
+
+        if error:
+            logger.warning("Upload of {0} failed: {1}".format(source, error))
+        else:
+            logger.info("Uploaded file at {0} to {1} in {2} with {3:.2f} MB/s (HTTP status code {4})".format(source, issue, duration, throughput, status_code))
+        return JIRAUploadResult(str(source), file_size, status_code, attempts, duration, error, throughput, span)
+
+    def upload_files(self, issue, filepaths):
+        """Uploads files concurrently, at most max_connections at a time.
+
+        Args:
+            issue (str): Code of the JIRA issue, e.g. 'ITD-122'
+            filepaths (list): File paths or UploadSource objects of the files to be uploaded.
+
+        Returns:
+            A list of JIRAUploadResult objects in the order of the given file paths.
+        """
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_connections, len(filepaths))), thread_name_prefix='krano-upload') as executor:
+            return list(executor.map(lambda filepath: self.upload(issue, filepath), filepaths))
+
+    def close(self):
+        """Closes the connections of the session."""
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class JIRAForwarder(object):
+    """Uploads files as attachments to a JIRA issue.
+
+    Args:
+        base_url (str): JIRA base URL, e.g. 'jira.domain.com'.
+        login (str): Name of the JIRA user.
+        password (str): Password of the JIRA user.
+        client (JIRAClient): A client to be shared with other JIRA requests, defaults to None (a client of its own).
+    """
+    def __init__(self, base_url, login, password, client=None):
+        self.base_url = base_url
+        self.login = login
+        self.password = password
+        self.client = client or JIRAClient(base_url, login, password)
+
+    def upload(self, issue, filepaths):
+        """Uploads files as attachments to a specific JIRA issue, several at a time.
+
+        Args:
+            issue (str): Code of the JIRA issue, e.g. 'ITD-122'
+            filepaths (list): A list of filepaths or UploadSource objects to upload as attachments to the JIRA issue.
+
+        Returns:
+            A list of JIRAUploadResult objects in the order of the given file paths.
+        """
+        logger.info('+{0}+'.format(60 * '-'))
+        logger.info("Uploading {0} file(s) to {1} with up to {2} parallel uploads...".format(len(filepaths), issue, self.client.max_connections))
+        return self.client.upload_files(issue, filepaths)
+
+
+class AsyncUploader(object):
+    """Uploads files to a JIRA issue in the background of an asyncio event loop, e.g. each file as soon as it was written.
+
+    Every upload runs in a thread of the uploader, at most max_connections of the client at a time, so the event loop
+    is free to wait for the next files meanwhile. Files can also be handed over from other threads, e.g. from the
+    callbacks of the Excel export processes, see submit_threadsafe(). A failed upload is reported in its JIRAUploadResult.
+
+    Args:
+        client (JIRAClient): The client sending the uploads.
+        issue (str): Code of the JIRA issue, e.g. 'ITD-122'
+        loop (asyncio.AbstractEventLoop): The event loop running the uploads.
+        upload_callback (callable): Called in the event loop with the JIRAUploadResult of every finished upload, e.g. to record
+            it in an export manifest, defaults to None.
+    """
+    def __init__(self, client, issue, loop, upload_callback=None):
+        self.client = client
+        self.issue = issue
+        self.loop = loop
+        self.upload_callback = upload_callback
+        self.executor = ThreadPoolExecutor(max_workers=max(1, client.max_connections), thread_name_prefix='krano-upload')
+        self.tasks = []
+
+    def submit(self, source):
+        """Starts uploading a file path or an UploadSource, to be called in the event loop."""
+        logger.info("Queued file at {0} for the upload to {1}".format(source, self.issue))
+        self.tasks.append(self.loop.create_task(self._upload(source)))
+
+    def submit_threadsafe(self, source):
+        """Starts uploading a file path or an UploadSource from another thread than the one of the event loop."""
+        self.loop.call_soon_threadsafe(self.submit, source)
+
+    async def _upload(self, source):
+        try:
+            result = await self.loop.run_in_executor(self.executor, self.client.upload, self.issue, source)
+        except Exception as e:
+            logger.warning("Upload of {0} failed: {1}".format(source, str(e)))
+            result = JIRAUploadResult(str(source), None, None, 1, timedelta(0), str(e))
+        if self.upload_callback:
+            self.upload_callback(result)
+        return result
+
+    async def wait(self):
+        """Waits for all uploads, including the ones submitted meanwhile.
+
+        Returns:
+            A list of JIRAUploadResult objects in the order the files were submitted.
+        """
+        while True:
+            pending = [task for task in self.tasks if not task.done()]
+            if not pending:
+                break
+            await asyncio.wait(pending)
+        return [task.result() for task in self.tasks]
+
+    def close(self):
+        """Stops the threads of the uploader, the client is left open."""
+        self.executor.shutdown(wait=True)
+
+
+class JIRACommenter(object):
+    """Adds comments to a JIRA issue.
+
+    Args:
+        base_url (str): JIRA base URL, e.g. 'jira.domain.com'.
+        login (str): Name of the JIRA user.
+        password (str): Password of the JIRA user.
+        client (JIRAClient): A client to be shared with other JIRA requests, defaults to None (a client of its own).
+    """
+    def __init__(self, base_url, login, password, client=None):
+        self.base_url = base_url
+        self.login = login
+        self.password = password
+        self.client = client or JIRAClient(base_url, login, password)
+
+    def comment(self, issue, comment):
+        """Adds a comment to a specific JIRA issue.
+
+        Args:
+            issue (str): Code of the JIRA issue, e.g. 'ITD-122'
+            comment (str): A comment to be added to the JIRA issue.
+        """
+        logger.info('+{0}+'.format(60 * '-'))
+
+        logger.info("Adding comment to {0}...".format(self.client.url('issue/{0}/comment'.format(issue))))
+        try:
+            r = self.client.comment(issue, comment)
+            logger.info("HTTP status code: {0}".format(r.status_code))
+        except Exception as e:
+            logger.warning("Adding the comment failed: {0}".format(str(e)))
@@ -2,14 +2,11 @@
 # -*- coding: utf-8 -*-
 
 import logging
-logging.basicConfig(level=logging.INFO,
-                    format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
 logger = logging.getLogger(__name__)
-import requests
-import json
+from forwarders import JIRAClient
 
 
-def getissuetitle(base_url, issue, login, password):
+def getissuetitle(base_url, issue, login, password, client=None):
     """Fetches the title/summary of a given JIRA issue.
 
     Args:
@@ -17,16 +14,16 @@ def getissuetitle(base_url, issue, login, password):
         issue (str): JIRA issue key.
         login (str): Name of the JIRA user.
         password (str): Password of the JIRA user.
+        client (JIRAClient): A client to be shared with other JIRA requests, defaults to None (a client of its own).
 
     Returns:
         The title of the given JIRA issue,
     """
     try:
-        url = 'https://{0}/rest/api/2/issue/{1}'.format(base_url, issue)
-        r = requests.get(url, auth=(login, password))
-        r.raise_for_status()
-        issuetitle = r.json()['fields']['summary']
-        return issuetitle
+        if client:
+            return client.get_issue_title(issue)
+        with JIRAClient(base_url, login, password) as client:
+            return client.get_issue_title(issue)
     except Exception as e:
         logger.warning("GET request to JIRA failed: {0}".format(str(e)))
         raise (e)
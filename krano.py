@@ -1,177 +1,678 @@
-#!/usr/bin/python
-# -*- coding: utf-8 -*-
-
-import logging
-logging.basicConfig(level=logging.INFO,
-                    format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
-logger = logging.getLogger(__name__)
-import os
-from pathlib import Path
-from postgresql import ConnectionSettings
-from postgresql import Database
-from exporter import ExcelExporter
-from exporter import  ExcelDecoration
-from exporter import  ExcelDecorationElement
-from exporter import ExcelDecorationManager
-from exporter import SQLFileWriter
-from forwarders import JIRAForwarder
-from forwarders import JIRACommenter
-
-
-class KranoExportError(Exception):
-    """Raised when the Excel export encounters errors."""
-    pass
-
-
-class KranoDecorationError(Exception):
-    """Raised when the Excel export encounters errors."""
-    pass
-
-
-class Krano(object):
-    """Fetches records from a PostreSQL database and exports the result to one
-    or several Excel documents. Can be configured to decorate the Excel documents
-    with further worksheets containing additional informations and to upload the
-    created Excel documents as attachments to a JIRA issue."""
-
-    def __init__(self):
-        self.db_connection_settings = None
-        self.export_folderpath = None
-        self.jira_base_url = None
-        self.jira_user = None
-        self.jira_password = None
-        self.sql_decoration = True
-
-    def set_database_config(self, connection_name, host, database_name, user, password):
-        """Sets the database configuration.
-
-        Args:
-            connection_name (str): Name of the database connection.
-            host (str): Host of the database server.
-            database_name (str): Name of the database.
-            user (str): Name of the database user.
-            password (str): Password of the database user.
-        """
-        db_connection_settings = ConnectionSettings(connection_name, host, database_name, user, password)
-        self.db_connection_settings = db_connection_settings
-
-    def set_export_config(self, export_folderpath):
-        """Sets the export configuration.
-
-        Args:
-            export_folderpath (str): Path to the export folder where the Excel & SQL files will be created.
-
-        Raises:
-            FileNotFoundError: The given export folder path does not exist.
-            NotADirectoryError: The given export folder path does not point to a directory.
-        """
-        self.export_folderpath = export_folderpath
-
-        if not os.path.exists(self.export_folderpath):
-            errmsg = "No such file or directory: '{0}'".format(self.export_folderpath)
-            raise FileNotFoundError(errmsg)
-
-        if not os.path.isdir(self.export_folderpath):
-            errmsg = "Chosen export folderpath does not point to a directory: '{0}'".format(self.export_folderpath)
-            raise NotADirectoryError(errmsg)
-
-    def set_jira_config(self, base_url, user, password):
-        """Sets the basic JIRA configuration.
-
-        Args:
-            base_url (str): JIRA base URL, e.g. 'jira.domain.com'.
-            user (str): Name of the JIRA user.
-            password (str): Password of the JIRA user.
-        """
-        self.jira_base_url = base_url
-        self.jira_user = user
-        self.jira_password = password
-
-    def export(self, sql_statement, xlsx_filename, sheet_name, chunk_size, overwrite_files=False, parallel_processes=2, excel_decorations=None, jira_issue=None):
-        """Executes an SQL query against a PostgreSQL database and exports the fetched records to one or several Excel documents.
-
-        Args:
-            sql_statement (str): The SQL query to be executed.
-            xlsx_filename (str): Filename of the Excel file to be created.
-            sheet_name (str): Name of the worksheet where the records will occur in the Excel file.
-            chunk_size (int): Maximum number of rows per Excel file.
-            overwrite_files (bool): Indicates if an already existing Excel file will be overwritten.
-            parallel_processes (int): The maximum count of parallel Excel export/decoration processes to be started, defaults to 2.
-            excel_decorations (list): A list of ExcelDecoration objects. If this argument is ot given, the Excel files will not boe decorated.
-            jira_issue (str): The JIRA issue where the created Excel & SQL files should be attached. If this argument is not given, no files will be uploaded.
-
-        Raises:
-            ValueError: No database configuration was set with set_database_config prior to calling the export function.
-            ValueError: No export folderpath was defined with set_export_config prior to calling the export function.
-            KranoExportError: Excel export encountered an error.
-            KranoDecorationError: Excel decoration encountered an error.
-        """
-        if not self.db_connection_settings:
-            errmsg = "No database configuration was set with set_database_config prior to calling the export function."
-            raise ValueError(errmsg)
-
-        if not self.export_folderpath:
-            errmsg = "No export folderpath was defined with set_export_config prior to calling the export function."
-            raise ValueError(errmsg)
-
-        try:
-            db = Database(self.db_connection_settings)
-            result = db.query(sql_statement)
-        except Exception as e:
-            raise(e)
-        finally:
-            db.close()
-
-        if result.record_count == 0:
-            logger.info('The result from the database is empty')
-            return
-
-        xlsx_filepath = os.path.join(self.export_folderpath, xlsx_filename)
-        sql_filepath = os.path.splitext(xlsx_filepath)[0] + '.sql'
-
-        xlsx_exporter = ExcelExporter(xlsx_filepath, result, chunk_size, sheet_name, overwrite_files, parallel_processes=parallel_processes)
-        xlsx_exporter_result = xlsx_exporter.export()
-
-        if xlsx_exporter_result.has_errros():
-            logger.error('The Excel export process encountered the following errors:')
-            for excel_export_process_error in xlsx_exporter_result.excel_export_process_errors:
-                logger.error('Process name: {0} | Filepath: {1} | Error message: {2}'.format(excel_export_process_error.excel_export_process.process_name,
-                                                                                             excel_export_process_error.excel_export_process.filepath,
-                                                                                             excel_export_process_error.message))
-            raise KranoExportError('The Excel export process encountered errors.')
-
-        exported_xlsx_filepaths = [res.filepath for res in xlsx_exporter_result.excel_export_process_results]
-
-        copy_excel_decorations = excel_decorations.copy()
-
-        if excel_decorations:
-            if self.sql_decoration:
-                excel_sql_decoration = ExcelDecoration('SQL', "Query details")
-                excel_sql_decoration.add_element(ExcelDecorationElement('Query duration', result.query_duration))
-                excel_sql_decoration.add_element(ExcelDecorationElement('SQL query', result.sql_statement))
-                copy_excel_decorations.append(excel_sql_decoration)
-
-            excel_decorator_manager = ExcelDecorationManager(exported_xlsx_filepaths, copy_excel_decorations, parallel_processes=parallel_processes)
-            xlsx_decorator_result = excel_decorator_manager.decorate()
-
-            if xlsx_decorator_result.has_errros():
-                logger.error('The Excel decoration process encountered the following errors:')
-                for excel_decoration_process_error in xlsx_decorator_result.excel_decoration_process_errors:
-                    logger.error('Process name: {0} | Filepath: {1} | Error message: {2}'.format(excel_decoration_process_error.excel_decorator.process_name,
-                                                                                                 excel_decoration_process_error.excel_decorator.filepath,
-                                                                                                 excel_decoration_process_error.message))
-                raise KranoDecorationError('The Excel decoration process encountered errors.')
-
-        sql_exporter = SQLFileWriter(sql_filepath, result.sql_statement)
-        sql_exporter.write()
-
-        if jira_issue:
-            upload_filepaths = exported_xlsx_filepaths + [sql_filepath]
-            jira_forwarder = JIRAForwarder(self.jira_base_url, self.jira_user, self.jira_password)
-            jira_forwarder.upload(jira_issue, upload_filepaths)
-
-            upload_filenames = [' [^' + Path(filepath).name + ']' for filepath in upload_filepaths]
-            comment_filenames = '\n'.join(upload_filenames)
-            comment = 'The Python script krano attached the following {0} file(s) to this JIRA issue: \n\n{1}'.format(len(upload_filenames), comment_filenames)
-            jira_commenter = JIRACommenter(self.jira_base_url, self.jira_user, self.jira_password)
-            jira_commenter.comment(jira_issue, comment)
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+import asyncio
+import inspect
+import os
+from pathlib import Path
+from metrics import RUN_FAILED
+from metrics import RUN_SUCCEEDED
+from metrics import STAGE_COMMENT
+from metrics import STAGE_SQL_FILE_WRITE
+from metrics import RunMetrics
+from resources import resolve_parallel_processes
+from workers import WorkerPool
+from writers import FORMAT_XLSX
+from writers import output_format_for_filename
+from writers import split_output_extension
+
+
+class KranoExportError(Exception):
+    """Raised when the Excel export encounters errors."""
+    pass
+
+
+class KranoDecorationError(Exception):
+    """Raised when the Excel export encounters errors."""
+    pass
+
+
+class KranoUploadError(Exception):
+    """Raised when files could not be uploaded to JIRA."""
+    pass
+
+
+class KranoPreflightError(Exception):
+    """Raised when the estimate of an export exceeds the limits set with set_preflight_config."""
+    pass
+
+
+class Krano(object):
+    """Fetches records from a PostreSQL database and exports the result to one
+    or several Excel documents. Can be configured to decorate the Excel documents
+    with further worksheets containing additional informations and to upload the
+    created Excel documents as attachments to a JIRA issue.
+
+    The database driver, the writers and the JIRA client are only imported by the methods needing them,
+    so importing krano stays cheap, e.g. for the command line interface (cli.py). The database_class attribute
+    replaces postgresql.Database, e.g. by the FakeDatabase of benchmark.py."""
+
+    def __init__(self):
+        self.db_connection_settings = None
+        self.export_folderpath = None
+        self.jira_base_url = None
+        self.jira_user = None
+        self.jira_password = None
+        self.jira_client = None
+        self.sql_decoration = True
+        self.decorate_existing_files = False
+        self.connection_pool = None
+        self.worker_pool = None
+        self.owned_worker_pool = None
+        self.worker_start_method = 'forkserver'
+        self.worker_preload_modules = None
+        self.result_cache = None
+        self.metrics_report_folderpath = None
+        self.metrics_prometheus_folderpath = None
+        self.last_run_metrics = None
+        self.database_class = None
+        self.preflight_max_rows = None
+        self.preflight_max_size = None
+        self.preflight_refuse = False
+
+    def set_database_config(self, connection_name, host, database_name, user, password):
+        """Sets the database configuration.
+
+        Args:
+            connection_name (str): Name of the database connection.
+            host (str): Host of the database server.
+            database_name (str): Name of the database.
+            user (str): Name of the database user.
+            password (str): Password of the database user.
+        """
+        from postgresql import ConnectionSettings
+
+        db_connection_settings = ConnectionSettings(connection_name, host, database_name, user, password)
+        self.db_connection_settings = db_connection_settings
+
+    def set_export_config(self, export_folderpath):
+        """Sets the export configuration.
+
+        Args:
+            export_folderpath (str): Path to the export folder where the Excel & SQL files will be created.
+
+        Raises:
+            FileNotFoundError: The given export folder path does not exist.
+            NotADirectoryError: The given export folder path does not point to a directory.
+        """
+        self.export_folderpath = export_folderpath
+
+        if not os.path.exists(self.export_folderpath):
+            errmsg = "No such file or directory: '{0}'".format(self.export_folderpath)
+            raise FileNotFoundError(errmsg)
+
+        if not os.path.isdir(self.export_folderpath):
+            errmsg = "Chosen export folderpath does not point to a directory: '{0}'".format(self.export_folderpath)
+            raise NotADirectoryError(errmsg)
+
+    def set_jira_config(self, base_url, user, password, parallel_uploads=4, max_retries=3, upload_block_size=1048576):
+        """Sets the basic JIRA configuration.
+
+        Args:
+            base_url (str): JIRA base URL, e.g. 'jira.domain.com'.
+            user (str): Name of the JIRA user.
+            password (str): Password of the JIRA user.
+            parallel_uploads (int): The maximum count of files uploaded at the same time, defaults to 4.
+            max_retries (int): The count of retries of a failed JIRA request, defaults to 3.
+            upload_block_size (int): The count of bytes of a file read and sent at a time while uploading, defaults to 1 MB.
+        """
+        from forwarders import JIRAClient
+
+        self.jira_base_url = base_url
+        self.jira_user = user
+        self.jira_password = password
+        if self.jira_client:
+            self.jira_client.close()
+        self.jira_client = JIRAClient(base_url, user, password, max_connections=parallel_uploads, max_retries=max_retries,
+                                      block_size=upload_block_size)
+
+    def set_cache_config(self, cache_folderpath, ttl=86400, max_size=10 * 1024 ** 3):
+        """Sets the configuration of the on-disk query result cache, which is disabled unless configured.
+
+        Args:
+            cache_folderpath (str): Path to the folder storing the cached query results.
+            ttl (int): Time to live of a cached query result in seconds, defaults to 86400 (one day).
+            max_size (int): Maximum size of all cached query results in bytes, the least recently used ones are evicted, defaults to 10 GB.
+        """
+        from cache import QueryResultCache
+
+        self.result_cache = QueryResultCache(cache_folderpath, ttl=ttl, max_size=max_size)
+
+    def set_preflight_config(self, max_rows=None, max_size=None, refuse=False):
+        """Sets the limits checked by the pre-flight estimate of exports run with preflight=True.
+
+        Args:
+            max_rows (int): The maximum estimated count of rows, defaults to None (no limit).
+            max_size (int): The maximum estimated size of the result in bytes, as PostgreSQL stores it, defaults to None (no limit).
+            refuse (bool): Refuse exports exceeding a limit with a KranoPreflightError instead of only logging a warning, defaults to False.
+        """
+        self.preflight_max_rows = max_rows
+        self.preflight_max_size = max_size
+        self.preflight_refuse = refuse
+
+    def set_metrics_config(self, report_folderpath=None, prometheus_folderpath=None):
+        """Sets where the metrics of every export are written. They are always logged as a table at the end of an export.
+
+        Args:
+            report_folderpath (str): Path to the folder receiving a JSON run report per export, named after the file and the start time, defaults to None.
+            prometheus_folderpath (str): Path to the folder receiving a Prometheus textfile per exported file name, replaced by every run,
+                e.g. the folder of the textfile collector of the node exporter, defaults to None.
+        """
+        self.metrics_report_folderpath = report_folderpath
+        self.metrics_prometheus_folderpath = prometheus_folderpath
+
+    def _finish_run_metrics(self, run_metrics, status):
+        """Logs the metrics of an export and writes the run report and the Prometheus textfile, if configured."""
+        run_metrics.finish(status)
+        logger.info('{0}{1}'.format('Run metrics:\n', run_metrics.statistics_table()))
+        try:
+            if self.metrics_report_folderpath:
+                logger.info('Run report written to {0}'.format(run_metrics.write_report(self.metrics_report_folderpath)))
+            if self.metrics_prometheus_folderpath:
+                logger.info('Prometheus metrics written to {0}'.format(run_metrics.write_prometheus(self.metrics_prometheus_folderpath)))
+        except OSError as e:
+            logger.error('The run metrics could not be written: {0}'.format(str(e)))
+
+    def set_pool_config(self, connection_pool=None, worker_pool=None):
+        """Sets pools shared with other exports, e.g. by the exports of a batch. Krano neither closes nor joins them.
+
+        Args:
+            connection_pool (ConnectionPool): The pool of connections to the configured database, defaults to None.
+            worker_pool (workers.WorkerPool): The process pool creating and decorating the Excel files, defaults to None.
+        """
+        self.connection_pool = connection_pool
+        self.worker_pool = worker_pool
+
+    def set_worker_config(self, start_method='forkserver', preload_modules=None):
+        """Sets the configuration of the worker pool Krano starts for the first export and keeps for the following ones.
+
+        Args:
+            start_method (str): 'forkserver', 'spawn' or 'fork', defaults to 'forkserver'.
+            preload_modules (list): The modules imported once before the workers start, defaults to None (workers.DEFAULT_PRELOAD_MODULES).
+        """
+        self.worker_start_method = start_method
+        self.worker_preload_modules = preload_modules
+        if self.owned_worker_pool:
+            self.owned_worker_pool.close()
+            self.owned_worker_pool = None
+
+    def _get_worker_pool(self, parallel_processes):
+        """Returns the shared worker pool, or the one owned by Krano, which is restarted if it has too few processes."""
+        if self.worker_pool:
+            return self.worker_pool
+
+        processes = resolve_parallel_processes(parallel_processes)
+        if self.owned_worker_pool and self.owned_worker_pool.processes < processes:
+            self.owned_worker_pool.close()
+            self.owned_worker_pool = None
+        if not self.owned_worker_pool:
+            self.owned_worker_pool = WorkerPool(processes, self.worker_start_method, self.worker_preload_modules)
+        return self.owned_worker_pool
+
+    def close(self):
+        """Stops the worker pool owned by Krano and closes the connections to JIRA."""
+        if self.owned_worker_pool:
+            self.owned_worker_pool.close()
+            self.owned_worker_pool = None
+        if self.jira_client:
+            self.jira_client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _get_decorations(self, excel_decorations, sql_statement, query_duration, delta_range=None):
+        """Returns the given Excel decorations plus the SQL decoration, if enabled, recording the delta range of an incremental export."""
+        from exporter import ExcelDecoration
+        from exporter import ExcelDecorationElement
+
+        if not excel_decorations:
+            return []
+
+        copy_excel_decorations = excel_decorations.copy()
+
+        if self.sql_decoration:
+            excel_sql_decoration = ExcelDecoration('SQL', "Query details")
+            excel_sql_decoration.add_element(ExcelDecorationElement('Query duration', query_duration))
+            excel_sql_decoration.add_element(ExcelDecorationElement('SQL query', sql_statement))
+            if delta_range:
+                excel_sql_decoration.add_element(ExcelDecorationElement('Delta range', delta_range))
+            copy_excel_decorations.append(excel_sql_decoration)
+
+        return copy_excel_decorations
+
+    def export(self, sql_statement, xlsx_filename, sheet_name, chunk_size, overwrite_files=False, parallel_processes=2, excel_decorations=None, jira_issue=None,
+               stream=False, xlsx_engine='native', chunk_handoff='pickle', fetch_method='cursor', partitions=1, partition_column=None,
+               partition_method='hash', cache_mode='use', output_format=None, upload_from_memory=False, max_file_size=None, resume=False,
+               retries=0, watermark_column=None, exact_decimal_columns=None, columnar=False, single_file=False, preflight=False):
+        """Executes an SQL query against a PostgreSQL database and exports the fetched records to one or several Excel documents.
+
+        Args:
+            sql_statement (str): The SQL query to be executed.
+            xlsx_filename (str): Filename of the Excel file to be created.
+            sheet_name (str): Name of the worksheet where the records will occur in the Excel file.
+            chunk_size (int): Maximum number of rows per Excel file.
+            overwrite_files (bool): Indicates if an already existing Excel file will be overwritten.
+            parallel_processes (int or str): The maximum count of parallel Excel export/decoration processes to be started, defaults to 2.
+                'auto' chooses it from the available CPUs and memory and holds back new processes while memory is short.
+            excel_decorations (list): A list of ExcelDecoration objects. If this argument is ot given, the Excel files will not boe decorated.
+                The decorations are written while the Excel files are created, unless decorate_existing_files is set to True. Can also be
+                an awaitable returning the list, e.g. a coroutine looking up the JIRA issue title, which then runs while the query is executed.
+            jira_issue (str): The JIRA issue where the created Excel & SQL files should be attached. If this argument is not given, no files will be uploaded.
+            stream (bool): Fetch the records in batches through a server-side cursor while exporting them, so the result never has to fit into memory as a whole, defaults to False.
+            xlsx_engine (str): The engine writing the Excel files, either 'native' (constant memory) or 'pandas', defaults to 'native'.
+            chunk_handoff (str): How the chunks are passed to the export processes, either 'pickle' or 'shared_memory', defaults to 'pickle'.
+            fetch_method (str): How the records are fetched: 'cursor', 'copy_text' or 'copy_binary', defaults to 'cursor'.
+            partitions (int): Split the SQL query into this many slices fetched in parallel over one connection each, all sharing
+                one snapshot. The rows of the slices are interleaved, so an ORDER BY is not preserved. Defaults to 1 (no partitioning).
+            partition_column (str): The column of the query result the rows are split by, defaults to None (hash of the whole row).
+            partition_method (str): Either 'hash' or 'range' (requires a partition column), defaults to 'hash'.
+            cache_mode (str): If a cache was configured with set_cache_config: 'use' takes a valid cached result instead of running
+                the query, 'refresh' runs the query and replaces the cached result, 'bypass' ignores the cache, defaults to 'use'.
+            output_format (str): 'xlsx', 'csv', 'csv.gz' or 'parquet' (requires pyarrow). Decorations are only written into XLSX files.
+                Defaults to None, which picks the format from the extension of xlsx_filename and falls back to 'xlsx'.
+            upload_from_memory (bool): If a JIRA issue is given, create the files in memory and upload them straight from there, so nothing
+                is written to the export folder. Only meant for small exports, every file is held in memory as a whole. Defaults to False.
+            max_file_size (int): The maximum size of a file in bytes. The rows per file are then chosen from an estimate of the bytes per row,
+                chunk_size only caps them. Defaults to None (chunk_size rows per file).
+            resume (bool): Record the progress in a manifest next to the files (see manifest.ExportManifest), so rerunning a failed export
+                only creates the missing or corrupt files again and skips the uploads that already succeeded. If all files were created,
+                the query is not even executed again. The manifest is removed once the export succeeded. Defaults to False.
+            retries (int): How often a failed Excel export process is started again before the export fails, defaults to 0.
+            watermark_column (str): Export incrementally: an increasing column of the query result, e.g. an id or updated_at. Its highest
+                exported value is kept next to the files (see watermark.Watermark), the next export only fetches the rows above it and
+                numbers its files after the existing ones, e.g. '_5', '_6'. All files are numbered, rows with a NULL value are never
+                exported. The SQL decoration records the range of every export. Defaults to None (export all rows).
+            exact_decimal_columns (list): Names of NUMERIC columns written into XLSX files as text with all their digits. Other NUMERIC
+                columns are written as numbers, which Excel keeps with 15 significant digits. Defaults to None.
+            columnar (bool): Keep the fetched records column by column in typed arrays instead of as Python tuples, which takes a
+                fraction of the memory of large results. Ignored when streaming. Defaults to False.
+            single_file (bool): Export all records into one XLSX file instead of one file per chunk, writing the worksheet in parts of
+                chunk_size rows in parallel processes (see exporter.SingleFileExcelExporter). The result must not exceed 1048575 rows,
+                max_file_size and xlsx_engine are ignored. Defaults to False.
+            preflight (bool): Estimate the rows and the row width of the result with EXPLAIN before executing the query (see
+                preflight.plan_export()). The estimate plans the count of files, the parallel processes and the memory budget, streams
+                a result which would not fit into memory and is checked against the limits set with set_preflight_config. The progress
+                of the export and the remaining time are logged against it. Defaults to False.
+
+        The export runs in an asyncio event loop (see export_async()), which uploads every file to JIRA as soon as it was written,
+        while the next files are still being created. The SQL file is uploaded right after the query, files decorated afterwards once
+        they were decorated. The comment listing the files is added when all uploads finished. If the export fails, the files uploaded
+        so far stay attached to the JIRA issue, a rerun with resume skips them.
+
+        The time spent connecting, executing, fetching, writing, decorating and uploading is measured per stage and per file.
+        The metrics of the last export are kept in the last_run_metrics attribute, see set_metrics_config for writing them out.
+
+        Raises:
+            ValueError: No database configuration was set with set_database_config prior to calling the export function.
+            ValueError: No export folderpath was defined with set_export_config prior to calling the export function.
+            ValueError: The watermark next to the files belongs to another SQL query, connection or watermark column.
+            ValueError: A single file was requested for another output format than XLSX.
+            KranoPreflightError: The estimate of the export exceeds the configured limits and set_preflight_config refuses such exports.
+            KranoExportError: Excel export encountered an error.
+            KranoDecorationError: Excel decoration encountered an error.
+            KranoUploadError: One or more files could not be uploaded to JIRA.
+        """
+        return asyncio.run(self.export_async(sql_statement, xlsx_filename, sheet_name, chunk_size, overwrite_files=overwrite_files,
+                                             parallel_processes=parallel_processes, excel_decorations=excel_decorations, jira_issue=jira_issue,
+                                             stream=stream, xlsx_engine=xlsx_engine, chunk_handoff=chunk_handoff, fetch_method=fetch_method,
+                                             partitions=partitions, partition_column=partition_column, partition_method=partition_method,
+                                             cache_mode=cache_mode, output_format=output_format, upload_from_memory=upload_from_memory,
+                                             max_file_size=max_file_size, resume=resume, retries=retries, watermark_column=watermark_column,
+                                             exact_decimal_columns=exact_decimal_columns, columnar=columnar, single_file=single_file,
+                                             preflight=preflight))
+
+    async def export_async(self, sql_statement, xlsx_filename, sheet_name, chunk_size, overwrite_files=False, parallel_processes=2,
+                           excel_decorations=None, jira_issue=None, stream=False, xlsx_engine='native', chunk_handoff='pickle',
+                           fetch_method='cursor', partitions=1, partition_column=None, partition_method='hash', cache_mode='use',
+                           output_format=None, upload_from_memory=False, max_file_size=None, resume=False, retries=0,
+                           watermark_column=None, exact_decimal_columns=None, columnar=False, single_file=False, preflight=False):
+        """Runs an export as a coroutine, e.g. within an application already running an asyncio event loop.
+
+        The query, the export processes and the uploads run in threads and processes, the event loop only coordinates them.
+        Takes the same arguments and raises the same errors as export().
+        """
+        if not self.db_connection_settings:
+            errmsg = "No database configuration was set with set_database_config prior to calling the export function."
+            raise ValueError(errmsg)
+
+        if not self.export_folderpath:
+            errmsg = "No export folderpath was defined with set_export_config prior to calling the export function."
+            raise ValueError(errmsg)
+
+        run_metrics = RunMetrics(split_output_extension(xlsx_filename)[0], {'connection': self.db_connection_settings.name,
+                                                                            'output_format': output_format or output_format_for_filename(xlsx_filename)})
+        self.last_run_metrics = run_metrics
+        status = RUN_FAILED
+        try:
+            await self._export(run_metrics, sql_statement, xlsx_filename, sheet_name, chunk_size, overwrite_files=overwrite_files,
+                               parallel_processes=parallel_processes, excel_decorations=excel_decorations, jira_issue=jira_issue, stream=stream,
+                               xlsx_engine=xlsx_engine, chunk_handoff=chunk_handoff, fetch_method=fetch_method, partitions=partitions,
+                               partition_column=partition_column, partition_method=partition_method, cache_mode=cache_mode,
+                               output_format=output_format, upload_from_memory=upload_from_memory, max_file_size=max_file_size, resume=resume,
+                               retries=retries, watermark_column=watermark_column, exact_decimal_columns=exact_decimal_columns, columnar=columnar,
+                               single_file=single_file, preflight=preflight)
+            status = RUN_SUCCEEDED
+        finally:
+            self._finish_run_metrics(run_metrics, status)
+
+    async def _export(self, run_metrics, sql_statement, xlsx_filename, sheet_name, chunk_size, *, overwrite_files, parallel_processes,
+                      excel_decorations, jira_issue, stream, xlsx_engine, chunk_handoff, fetch_method, partitions, partition_column, partition_method,
+                      cache_mode, output_format, upload_from_memory, max_file_size, resume, retries, watermark_column, exact_decimal_columns,
+                      columnar, single_file, preflight):
+        """Runs the export described in export(), recording its spans in the given RunMetrics.
+
+        Blocking steps (the query, the export and decoration processes, the JIRA requests) run in the default executor of the
+        event loop. Every file is handed to an AsyncUploader as soon as it is final, so the uploads overlap with the export.
+        """
+        loop = asyncio.get_running_loop()
+        upload_from_memory = upload_from_memory and bool(jira_issue)
+
+        xlsx_filepath = os.path.join(self.export_folderpath, xlsx_filename)
+        sql_filepath = split_output_extension(xlsx_filepath)[0] + '.sql'
+
+        if not output_format:
+            output_format = output_format_for_filename(xlsx_filename)
+
+        if single_file and output_format != FORMAT_XLSX:
+            raise ValueError("A single file with parts written in parallel can only be created in the XLSX format, not '{0}'.".format(output_format))
+
+        decorations_task = None
+        if inspect.isawaitable(excel_decorations):
+            # e.g. the lookup of the JIRA issue title, which then runs while the SQL query is executed
+            decorations_task = asyncio.ensure_future(excel_decorations)
+
+        if excel_decorations and output_format != FORMAT_XLSX:
+            logger.info("Decorations are only written into XLSX files, skipping them for the output format '{0}'".format(output_format))
+            excel_decorations = None
+            if decorations_task:
+                decorations_task.cancel()
+                decorations_task = None
+
+        try:
+            await self._export_files(loop, run_metrics, sql_statement, xlsx_filepath, sql_filepath, sheet_name, chunk_size,
+                                     overwrite_files=overwrite_files, parallel_processes=parallel_processes, excel_decorations=excel_decorations,
+                                     decorations_task=decorations_task, jira_issue=jira_issue, stream=stream, xlsx_engine=xlsx_engine,
+                                     chunk_handoff=chunk_handoff, fetch_method=fetch_method, partitions=partitions, partition_column=partition_column,
+                                     partition_method=partition_method, cache_mode=cache_mode, output_format=output_format,
+                                     upload_from_memory=upload_from_memory, max_file_size=max_file_size, resume=resume, retries=retries,
+                                     watermark_column=watermark_column, exact_decimal_columns=exact_decimal_columns, columnar=columnar,
+                                     single_file=single_file, preflight=preflight)
+        finally:
+            if decorations_task and not decorations_task.done():
+                decorations_task.cancel()
+            elif decorations_task and not decorations_task.cancelled():
+                # retrieve a failure of the lookup, so asyncio does not report it a second time
+                decorations_task.exception()
+
+    async def _export_files(self, loop, run_metrics, sql_statement, xlsx_filepath, sql_filepath, sheet_name, chunk_size, *, overwrite_files,
+                            parallel_processes, excel_decorations, decorations_task, jira_issue, stream, xlsx_engine, chunk_handoff, fetch_method,
+                            partitions, partition_column, partition_method, cache_mode, output_format, upload_from_memory, max_file_size, resume,
+                            retries, watermark_column, exact_decimal_columns, columnar, single_file, preflight):
+        from postgresql import Database
+        from exporter import ExcelExporter
+        from exporter import SingleFileExcelExporter
+        from exporter import ExcelDecorationManager
+        from exporter import SQLFileWriter
+        from forwarders import AsyncUploader
+        from forwarders import JIRAClient
+        from forwarders import JIRACommenter
+        from forwarders import UploadSource
+        from manifest import ExportManifest
+        from manifest import export_fingerprint
+        from manifest import file_checksum
+        from manifest import manifest_filepath
+        from watermark import Watermark
+        from watermark import watermark_filepath
+        from cache import cache_key
+        from preflight import ExportProgress
+        from preflight import plan_export
+
+        async def resolve_decorations(query_duration, delta_range):
+            decorations = await decorations_task if decorations_task else excel_decorations
+            return self._get_decorations(decorations, sql_statement, query_duration, delta_range)
+
+        watermark = None
+        first_file_number = None
+        manifest = None
+        uploader = None
+        jira_client = None
+        skipped_upload_filenames = []
+        if jira_issue:
+            jira_client = self.jira_client or JIRAClient(self.jira_base_url, self.jira_user, self.jira_password)
+
+            def upload_finished(upload_result):
+                if upload_result.span:
+                    run_metrics.add(upload_result.span)
+                if manifest and upload_result.succeeded():
+                    manifest.uploaded(Path(upload_result.filepath).name)
+
+            uploader = AsyncUploader(jira_client, jira_issue, loop, upload_callback=upload_finished)
+            logger.info("Uploading the files to {0} as soon as they are created, up to {1} at a time".format(jira_issue, jira_client.max_connections))
+
+        def upload(source):
+            filename = Path(str(source)).name
+            if manifest and manifest.is_uploaded(filename):
+                skipped_upload_filenames.append(filename)
+            else:
+                uploader.submit(source)
+
+        def write_sql_file():
+            # the SQL file is final once the query ran, so it is uploaded while the records are still being exported
+            if upload_from_memory:
+                sql_source = UploadSource(Path(sql_filepath).name, data=sql_statement.encode('utf-8'))
+            else:
+                sql_exporter = SQLFileWriter(sql_filepath, sql_statement)
+                with run_metrics.span(STAGE_SQL_FILE_WRITE) as sql_file_span:
+                    sql_exporter.write()
+                    sql_file_span.size = os.path.getsize(sql_filepath)
+                sql_source = sql_filepath
+            if uploader:
+                loop.call_soon_threadsafe(upload, sql_source)
+
+        def file_written(result):
+            if upload_from_memory:
+                upload(UploadSource(Path(result.filepath).name, data=result.data))
+            else:
+                upload(result.filepath)
+
+        try:
+            db = (self.database_class or Database)(self.db_connection_settings, self.connection_pool, metrics=run_metrics)
+            try:
+                if watermark_column:
+                    watermark = Watermark.load(watermark_filepath(split_output_extension(xlsx_filepath)[0]), watermark_column,
+                                               cache_key(self.db_connection_settings.name, sql_statement))
+                    if watermark.pending_statement:
+                        logger.info('Exporting the rows {0} again, the last export of them did not finish'.format(watermark.delta_range()))
+                        sql_statement = watermark.pending_statement
+                    else:
+                        delta_sql_statement, upper = await loop.run_in_executor(None, db.watermark_delta, sql_statement, watermark_column,
+                                                                                watermark.value)
+                        if delta_sql_statement is None:
+                            logger.info('There are no rows with {0} above {1}, nothing to export'.format(watermark_column, watermark.value))
+                            return
+                        watermark.begin(delta_sql_statement, upper)
+                        sql_statement = delta_sql_statement
+                    first_file_number = watermark.file_count + 1
+
+                if resume and not upload_from_memory:
+                    fingerprint = export_fingerprint(cache_key(self.db_connection_settings.name, sql_statement), output_format,
+                                                     'single_file' if single_file else xlsx_engine, chunk_size, max_file_size, sheet_name,
+                                                     exact_decimal_columns)
+                    manifest = ExportManifest.open(manifest_filepath(split_output_extension(xlsx_filepath)[0]), fingerprint)
+
+                plan = None
+                if preflight and not (manifest and manifest.is_exported()):
+                    estimate = await loop.run_in_executor(None, db.estimate, sql_statement)
+                    plan = plan_export(estimate, chunk_size, parallel_processes, stream, output_format, xlsx_engine, columnar, single_file,
+                                       max_file_size, self.preflight_max_rows, self.preflight_max_size)
+                    logger.info('{0}{1}'.format('Pre-flight plan:\n', plan.statistics_table()))
+                    if plan.violations and self.preflight_refuse:
+                        raise KranoPreflightError('The export exceeds the configured limits: {0}.'.format('; '.join(plan.violations)))
+                    for violation in plan.violations:
+                        logger.warning('The export exceeds a configured limit: {0}'.format(violation))
+                    stream = plan.stream
+                    # the worker pool, the exporters and the decorations all use the planned count of processes
+                    parallel_processes = plan.parallel_processes
+
+                worker_pool = self._get_worker_pool(parallel_processes)
+                delta_range = watermark.delta_range() if watermark else None
+                if manifest and manifest.is_exported():
+                    # An earlier run created all files and died while decorating or uploading them, so the query is not executed again
+                    logger.info('All {0} file(s) were created by an earlier run, continuing with the decoration and upload'.format(len(manifest.filepaths())))
+                    exported_xlsx_filepaths = manifest.filepaths()
+                    last_file_number = manifest.last_file_number()
+                    xlsx_decorations = await resolve_decorations(manifest.query_duration, delta_range)
+                    await loop.run_in_executor(None, write_sql_file)
+                    uploaded_while_exporting = False
+                else:
+                    def run_query():
+                        if partitions > 1:
+                            return db.query_partitioned(sql_statement, partitions, partition_column, partition_method, stream=stream,
+                                                        fetch_size=min(chunk_size, 10000), fetch_method=fetch_method, columnar=columnar)
+                        return db.query(sql_statement, stream=stream, fetch_size=min(chunk_size, 10000), fetch_method=fetch_method, columnar=columnar)
+
+                    if self.result_cache:
+                        result = await loop.run_in_executor(None, lambda: self.result_cache.query(self.db_connection_settings.name, sql_statement,
+                                                                                                  run_query, stream=stream, mode=cache_mode,
+                                                                                                  columnar=columnar))
+                    else:
+                        result = await loop.run_in_executor(None, run_query)
+
+                    if result.isempty():
+                        logger.info('The result from the database is empty')
+                        if watermark:
+                            # e.g. the rows were deleted after the highest value was looked up, the range is done nonetheless
+                            watermark.commit(watermark.file_count)
+                        if manifest:
+                            manifest.remove()
+                        return
+
+                    sql_statement = result.sql_statement
+                    progress = ExportProgress(plan.estimate.rows) if plan else None
+                    xlsx_decorations = await resolve_decorations(result.query_duration, delta_range)
+                    await loop.run_in_executor(None, write_sql_file)
+
+                    if self.decorate_existing_files and not upload_from_memory:
+                        inline_decorations = None
+                    else:
+                        inline_decorations = xlsx_decorations
+
+                    # files decorated afterwards are only uploaded once they were decorated
+                    uploaded_while_exporting = bool(uploader) and not (xlsx_decorations and inline_decorations is None)
+                    file_callback = (lambda res: loop.call_soon_threadsafe(file_written, res)) if uploaded_while_exporting else None
+
+                    if single_file:
+                        xlsx_exporter = SingleFileExcelExporter(xlsx_filepath, result, sheet_name, overwrite_files, parallel_processes=parallel_processes,
+                                                                part_size=chunk_size, decorations=inline_decorations, handoff=chunk_handoff,
+                                                                pool=worker_pool, in_memory=upload_from_memory, metrics=run_metrics, retries=retries,
+                                                                manifest=manifest, first_file_number=first_file_number,
+                                                                exact_decimal_columns=exact_decimal_columns, file_callback=file_callback,
+                                                                progress=progress)
+                    else:
+                        xlsx_exporter = ExcelExporter(xlsx_filepath, result, chunk_size, sheet_name, overwrite_files, parallel_processes=parallel_processes,
+                                                      engine=xlsx_engine, decorations=inline_decorations, handoff=chunk_handoff, pool=worker_pool,
+                                                      output_format=output_format, in_memory=upload_from_memory,
+                                                      max_file_size=max_file_size, metrics=run_metrics, retries=retries, manifest=manifest,
+                                                      first_file_number=first_file_number, exact_decimal_columns=exact_decimal_columns,
+                                                      file_callback=file_callback, progress=progress)
+                    xlsx_exporter_result = await loop.run_in_executor(None, xlsx_exporter.export)
+
+                    if xlsx_exporter_result.has_errros():
+                        logger.error('The Excel export process encountered the following errors:')
+                        for excel_export_process_error in xlsx_exporter_result.excel_export_process_errors:
+                            logger.error('Process name: {0} | Filepath: {1} | Error message: {2}'.format(excel_export_process_error.excel_export_process.process_name,
+                                                                                                         excel_export_process_error.excel_export_process.filepath,
+                                                                                                         excel_export_process_error.message))
+                        if manifest:
+                            logger.error('Rerun the export to create only the failed files again, the progress is recorded in {0}'.format(manifest.filepath))
+                        raise KranoExportError('The Excel export process encountered errors.')
+
+                    exported_xlsx_filepaths = [res.filepath for res in xlsx_exporter_result.excel_export_process_results]
+                    last_file_number = xlsx_exporter_result.last_file_number
+                    if progress:
+                        progress.finish()
+            finally:
+                db.close()
+
+            if uploaded_while_exporting:
+                logger.info('{0} of {1} upload(s) to {2} finished while the files were created'.format(
+                    len([task for task in uploader.tasks if task.done()]), len(uploader.tasks), jira_issue))
+
+            if xlsx_decorations and self.decorate_existing_files and not upload_from_memory:
+                undecorated_filepaths = [filepath for filepath in exported_xlsx_filepaths if not (manifest and manifest.is_decorated(filepath))]
+                excel_decorator_manager = ExcelDecorationManager(undecorated_filepaths, xlsx_decorations, parallel_processes=parallel_processes,
+                                                                 pool=worker_pool, metrics=run_metrics)
+                xlsx_decorator_result = await loop.run_in_executor(None, excel_decorator_manager.decorate)
+                if manifest:
+                    for decoration_result in xlsx_decorator_result.excel_decoration_process_results:
+                        manifest.chunk_decorated(decoration_result.filepath, os.path.getsize(decoration_result.filepath),
+                                                 file_checksum(decoration_result.filepath))
+
+                if xlsx_decorator_result.has_errros():
+                    logger.error('The Excel decoration process encountered the following errors:')
+                    for excel_decoration_process_error in xlsx_decorator_result.excel_decoration_process_errors:
+                        logger.error('Process name: {0} | Filepath: {1} | Error message: {2}'.format(excel_decoration_process_error.excel_decorator.process_name,
+                                                                                                     excel_decoration_process_error.excel_decorator.filepath,
+                                                                                                     excel_decoration_process_error.message))
+                    raise KranoDecorationError('The Excel decoration process encountered errors.')
+
+            if uploader:
+                if not uploaded_while_exporting:
+                    for filepath in exported_xlsx_filepaths:
+                        upload(filepath)
+                upload_results = await uploader.wait()
+
+            if jira_issue:
+                if skipped_upload_filenames:
+                    logger.info('{0} file(s) were already uploaded to {1} by an earlier run, skipping them'.format(len(skipped_upload_filenames), jira_issue))
+
+                uploaded_filepaths = [upload_result.filepath for upload_result in upload_results if upload_result.succeeded()]
+                failed_upload_results = [upload_result for upload_result in upload_results if not upload_result.succeeded()]
+
+                if manifest:
+                    # also mention the files uploaded by an earlier run which died before it could comment on them
+                    filenames_to_comment = manifest.uncommented()
+                else:
+                    filenames_to_comment = [Path(filepath).name for filepath in uploaded_filepaths]
+                # the uploads finish in any order, the comment lists the files in the order of the export
+                file_order = [Path(filepath).name for filepath in exported_xlsx_filepaths + [sql_filepath]]
+                filenames_to_comment.sort(key=lambda filename: file_order.index(filename) if filename in file_order else len(file_order))
+
+                if filenames_to_comment:
+                    upload_filenames = [' [^' + filename + ']' for filename in filenames_to_comment]
+                    comment_filenames = '\n'.join(upload_filenames)
+                    comment = 'The Python script krano attached the following {0} file(s) to this JIRA issue: \n\n{1}'.format(len(upload_filenames), comment_filenames)
+                    jira_commenter = JIRACommenter(self.jira_base_url, self.jira_user, self.jira_password, client=jira_client)
+                    with run_metrics.span(STAGE_COMMENT):
+                        await loop.run_in_executor(None, jira_commenter.comment, jira_issue, comment)
+                    if manifest:
+                        manifest.commented(filenames_to_comment)
+
+                if failed_upload_results:
+                    logger.error('The upload to JIRA encountered the following errors:')
+                    for upload_result in failed_upload_results:
+                        logger.error('Filepath: {0} | Attempts: {1} | Error message: {2}'.format(upload_result.filepath, upload_result.attempts, upload_result.error))
+                    raise KranoUploadError('{0} of {1} file(s) could not be uploaded to JIRA.'.format(len(failed_upload_results), len(upload_results)))
+        except Exception:
+            if uploader and uploader.tasks:
+                # the files uploaded so far stay attached, a rerun with resume skips them
+                upload_results = await uploader.wait()
+                logger.error('{0} file(s) were attached to {1} before the export failed'.format(
+                    len([upload_result for upload_result in upload_results if upload_result.succeeded()]), jira_issue))
+            raise
+        finally:
+            if uploader:
+                uploader.close()
+            if jira_client and jira_client is not self.jira_client:
+                jira_client.close()
+
+        if watermark:
+            # files skipped because they already existed keep their numbers as well
+            watermark.commit(watermark.file_count if last_file_number is None else last_file_number)
+        if manifest:
+            manifest.remove()
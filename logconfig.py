@@ -0,0 +1,11 @@
+#/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+
+LOG_FORMAT = '%(asctime)s %(name)-12s %(levelname)-8s %(message)s'
+
+
+def configure_logging(level=logging.INFO):
+    """Logs to stderr in the format of krano, called by the entry points and the worker processes, not on import."""
+    logging.basicConfig(level=level, format=LOG_FORMAT)
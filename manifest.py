@@ -0,0 +1,285 @@
+#/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+import hashlib
+import json
+import os
+import tempfile
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from threading import RLock
+
+MANIFEST_VERSION = 1
+MANIFEST_EXTENSION = '.manifest.json'
+
+CHUNK_PENDING = 'pending'
+CHUNK_WRITTEN = 'written'
+CHUNK_FAILED = 'failed'
+
+
+def manifest_filepath(filepath_part):
+    """Returns the file path of the manifest for the files starting with the given path, e.g. '/exports/orders'."""
+    return filepath_part + MANIFEST_EXTENSION
+
+
+def export_fingerprint(query_key, output_format, engine, chunk_size, max_file_size, sheet_name, exact_decimal_columns=None):
+    """Returns a fingerprint of everything that determines the content and the boundaries of the files of an export.
+
+    Args:
+        query_key (str): The fingerprint of the connection and the SQL query, see cache.cache_key().
+        output_format (str): The output format.
+        engine (str): The XLSX writer engine.
+        chunk_size (int): The maximum count of rows per file.
+        max_file_size (int): The maximum size of a file in bytes, or None.
+        sheet_name (str): The name of the worksheet containing the records.
+        exact_decimal_columns (list): Names of NUMERIC columns written as text, defaults to None.
+    """
+    parts = [query_key, output_format, engine, str(chunk_size), str(max_file_size), sheet_name]
+    if exact_decimal_columns:
+        parts.append(','.join(sorted(exact_decimal_columns)))
+    return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+def write_atomically(filepath, content):
+    """Writes text into a temporary file next to filepath first and moves it into place, so a crash never leaves a half written
+    file behind and readers never see one.
+
+    Args:
+        filepath (str): File path of the file to be written, missing folders are created.
+        content (str): The text to be written.
+    """
+    folderpath = os.path.dirname(os.path.abspath(filepath))
+    os.makedirs(folderpath, exist_ok=True)
+    descriptor, temp_filepath = tempfile.mkstemp(dir=folderpath, prefix='.krano-', suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'w', encoding='utf-8') as temp_file:
+            temp_file.write(content)
+        os.chmod(temp_filepath, 0o644)
+        os.replace(temp_filepath, filepath)
+    except Exception:
+        os.remove(temp_filepath)
+        raise
+
+
+def file_checksum(filepath, block_size=1048576):
+    """Returns the SHA-256 checksum of a file, read in blocks of block_size bytes."""
+    checksum = hashlib.sha256()
+    with open(filepath, 'rb') as a_file:
+        for block in iter(lambda: a_file.read(block_size), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+class ExportManifest(object):
+    """Records the progress of an export next to its files, so a rerun only redoes what is missing.
+
+    The manifest lists the boundaries, file paths, sizes and checksums of the chunks, whether the files were decorated,
+    uploaded and mentioned in the JIRA comment. A rerun of the same export (same fingerprint) reuses every file whose size
+    and checksum still match, follows the recorded chunk boundaries and skips the uploads that already succeeded. The
+    manifest is removed once the export finished completely. It is saved after every change, so it survives a crash.
+
+    Args:
+        filepath (str): File path of the manifest.
+        fingerprint (str): The fingerprint of the export, see export_fingerprint().
+    """
+    def __init__(self, filepath, fingerprint):
+        self.filepath = filepath
+        self.fingerprint = fingerprint
+        self.lock = RLock()
+        self._reset()
+
+    @classmethod
+    def open(cls, filepath, fingerprint):
+        """Loads the manifest of an earlier run of the same export, or starts a new one.
+
+        A manifest of a different export, e.g. with another SQL query or chunk size, or one that cannot be read is replaced.
+        """
+        manifest = cls(filepath, fingerprint)
+        if not os.path.isfile(filepath):
+            return manifest
+
+        try:
+            with open(filepath, encoding='utf-8') as manifest_file:
+                data = json.load(manifest_file)
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring the unreadable export manifest {0}: {1}".format(filepath, str(e)))
+            return manifest
+
+        if data.get('version') != MANIFEST_VERSION or data.get('fingerprint') != fingerprint:
+            logger.info("Ignoring the export manifest {0} of a different export".format(filepath))
+            return manifest
+
+        manifest.data = data
+        logger.info("Resuming the export of {0}: {1} of {2} recorded file(s) written, {3} uploaded".format(
+            data['started_at'], len([chunk for chunk in data['chunks'].values() if chunk['status'] == CHUNK_WRITTEN]), len(data['chunks']),
+            len(data['uploaded'])))
+        return manifest
+
+    def _reset(self):
+        # the files of the chunks forgotten by a reset were still created by this export and may be written again
+        owned = self.owned_filepaths() if hasattr(self, 'data') else []
+        self.data = {'version': MANIFEST_VERSION,
+                     'fingerprint': self.fingerprint,
+                     'started_at': datetime.now(timezone.utc).isoformat(),
+                     'record_count': None,
+                     'query_duration': None,
+                     'exported': False,
+                     'chunks': {},
+                     'uploaded': [],
+                     'commented': [],
+                     'owned': owned}
+
+    def start(self, record_count):
+        """Starts over if the query returned a different count of records than in the earlier run."""
+        with self.lock:
+            recorded_count = self.data['record_count']
+            if record_count is not None and recorded_count is not None and record_count != recorded_count:
+                logger.info("The query now returns {0} instead of {1} records, creating all files again".format(record_count, recorded_count))
+                self._reset()
+            if record_count is not None:
+                self.data['record_count'] = record_count
+            self.save()
+
+    def chunk_sizes(self):
+        """Returns the row counts of the recorded chunks in the order of their numbers, up to the first gap."""
+        sizes = []
+        numbers = sorted(int(number) for number in self.data['chunks'])
+        for number in range(numbers[0], numbers[0] + len(numbers)) if numbers else []:
+            chunk = self.data['chunks'].get(str(number))
+            if chunk is None:
+                break
+            sizes.append(chunk['row_count'])
+        return sizes
+
+    def chunk(self, number):
+        """Returns the record of the chunk with the given number, None if it is not recorded."""
+        return self.data['chunks'].get(str(number))
+
+    def owned_filepaths(self):
+        """Returns the file paths of all chunks this export ever planned, also of those dropped when it started over."""
+        filepaths = self.data.get('owned', []) + [chunk['filepath'] for chunk in self.data['chunks'].values()]
+        return sorted(set(filepaths))
+
+    def owns(self, filepath):
+        """Indicates whether the file was created by an earlier run of this export, e.g. a truncated leftover of a crash.
+
+        Files at the paths of chunks that this export does not own belong to someone else and must not be overwritten.
+        """
+        return filepath in self.owned_filepaths()
+
+    def is_chunk_valid(self, number, filepath, row_count):
+        """Indicates whether the chunk was written completely before and its file is still unchanged."""
+        chunk = self.chunk(number)
+        if chunk is None or chunk['status'] != CHUNK_WRITTEN or chunk['filepath'] != filepath or chunk['row_count'] != row_count:
+            return False
+        return self._is_file_valid(chunk)
+
+    def _is_file_valid(self, chunk):
+        if not os.path.isfile(chunk['filepath']) or os.path.getsize(chunk['filepath']) != chunk['size']:
+            return False
+        return file_checksum(chunk['filepath']) == chunk['checksum']
+
+    def plan_chunk(self, number, row_start, row_count, filepath):
+        """Records a chunk that is about to be written, forgetting an earlier upload of its file."""
+        with self.lock:
+            self.data['chunks'][str(number)] = {'row_start': row_start, 'row_count': row_count, 'filepath': filepath, 'status': CHUNK_PENDING,
+                                                'size': None, 'checksum': None, 'decorated': False, 'error': None}
+            self._forget_upload(filepath)
+            self.save()
+
+    def chunk_written(self, number, size, checksum, decorated=False):
+        """Records that the file of a chunk was written completely."""
+        with self.lock:
+            chunk = self.data['chunks'][str(number)]
+            chunk.update(status=CHUNK_WRITTEN, size=size, checksum=checksum, decorated=decorated, error=None)
+            self.save()
+
+    def chunk_failed(self, number, error):
+        """Records that the file of a chunk could not be written."""
+        with self.lock:
+            chunk = self.data['chunks'][str(number)]
+            chunk.update(status=CHUNK_FAILED, error=error)
+            self.save()
+
+    def chunk_decorated(self, filepath, size, checksum):
+        """Records that the file of a chunk was decorated afterwards, which changed its size and checksum."""
+        with self.lock:
+            for chunk in self.data['chunks'].values():
+                if chunk['filepath'] == filepath:
+                    chunk.update(size=size, checksum=checksum, decorated=True)
+            self.save()
+
+    def is_decorated(self, filepath):
+        return any(chunk['filepath'] == filepath and chunk['decorated'] for chunk in self.data['chunks'].values())
+
+    def finish_export(self, file_count, query_duration):
+        """Records that all files were written, dropping chunks beyond the given count of files left over from an earlier run.
+
+        Args:
+            file_count (int): The count of files of the export.
+            query_duration (datetime.timedelta): The execution time of the SQL query, e.g. for the decorations of a resumed run.
+        """
+        with self.lock:
+            self.data['chunks'] = {number: chunk for number, chunk in self.data['chunks'].items() if int(number) <= file_count}
+            self.data['exported'] = True
+            self.data['query_duration'] = None if query_duration is None else query_duration.total_seconds()
+            self.save()
+
+    @property
+    def query_duration(self):
+        """The execution time of the SQL query of the run that wrote the files, None if it is not known."""
+        seconds = self.data['query_duration']
+        return None if seconds is None else timedelta(seconds=seconds)
+
+    def is_exported(self):
+        """Indicates whether an earlier run wrote all files and all of them are still unchanged."""
+        if not self.data['exported']:
+            return False
+        return all(chunk['status'] == CHUNK_WRITTEN and self._is_file_valid(chunk) for chunk in self.data['chunks'].values())
+
+    def last_file_number(self):
+        """Returns the highest number of the recorded chunks, None if there are none."""
+        return max((int(number) for number in self.data['chunks']), default=None)
+
+    def filepaths(self):
+        """Returns the file paths of the chunks in the order of their numbers."""
+        return [self.data['chunks'][number]['filepath'] for number in sorted(self.data['chunks'], key=int)]
+
+    def is_uploaded(self, filename):
+        return filename in self.data['uploaded']
+
+    def uploaded(self, filename):
+        """Records that the file with the given name was attached to the JIRA issue."""
+        with self.lock:
+            if filename not in self.data['uploaded']:
+                self.data['uploaded'].append(filename)
+            self.save()
+
+    def uncommented(self):
+        """Returns the names of the uploaded files that were not mentioned in a JIRA comment yet."""
+        return [filename for filename in self.data['uploaded'] if filename not in self.data['commented']]
+
+    def commented(self, filenames):
+        """Records that the files with the given names were mentioned in a JIRA comment."""
+        with self.lock:
+            self.data['commented'].extend(filename for filename in filenames if filename not in self.data['commented'])
+            self.save()
+
+    def _forget_upload(self, filepath):
+        filename = os.path.basename(filepath)
+        self.data['uploaded'] = [name for name in self.data['uploaded'] if name != filename]
+        self.data['commented'] = [name for name in self.data['commented'] if name != filename]
+
+    def save(self):
+        """Writes the manifest atomically, see write_atomically()."""
+        with self.lock:
+            self.data['updated_at'] = datetime.now(timezone.utc).isoformat()
+            write_atomically(self.filepath, json.dumps(self.data, indent=2))
+
+    def remove(self):
+        """Deletes the manifest once the export finished completely."""
+        if os.path.isfile(self.filepath):
+            os.remove(self.filepath)
@@ -0,0 +1,316 @@
+#/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+import json
+import os
+import re
+import sys
+import time
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from threading import Lock
+from manifest import write_atomically
+try:
+    import resource
+except ImportError:
+    resource = None
+
+STAGE_CONNECT = 'connect'
+STAGE_EXECUTE = 'execute'
+STAGE_FETCH = 'fetch'
+STAGE_HANDOFF = 'handoff'
+STAGE_NORMALISE = 'normalise'
+STAGE_FRAME_BUILD = 'frame_build'
+STAGE_WRITE = 'write'
+STAGE_DECORATE = 'decorate'
+STAGE_SQL_FILE_WRITE = 'sql_file_write'
+STAGE_UPLOAD = 'upload'
+STAGE_COMMENT = 'comment'
+STAGES = [STAGE_CONNECT, STAGE_EXECUTE, STAGE_FETCH, STAGE_HANDOFF, STAGE_NORMALISE, STAGE_FRAME_BUILD, STAGE_WRITE, STAGE_DECORATE,
+          STAGE_SQL_FILE_WRITE, STAGE_UPLOAD, STAGE_COMMENT]
+
+RUN_SUCCEEDED = 'succeeded'
+RUN_FAILED = 'failed'
+
+REPORT_VERSION = 1
+PROMETHEUS_PREFIX = 'krano'
+PROMETHEUS_UNSAFE_CHARACTERS = re.compile(r'[^A-Za-z0-9_.-]')
+
+
+def peak_rss_bytes():
+    """Returns the peak resident set size of the current process in bytes, None where it cannot be determined."""
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+def elapsed(start_time):
+    """Returns the time passed since the given time.perf_counter() value as a timedelta, to the millisecond."""
+    return timedelta(seconds=round(time.perf_counter() - start_time, 3))
+
+
+def _per_second(amount, duration):
+    if amount is None or not duration:
+        return None
+    return amount / duration
+
+
+class Span(object):
+    """The measurement of one stage of an export, e.g. the fetch of the records or the creation of one file.
+
+    Args:
+        stage (str): The name of the stage, one of STAGES.
+        duration (float): The seconds spent in the stage.
+        rows (int): The count of rows processed, defaults to None.
+        size (int): The count of bytes processed, e.g. the size of the created file, defaults to None.
+        chunk (int): The number of the chunk (file) the span belongs to, defaults to None.
+        error (str): The error the stage failed with, defaults to None.
+        started (float): The start as seconds since the epoch, defaults to now minus the duration.
+        worker (int): The process id of the process that ran the stage, defaults to the current process.
+        peak_rss (int): The peak resident set size in bytes of that process, defaults to the one of the current process.
+    """
+    def __init__(self, stage, duration, rows=None, size=None, chunk=None, error=None, started=None, worker=None, peak_rss=None):
+        self.stage = stage
+        self.duration = duration
+        self.rows = rows
+        self.size = size
+        self.chunk = chunk
+        self.error = error
+        self.started = time.time() - duration if started is None else started
+        self.worker = os.getpid() if worker is None else worker
+        self.peak_rss = peak_rss_bytes() if peak_rss is None else peak_rss
+
+    @property
+    def rows_per_second(self):
+        return _per_second(self.rows, self.duration)
+
+    @property
+    def bytes_per_second(self):
+        return _per_second(self.size, self.duration)
+
+    def to_dict(self):
+        return {'stage': self.stage, 'chunk': self.chunk, 'worker': self.worker, 'started': self.started, 'duration': self.duration,
+                'rows': self.rows, 'bytes': self.size, 'rows_per_second': self.rows_per_second, 'bytes_per_second': self.bytes_per_second,
+                'peak_rss_bytes': self.peak_rss, 'error': self.error}
+
+    def __repr__(self):
+        return "<Span stage={0} chunk={1} duration={2:.3f}s>".format(self.stage, self.chunk, self.duration)
+
+
+class SpanTimer(object):
+    """Measures the time spent in a with block with time.perf_counter() and turns it into a Span.
+
+    The rows and size attributes can be set within the block. When the block is left, the span is stored in the span
+    attribute and passed to the callback, a failed block is recorded with its error.
+
+    Args:
+        stage (str): The name of the stage, one of STAGES.
+        callback (callable): Called with the Span, e.g. RunMetrics.add, defaults to None.
+        rows (int): The count of rows processed, defaults to None.
+        size (int): The count of bytes processed, defaults to None.
+        chunk (int): The number of the chunk (file) the span belongs to, defaults to None.
+    """
+    def __init__(self, stage, callback=None, rows=None, size=None, chunk=None):
+        self.stage = stage
+        self.callback = callback
+        self.rows = rows
+        self.size = size
+        self.chunk = chunk
+        self.span = None
+
+    def __enter__(self):
+        self.started = time.time()
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        error = None if exc_type is None else '{0}: {1}'.format(exc_type.__name__, exc_val)
+        self.span = Span(self.stage, time.perf_counter() - self.start_time, self.rows, self.size, self.chunk, error, self.started)
+        if self.callback:
+            self.callback(self.span)
+        return False
+
+
+def measure(stage, metrics=None, rows=None, size=None, chunk=None):
+    """Returns a SpanTimer for the given stage, which adds its span to the given RunMetrics, if any."""
+    return SpanTimer(stage, metrics.add if metrics is not None else None, rows, size, chunk)
+
+
+class RunMetrics(object):
+    """Collects the spans of one export and turns them into a run report.
+
+    Spans of the export processes are measured in the workers and added once their results arrive. The report
+    is written as JSON and optionally as a Prometheus textfile, e.g. for the textfile collector of the node exporter.
+
+    Args:
+        name (str): The name of the export, e.g. the filename without extension.
+        labels (dict): Further labels of the run, e.g. the connection name and the output format, defaults to None.
+    """
+    def __init__(self, name, labels=None):
+        self.name = name
+        self.labels = labels or {}
+        self.spans = []
+        self.started_at = datetime.now(timezone.utc)
+        self.start_time = time.perf_counter()
+        self.duration = None
+        self.status = None
+        self.lock = Lock()
+
+    def span(self, stage, rows=None, size=None, chunk=None):
+        """Returns a SpanTimer adding its span to this run."""
+        return measure(stage, self, rows, size, chunk)
+
+    def add(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def extend(self, spans):
+        with self.lock:
+            self.spans.extend(spans)
+
+    def finish(self, status):
+        """Stops the clock of the run.
+
+        Args:
+            status (str): 'succeeded' or 'failed'.
+        """
+        self.duration = time.perf_counter() - self.start_time
+        self.status = status
+
+    def stages(self):
+        """Returns the totals per stage, ordered like STAGES.
+
+        The duration is the sum over all spans of a stage, e.g. of all export processes, the wall duration the time
+        from the start of the first to the end of the last span. Rows and bytes per second refer to the wall duration.
+        """
+        with self.lock:
+            spans = list(self.spans)
+
+        stages = {}
+        for span in spans:
+            stage = stages.setdefault(span.stage, {'spans': 0, 'errors': 0, 'duration': 0.0, 'rows': None, 'bytes': None,
+                                                   'first_start': span.started, 'last_end': span.started + span.duration, 'peak_rss_bytes': None})
+            stage['spans'] += 1
+            stage['errors'] += 1 if span.error else 0
+            stage['duration'] += span.duration
+            if span.rows is not None:
+                stage['rows'] = (stage['rows'] or 0) + span.rows
+            if span.size is not None:
+                stage['bytes'] = (stage['bytes'] or 0) + span.size
+            stage['first_start'] = min(stage['first_start'], span.started)
+            stage['last_end'] = max(stage['last_end'], span.started + span.duration)
+            if span.peak_rss is not None:
+                stage['peak_rss_bytes'] = max(stage['peak_rss_bytes'] or 0, span.peak_rss)
+
+        ordered = {}
+        for name in sorted(stages, key=lambda name: STAGES.index(name) if name in STAGES else len(STAGES)):
+            stage = stages[name]
+            wall_duration = stage.pop('last_end') - stage.pop('first_start')
+            stage['wall_duration'] = wall_duration
+            stage['rows_per_second'] = _per_second(stage['rows'], wall_duration)
+            stage['bytes_per_second'] = _per_second(stage['bytes'], wall_duration)
+            ordered[name] = stage
+        return ordered
+
+    def report(self):
+        """Returns the run report as a dictionary, ready to be serialised as JSON."""
+        with self.lock:
+            spans = [span.to_dict() for span in sorted(self.spans, key=lambda span: span.started)]
+        peak_rss = [span['peak_rss_bytes'] for span in spans if span['peak_rss_bytes'] is not None]
+        return {'version': REPORT_VERSION,
+                'name': self.name,
+                'labels': self.labels,
+                'status': self.status,
+                'started_at': self.started_at.isoformat(),
+                'duration': self.duration,
+                'peak_rss_bytes': max(peak_rss) if peak_rss else None,
+                'stages': self.stages(),
+                'spans': spans}
+
+    def write_report(self, folderpath):
+        """Writes the run report as JSON into the given folder, named after the export and its start time.
+
+        Returns:
+            The file path of the report.
+        """
+        filename = '{0}_{1}.json'.format(self._safe_name(), self.started_at.strftime('%Y%m%d_%H%M%S'))
+        filepath = os.path.join(folderpath, filename)
+        write_atomically(filepath, json.dumps(self.report(), indent=2))
+        return filepath
+
+    def prometheus_text(self):
+        """Returns the metrics of the run in the Prometheus text exposition format."""
+        labels = dict(self.labels, export=self.name)
+        report = self.report()
+        lines = []
+
+        def add_metric(name, help_text, samples):
+            samples = [(sample_labels, value) for sample_labels, value in samples if value is not None]
+            if not samples:
+                return
+            lines.append('# HELP {0}_{1} {2}'.format(PROMETHEUS_PREFIX, name, help_text))
+            lines.append('# TYPE {0}_{1} gauge'.format(PROMETHEUS_PREFIX, name))
+            for sample_labels, value in samples:
+                lines.append('{0}_{1}{{{2}}} {3}'.format(PROMETHEUS_PREFIX, name, self._prometheus_labels(sample_labels), float(value)))
+
+        finished_at = self.started_at.timestamp() + (self.duration or 0)
+        add_metric('run_duration_seconds', 'Duration of the last export.', [(labels, self.duration)])
+        add_metric('run_success', 'Whether the last export succeeded.', [(labels, 1 if self.status == RUN_SUCCEEDED else 0)])
+        add_metric('run_finished_timestamp_seconds', 'End of the last export as seconds since the epoch.', [(labels, finished_at)])
+        add_metric('run_peak_rss_bytes', 'Highest peak resident set size of the processes of the last export.', [(labels, report['peak_rss_bytes'])])
+
+        stage_metrics = [('stage_duration_seconds', 'duration', 'Time spent in the stage, summed over all processes.'),
+                         ('stage_wall_duration_seconds', 'wall_duration', 'Time from the start of the first to the end of the last span of the stage.'),
+                         ('stage_spans', 'spans', 'Count of spans of the stage, e.g. files written.'),
+                         ('stage_errors', 'errors', 'Count of failed spans of the stage.'),
+                         ('stage_rows', 'rows', 'Rows processed by the stage.'),
+                         ('stage_bytes', 'bytes', 'Bytes processed by the stage.'),
+                         ('stage_rows_per_second', 'rows_per_second', 'Rows per second of wall duration.'),
+                         ('stage_bytes_per_second', 'bytes_per_second', 'Bytes per second of wall duration.'),
+                         ('stage_peak_rss_bytes', 'peak_rss_bytes', 'Highest peak resident set size of the processes running the stage.')]
+        for name, key, help_text in stage_metrics:
+            add_metric(name, help_text, [(dict(labels, stage=stage), values[key]) for stage, values in report['stages'].items()])
+
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, folderpath):
+        """Writes the metrics into a Prometheus textfile named after the export, replacing the one of the previous run.
+
+        Returns:
+            The file path of the textfile.
+        """
+        filepath = os.path.join(folderpath, '{0}_{1}.prom'.format(PROMETHEUS_PREFIX, self._safe_name()))
+        write_atomically(filepath, self.prometheus_text())
+        return filepath
+
+    def statistics_table(self):
+        """Returns the totals per stage as a PrettyTable."""
+        from prettytable import PrettyTable
+
+        pt = PrettyTable()
+        pt.field_names = ['Stage', 'Spans', 'Time (s)', 'Wall time (s)', 'Rows', 'Rows/s', 'MB', 'MB/s', 'Peak RSS (MB)']
+        for name, stage in self.stages().items():
+            pt.add_row([name,
+                         stage['spans'],
+                         '{0:.3f}'.format(stage['duration']),
+                         '{0:.3f}'.format(stage['wall_duration']),
+                         '' if stage['rows'] is None else stage['rows'],
+                         '' if stage['rows_per_second'] is None else int(stage['rows_per_second']),
+                         '' if stage['bytes'] is None else '{0:.2f}'.format(stage['bytes'] / 1024 ** 2),
+                         '' if stage['bytes_per_second'] is None else '{0:.2f}'.format(stage['bytes_per_second'] / 1024 ** 2),
+                         '' if stage['peak_rss_bytes'] is None else '{0:.1f}'.format(stage['peak_rss_bytes'] / 1024 ** 2)])
+        return pt
+
+    def _safe_name(self):
+        return PROMETHEUS_UNSAFE_CHARACTERS.sub('_', self.name)
+
+    def _prometheus_labels(self, labels):
+        escaped = []
+        for key in sorted(labels):
+            value = str(labels[key]).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            escaped.append('{0}="{1}"'.format(key, value))
+        return ','.join(escaped)
@@ -0,0 +1,110 @@
+#/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+from operator import methodcaller
+import pgtypes
+from writers import FORMAT_XLSX
+
+CONVERT_FLOAT = 'float'
+CONVERT_TEXT = 'text'
+CONVERT_NAIVE = 'naive'
+
+# The type OID a column has after the conversion, so the writers pick the matching write function
+CONVERTED_TYPE_CODES = {
+    CONVERT_FLOAT: pgtypes.FLOAT8_OID,
+    CONVERT_TEXT: pgtypes.TEXT_OID
+}
+NAIVE_TYPE_CODES = {
+    pgtypes.TIMESTAMPTZ_OID: pgtypes.TIMESTAMP_OID,
+    pgtypes.TIMETZ_OID: pgtypes.TIME_OID
+}
+
+_remove_timezone = methodcaller('replace', tzinfo=None)
+
+
+def _convert(values, function):
+    """Applies a function to all non-NULL values of a column, mapping it over the whole column if it contains no NULL."""
+    if None not in values:
+        return list(map(function, values))
+    return [None if value is None else function(value) for value in values]
+
+
+CONVERSIONS = {
+    CONVERT_FLOAT: lambda values: _convert(values, float),
+    CONVERT_TEXT: lambda values: _convert(values, str),
+    CONVERT_NAIVE: lambda values: _convert(values, _remove_timezone)
+}
+
+
+def xlsx_conversion(type_code, exact_decimal=False):
+    """Returns the conversion of a column with the given type OID before it is written into an XLSX file, None if it needs none.
+
+    Excel stores every number as a double, so a NUMERIC column is converted to float, which is what Excel keeps of it anyway,
+    up to the 16th significant digit written into the file. With exact_decimal it is written as text instead, keeping all digits. Excel has no time zones, timestamptz and timetz
+    values are written with the wall time of the session time zone. Arrays and JSON values are written as their string representation.
+    """
+    if type_code == pgtypes.NUMERIC_OID:
+        return CONVERT_TEXT if exact_decimal else CONVERT_FLOAT
+    if type_code in (pgtypes.TIMESTAMPTZ_OID, pgtypes.TIMETZ_OID):
+        return CONVERT_NAIVE
+    if type_code in pgtypes.ARRAY_OIDS or type_code in pgtypes.JSON_OIDS:
+        return CONVERT_TEXT
+    return None
+
+
+class ColumnNormaliser(object):
+    """Converts the values of a chunk column by column into the types the writer of the output format handles fastest.
+
+    psycopg2 returns NUMERIC columns as Decimal, timestamptz columns as datetimes with a time zone and arrays as lists, which
+    the XLSX writers otherwise convert cell by cell. The conversions are chosen once from the PostgreSQL type OIDs and every
+    column is converted in one pass, mapping a C implemented function over it. Only XLSX files are normalised, CSV and Parquet
+    files keep the exact values.
+
+    Args:
+        conversions (list): The conversion of every column, one of 'float', 'text', 'naive' or None, see xlsx_conversion().
+        column_type_codes (list): The PostgreSQL type OIDs of the columns.
+    """
+    def __init__(self, conversions, column_type_codes):
+        self.conversions = conversions
+        self.column_type_codes = column_type_codes
+
+    @classmethod
+    def for_output(cls, output_format, column_names, column_type_codes, exact_decimal_columns=None):
+        """Returns the normaliser for the records of a query written in the given output format, None if no column needs converting.
+
+        Args:
+            output_format (str): The output format, one of writers.OUTPUT_FORMATS.
+            column_names (list): The column names of the query result.
+            column_type_codes (list): The PostgreSQL type OIDs of the columns, None if they are not known.
+            exact_decimal_columns (list): Names of NUMERIC columns written as text with all their digits instead of as numbers, defaults to None.
+        """
+        if output_format != FORMAT_XLSX or not column_type_codes:
+            return None
+
+        exact_decimal_columns = set(exact_decimal_columns or [])
+        unknown_columns = exact_decimal_columns.difference(column_names)
+        if unknown_columns:
+            logger.warning("The exact decimal column(s) {0} are not part of the query result".format(', '.join(sorted(unknown_columns))))
+
+        conversions = [xlsx_conversion(type_code, column_name in exact_decimal_columns)
+                       for column_name, type_code in zip(column_names, column_type_codes)]
+        if not any(conversions):
+            return None
+        return cls(conversions, column_type_codes)
+
+    def converted_type_codes(self):
+        """Returns the PostgreSQL type OIDs of the columns after the conversion."""
+        return [NAIVE_TYPE_CODES[type_code] if conversion == CONVERT_NAIVE else CONVERTED_TYPE_CODES.get(conversion, type_code)
+                for conversion, type_code in zip(self.conversions, self.column_type_codes)]
+
+    def normalise(self, records):
+        """Returns the records (an iterable of tuples) as a list of tuples with the converted columns."""
+        columns = list(zip(*records))
+        if not columns:
+            return list(records)
+        for index, conversion in enumerate(self.conversions):
+            if conversion:
+                columns[index] = CONVERSIONS[conversion](columns[index])
+        return list(zip(*columns))
@@ -0,0 +1,53 @@
+#/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# PostgreSQL type OIDs as found in the type_code of cursor.description
+BOOL_OID = 16
+BYTEA_OID = 17
+INT8_OID = 20
+INT2_OID = 21
+INT4_OID = 23
+TEXT_OID = 25
+OID_OID = 26
+JSON_OID = 114
+FLOAT4_OID = 700
+FLOAT8_OID = 701
+BPCHAR_OID = 1042
+VARCHAR_OID = 1043
+DATE_OID = 1082
+TIME_OID = 1083
+TIMESTAMP_OID = 1114
+TIMESTAMPTZ_OID = 1184
+NUMERIC_OID = 1700
+UUID_OID = 2950
+JSONB_OID = 3802
+TIMETZ_OID = 1266
+
+# Array types, returned by psycopg2 as Python lists
+ARRAY_OIDS = (
+    199,   # json[]
+    1000,  # bool[]
+    1001,  # bytea[]
+    1005,  # int2[]
+    1007,  # int4[]
+    1009,  # text[]
+    1014,  # bpchar[]
+    1015,  # varchar[]
+    1016,  # int8[]
+    1021,  # float4[]
+    1022,  # float8[]
+    1028,  # oid[]
+    1115,  # timestamp[]
+    1182,  # date[]
+    1183,  # time[]
+    1185,  # timestamptz[]
+    1231,  # numeric[]
+    2951,  # uuid[]
+    3807   # jsonb[]
+)
+
+INTEGER_OIDS = (INT2_OID, INT4_OID, INT8_OID, OID_OID)
+FLOAT_OIDS = (FLOAT4_OID, FLOAT8_OID)
+NUMBER_OIDS = INTEGER_OIDS + FLOAT_OIDS + (NUMERIC_OID,)
+STRING_OIDS = (TEXT_OID, BPCHAR_OID, VARCHAR_OID)
+JSON_OIDS = (JSON_OID, JSONB_OID)
@@ -1,140 +1,1117 @@
-#/usr/bin/python
-# -*- coding: utf-8 -*-
-
-import logging
-logging.basicConfig(level=logging.INFO,
-                    format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
-logger = logging.getLogger(__name__)
-from datetime import datetime
-import psycopg2
-import psycopg2.extensions
-psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
-psycopg2.extensions.register_type(psycopg2.extensions.UNICODEARRAY)
-
-
-class ConnectionSettings(object):
-    """Encapsulates the specific connection settings for a PostgreSQL database connection.
-
-    Args:
-        name (str): Name for the connection settings.
-        host (str): Host of the database server.
-        database_name (str): Name of the database.
-        username (str): Name of the database user.
-        password (str): Password of the database user.
-        application_name (str): Application name for the database connection, defaults to 'krano'.
-        client_encoding (str): Encoding to be used fpr the database connection, defaults to 'utf-8'.
-
-    Raises:
-        ValueError: One of the non-optional arguments is not available.
-    """
-
-    def __init__(self, name, host, database_name, username, password, application_name='krano', client_encoding='utf-8'):
-        self.name = name
-        self.host = host
-        self.database_name = database_name
-        self.username = username
-        self.password = password
-        self.application_name = application_name
-        self.client_encoding = client_encoding
-
-        if not self.name:
-            raise ValueError('You must provide a name for the connection setting.')
-
-        if not self.host:
-            raise ValueError('You must provide a host for the connection setting.')
-
-        if not self.database_name:
-            raise ValueError('You must provide a database_name for the connection setting.')
-
-        if not self.username:
-            raise ValueError('You must provide a username for the connection setting.')
-
-        if not self.password:
-            raise ValueError('You must provide a password for the connection setting.')
-
-    def __repr__(self):
-        repr = "<ConnectionSettings name={0}>".format(self.name)
-        return repr
-
-
-class QueryResult(object):
-    """Stores the result of a executed query.
-
-    Args:
-        sql_statement (str): The SQL query that was used to fetch the records.
-        records (list): A list of rows (tuples) fetched with the SQL query.
-        column_names (list): A list containing the column names for the records.
-        query_duration (datetime.timedelta): Execution time of the SQL query.
-    """
-    def __init__(self, sql_statement, records, column_names, query_duration):
-        self.sql_statement = sql_statement
-        self.records = records
-        self.column_names = column_names
-        self.query_duration = query_duration
-        self.record_count = len(self.records)
-
-    def isempty(self):
-        """Indicates if the list of rows is empty or not."""
-        return self.record_count == 0
-
-
-class Database(object):
-    """Connects to a PostgreSQL Database and executes given SQL queries.
-
-    Args:
-        connection_settings (ConnectionSettings): An instance of a ConnectionSettings object.
-    """
-    def __init__(self, connection_settings):
-        self.connection_settings = connection_settings
-        self.connection = None
-
-        if not self.connection_settings:
-            raise ValueError('You must provide connection settings.')
-
-    def _get_connection(self):
-        if self.connection:
-            return self.connection
-
-        logger.info("Opening database connection to {0}...".format(self.connection_settings.name))
-        self.connection = psycopg2.connect(host=self.connection_settings.host, dbname=self.connection_settings.database_name,
-                                           user=self.connection_settings.username, password=self.connection_settings.password,
-                                           application_name=self.connection_settings.application_name)
-        self.connection.set_client_encoding('utf-8')
-
-        return self.connection
-
-    def query(self, sql_statement):
-        """Executes the SQL query against the database and returns the result.
-
-        Returns:
-            An instance of a QueryResult object containing the results of the executed query.
-        """
-        conn = self._get_connection()
-        logger.info("Executing SQL query against database {0}...".format(self.connection_settings.name))
-
-        cursor = conn.cursor()
-        query_start_time = datetime.now().replace(microsecond=0)
-
-        cursor.execute(sql_statement)
-        conn.commit()
-        records = cursor.fetchall()
-
-        query_end_time = datetime.now().replace(microsecond=0)
-        query_duration = query_end_time - query_start_time
-
-        column_names = [column[0] for column in cursor.description]
-        query_result = QueryResult(sql_statement, records, column_names, query_duration)
-        logger.info("Fetched {0} records from the database {1}".format(query_result.record_count, self.connection_settings.name))
-
-        return query_result
-
-    def close(self):
-        if self.connection:
-            logger.info("Closing database connection to {0}...".format(self.connection_settings.name))
-            self.connection.close()
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
+#/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+import io
+import re
+import struct
+from datetime import date
+from datetime import datetime
+from datetime import time
+from datetime import timedelta
+from datetime import timezone
+from decimal import Decimal
+from itertools import chain
+from itertools import count
+from itertools import islice
+from queue import Empty
+from queue import Full
+from queue import Queue
+from threading import BoundedSemaphore
+from threading import Thread
+from time import perf_counter
+from uuid import UUID
+import json
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
+psycopg2.extensions.register_type(psycopg2.extensions.UNICODEARRAY)
+import pgtypes
+from columnar import ColumnarRecords
+from metrics import STAGE_CONNECT
+from metrics import STAGE_EXECUTE
+from metrics import STAGE_FETCH
+from metrics import elapsed
+from metrics import measure
+from metrics import Span
+
+FETCH_CURSOR = 'cursor'
+FETCH_COPY_TEXT = 'copy_text'
+FETCH_COPY_BINARY = 'copy_binary'
+
+COPY_FORMATS = {FETCH_COPY_TEXT: 'text', FETCH_COPY_BINARY: 'binary'}
+COPY_BINARY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+COPY_TEXT_NULL = '\\N'
+COPY_TEXT_ESCAPE = re.compile(r'\\(?:([0-7]{1,3})|x([0-9a-fA-F]{1,2})|(.))', re.DOTALL)
+COPY_TEXT_ESCAPES = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'}
+
+PARTITION_HASH = 'hash'
+PARTITION_RANGE = 'range'
+PARTITION_METHODS = [PARTITION_HASH, PARTITION_RANGE]
+
+POSTGRES_EPOCH = datetime(2000, 1, 1)
+POSTGRES_EPOCH_DATE = date(2000, 1, 1)
+
+
+def strip_statement(sql_statement):
+    """Returns the SQL statement without trailing semicolons, so it can be embedded as a subquery."""
+    return sql_statement.strip().rstrip(';').rstrip()
+
+
+def partition_statements(sql_statement, partitions, partition_method=PARTITION_HASH, partition_column=None, boundaries=None):
+    """Splits an SQL query into slices that together return every row of the query exactly once.
+
+    Args:
+        sql_statement (str): The SQL query to be split.
+        partitions (int): The count of slices.
+        partition_method (str): 'hash' assigns the rows by the hash of the partition column (of the whole row if no
+            partition column is given), 'range' by the range of the partition column the value falls into, defaults to 'hash'.
+        partition_column (str): The quoted identifier of a column of the query result, defaults to None.
+        boundaries (list): SQL literals of the partitions + 1 range boundaries, required by the 'range' method.
+
+    Returns:
+        A list of SQL statements, one per slice.
+    """
+    subquery = 'SELECT * FROM ({0}\n) AS krano_partition'.format(strip_statement(sql_statement))
+
+    if partition_method == PARTITION_HASH:
+        hashed = 'krano_partition' if partition_column is None else 'krano_partition.{0}'.format(partition_column)
+        return ["{0} WHERE (hashtext(coalesce({1}::text, '')) & 2147483647) % {2} = {3}".format(subquery, hashed, partitions, index)
+                for index in range(partitions)]
+
+    column = 'krano_partition.{0}'.format(partition_column)
+    statements = []
+    for index in range(partitions):
+        conditions = []
+        if index > 0:
+            conditions.append('{0} >= {1}'.format(column, boundaries[index]))
+        if index < partitions - 1:
+            conditions.append('{0} < {1}'.format(column, boundaries[index + 1]))
+        condition = ' AND '.join(conditions) or 'TRUE'
+        if index == 0:
+            condition = '({0} OR {1} IS NULL)'.format(condition, column)
+        statements.append('{0} WHERE {1}'.format(subquery, condition))
+    return statements
+
+
+def delta_statement(sql_statement, watermark_column, lower, upper):
+    """Restricts an SQL query to the rows whose watermark column lies above lower and up to upper.
+
+    Args:
+        sql_statement (str): The SQL query to be restricted.
+        watermark_column (str): The quoted identifier of an increasing column of the query result, e.g. an id or updated_at.
+        lower (str): SQL literal of the last value exported before, None for the first export.
+        upper (str): SQL literal of the highest value to be exported.
+
+    Returns:
+        The restricted SQL statement, rows with a NULL watermark are never included.
+    """
+    column = 'krano_delta.{0}'.format(watermark_column)
+    conditions = ['{0} <= {1}'.format(column, upper)]
+    if lower is not None:
+        conditions.insert(0, '{0} > {1}'.format(column, lower))
+    return 'SELECT * FROM ({0}\n) AS krano_delta WHERE {1}'.format(strip_statement(sql_statement), ' AND '.join(conditions))
+
+
+def range_boundaries(lower, upper, partitions):
+    """Returns partitions + 1 evenly spaced values from lower to upper, used as boundaries of range partitions.
+
+    Raises:
+        ValueError: The values are neither numbers nor dates, timestamps or intervals.
+    """
+    if isinstance(lower, int) and not isinstance(lower, bool):
+        return [lower + (upper - lower) * index // partitions for index in range(partitions + 1)]
+    if isinstance(lower, (float, Decimal, date, timedelta)):
+        return [lower + (upper - lower) * index / partitions for index in range(partitions + 1)]
+    raise ValueError('Range partitioning requires a numeric, date, timestamp or interval partition column, got {0}.'.format(type(lower).__name__))
+
+
+class ConnectionSettings(object):
+    """Encapsulates the specific connection settings for a PostgreSQL database connection.
+
+    Args:
+        name (str): Name for the connection settings.
+        host (str): Host of the database server.
+        database_name (str): Name of the database.
+        username (str): Name of the database user.
+        password (str): Password of the database user.
+        application_name (str): Application name for the database connection, defaults to 'krano'.
+        client_encoding (str): Encoding to be used fpr the database connection, defaults to 'utf-8'.
+
+    Raises:
+        ValueError: One of the non-optional arguments is not available.
+    """
+
+    def __init__(self, name, host, database_name, username, password, application_name='krano', client_encoding='utf-8'):
+        self.name = name
+        self.host = host
+        self.database_name = database_name
+        self.username = username
+        self.password = password
+        self.application_name = application_name
+        self.client_encoding = client_encoding
+
+        if not self.name:
+            raise ValueError('You must provide a name for the connection setting.')
+
+        if not self.host:
+            raise ValueError('You must provide a host for the connection setting.')
+
+        if not self.database_name:
+            raise ValueError('You must provide a database_name for the connection setting.')
+
+        if not self.username:
+            raise ValueError('You must provide a username for the connection setting.')
+
+        if not self.password:
+            raise ValueError('You must provide a password for the connection setting.')
+
+    def __repr__(self):
+        repr = "<ConnectionSettings name={0}>".format(self.name)
+        return repr
+
+
+class ConnectionPool(object):
+    """Keeps connections to one database open, so several Database objects can reuse them, also across threads.
+
+    Connections are opened on demand, getconn() blocks while all max_connections connections are in use.
+
+    Args:
+        connection_settings (ConnectionSettings): An instance of a ConnectionSettings object.
+        max_connections (int): The maximum count of open connections, defaults to 2.
+    """
+    def __init__(self, connection_settings, max_connections=2):
+        self.connection_settings = connection_settings
+        self.max_connections = max_connections
+        self._slots = BoundedSemaphore(max_connections)
+        self._pool = psycopg2.pool.ThreadedConnectionPool(0, max_connections, host=connection_settings.host,
+                                                          dbname=connection_settings.database_name, user=connection_settings.username,
+                                                          password=connection_settings.password,
+                                                          application_name=connection_settings.application_name,
+                                                          client_encoding='utf-8')
+
+    def getconn(self):
+        """Returns an idle connection of the pool, opening a new one if there is none."""
+        self._slots.acquire()
+        try:
+            return self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, connection):
+        """Returns a connection to the pool, an open transaction is rolled back and a broken connection is discarded."""
+        try:
+            self._pool.putconn(connection)
+        finally:
+            self._slots.release()
+
+    def closeall(self):
+        """Closes all connections of the pool."""
+        logger.info("Closing all pooled database connections to {0}...".format(self.connection_settings.name))
+        self._pool.closeall()
+
+    def __repr__(self):
+        repr = "<ConnectionPool name={0} max_connections={1}>".format(self.connection_settings.name, self.max_connections)
+        return repr
+
+
+class QueryResult(object):
+    """Stores the result of a executed query.
+
+    Args:
+        sql_statement (str): The SQL query that was used to fetch the records.
+        records (list): A list of rows (tuples) fetched with the SQL query, or a columnar.ColumnarRecords sequence.
+        column_names (list): A list containing the column names for the records.
+        query_duration (datetime.timedelta): Execution time of the SQL query.
+        column_type_codes (list): A list containing the PostgreSQL type OIDs of the columns, defaults to None.
+
+    The attributes cache_status and cached_at are set by a QueryResultCache, see cache.py.
+    """
+    def __init__(self, sql_statement, records, column_names, query_duration, column_type_codes=None):
+        self.sql_statement = sql_statement
+        self.records = records
+        self.column_names = column_names
+        self.query_duration = query_duration
+        self.column_type_codes = column_type_codes
+        self.record_count = len(self.records)
+        self.cache_status = None
+        self.cached_at = None
+
+    def isempty(self):
+        """Indicates if the list of rows is empty or not."""
+        return self.record_count == 0
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def sample(self, count):
+        """Returns up to count records spread evenly over the result."""
+        step = max(1, self.record_count // max(count, 1))
+        return self.records[::step][:count]
+
+    def chunks(self, size):
+        """Yields the records in lists of at most the given size.
+
+        Args:
+            size (int or callable): The count of records per list, or a callable returning the count for the next list.
+        """
+        next_size = size if callable(size) else lambda: size
+        pos = 0
+        while pos < self.record_count:
+            chunk_size = next_size()
+            yield self.records[pos:pos + chunk_size]
+            pos += chunk_size
+
+
+class QueryEstimate(object):
+    """The estimate of the PostgreSQL planner for the result of an SQL query, see Database.estimate().
+
+    The estimate is only as good as the statistics of the tables, e.g. refreshed by ANALYZE, and can be far off for
+    complex joins or filters on correlated columns.
+
+    Args:
+        rows (int): The estimated count of rows.
+        row_width (int): The estimated average width of a row in bytes, as PostgreSQL stores it.
+        column_count (int): The count of columns of the result.
+        total_cost (float): The estimated total cost of the plan, in the arbitrary units of the planner.
+    """
+    def __init__(self, rows, row_width, column_count, total_cost):
+        self.rows = rows
+        self.row_width = row_width
+        self.column_count = column_count
+        self.total_cost = total_cost
+
+    @property
+    def size(self):
+        """The estimated size of the result in bytes, as PostgreSQL stores it."""
+        return self.rows * self.row_width
+
+    def __repr__(self):
+        return '<QueryEstimate rows={0} row_width={1} column_count={2} total_cost={3}>'.format(self.rows, self.row_width, self.column_count,
+                                                                                                self.total_cost)
+
+
+class StreamingQueryResultError(Exception):
+    """Raised when a streaming query result is consumed more than once."""
+    pass
+
+
+class StreamingQueryResult(QueryResult):
+    """Stores the result of a query whose records are fetched lazily in batches.
+
+    The records can only be consumed once. The record count is None until all batches were fetched.
+
+    Args:
+        sql_statement (str): The SQL query that was used to fetch the records.
+        batches (iterator): An iterator yielding lists of rows (tuples) as they arrive from the database.
+        column_names (list): A list containing the column names for the records.
+        query_duration (datetime.timedelta): Execution time of the SQL query until the first batch arrived.
+        close_callback (callable): Called once all batches were fetched or the result was closed, defaults to None.
+        column_type_codes (list): A list containing the PostgreSQL type OIDs of the columns, defaults to None.
+        metrics (metrics.RunMetrics): Receives the fetch span once all batches were fetched, defaults to None.
+    """
+    def __init__(self, sql_statement, batches, column_names, query_duration, close_callback=None, column_type_codes=None, metrics=None):
+        self.sql_statement = sql_statement
+        self.records = None
+        self.column_names = column_names
+        self.query_duration = query_duration
+        self.column_type_codes = column_type_codes
+        self.record_count = None
+        self.fetch_duration = None
+        self.cache_status = None
+        self.cached_at = None
+        self._batches = iter(batches)
+        self._first_batch = next(self._batches, [])
+        self._empty = not self._first_batch
+        self._close_callback = close_callback
+        self._consumed = False
+        self._fetched_count = 0
+        self._metrics = metrics
+
+        if self._empty:
+            self._finish(perf_counter())
+
+    def isempty(self):
+        """Indicates if the query returned no rows at all."""
+        return self._empty
+
+    def __iter__(self):
+        for batch in self.batches():
+            yield from batch
+
+    def batches(self):
+        """Yields the batches of rows as they arrive from the database."""
+        if self._consumed:
+            raise StreamingQueryResultError('The records of a streaming query result can only be consumed once.')
+        self._consumed = True
+
+        fetch_start_time = perf_counter()
+        try:
+            batch = self._first_batch
+            self._first_batch = None
+            while batch:
+                self._fetched_count += len(batch)
+                yield batch
+                batch = next(self._batches, None)
+        finally:
+            self._finish(fetch_start_time)
+
+    def sample(self, count):
+        """Returns up to count records from the start of the first batch, without consuming the result."""
+        return list(self._first_batch or [])[:count]
+
+    def chunks(self, size):
+        """Yields the records in lists of exactly the given size, except for the last one.
+
+        Args:
+            size (int or callable): The count of records per list, or a callable returning the count for the next list.
+        """
+        next_size = size if callable(size) else lambda: size
+        chunk_size = next_size()
+        chunk = []
+        for batch in self.batches():
+            pos = 0
+            while pos < len(batch):
+                missing = chunk_size - len(chunk)
+                chunk.extend(batch[pos:pos + missing])
+                pos += missing
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+                    chunk_size = next_size()
+        if chunk:
+            yield chunk
+
+    def close(self):
+        """Stops fetching and releases the underlying database cursor."""
+        self._consumed = True
+        self._finish(None)
+
+    def _finish(self, fetch_start_time):
+        if self._close_callback:
+            self._close_callback()
+            self._close_callback = None
+        if self.record_count is None and fetch_start_time:
+            self.record_count = self._fetched_count
+            self.fetch_duration = elapsed(fetch_start_time)
+            if self._metrics is not None:
+                self._metrics.add(Span(STAGE_FETCH, perf_counter() - fetch_start_time, rows=self.record_count))
+            logger.info("Fetched {0} records in {1}".format(self.record_count, self.fetch_duration))
+
+
+def _unescape_copy_text(field):
+    """Replaces the backslash escape sequences of a field in the COPY text format."""
+    if '\\' not in field:
+        return field
+    return COPY_TEXT_ESCAPE.sub(_replace_copy_text_escape, field)
+
+
+def _replace_copy_text_escape(match):
+    octal, hexadecimal, character = match.groups()
+    if octal:
+        return chr(int(octal, 8) & 0xFF)
+    if hexadecimal:
+        return chr(int(hexadecimal, 16))
+    return COPY_TEXT_ESCAPES.get(character, character)
+
+
+def _decode_binary_numeric(data):
+    """Decodes a NUMERIC value from the COPY binary format (base 10000 digits) into a Decimal."""
+    digit_count, weight, sign, display_scale = struct.unpack_from('>hhHh', data)
+    if sign == 0xC000:
+        return Decimal('NaN')
+    if sign in (0xD000, 0xF000):
+        return Decimal('-Infinity' if sign == 0xF000 else 'Infinity')
+
+    digits = struct.unpack_from('>{0}H'.format(digit_count), data, 8)
+    coefficient = int(''.join('{0:04d}'.format(digit) for digit in digits) or '0')
+    exponent = (weight - digit_count + 1) * 4
+    if exponent + display_scale >= 0:
+        coefficient *= 10 ** (exponent + display_scale)
+    else:
+        coefficient //= 10 ** -(exponent + display_scale)
+    return Decimal((1 if sign == 0x4000 else 0, tuple(int(digit) for digit in str(coefficient)), -display_scale))
+
+
+def _decode_binary_time(data):
+    microseconds = struct.unpack('>q', data)[0]
+    seconds, microsecond = divmod(microseconds, 1000000)
+    minutes, second = divmod(seconds, 60)
+    return time(minutes // 60, minutes % 60, second, microsecond)
+
+
+COPY_BINARY_DECODERS = {
+    pgtypes.BOOL_OID: lambda data: data != b'\x00',
+    pgtypes.BYTEA_OID: memoryview,
+    pgtypes.INT2_OID: lambda data: struct.unpack('>h', data)[0],
+    pgtypes.INT4_OID: lambda data: struct.unpack('>i', data)[0],
+    pgtypes.INT8_OID: lambda data: struct.unpack('>q', data)[0],
+    pgtypes.OID_OID: lambda data: struct.unpack('>I', data)[0],
+    pgtypes.FLOAT4_OID: lambda data: struct.unpack('>f', data)[0],
+    pgtypes.FLOAT8_OID: lambda data: struct.unpack('>d', data)[0],
+    pgtypes.TEXT_OID: lambda data: data.decode('utf-8'),
+    pgtypes.VARCHAR_OID: lambda data: data.decode('utf-8'),
+    pgtypes.BPCHAR_OID: lambda data: data.decode('utf-8'),
+    pgtypes.JSON_OID: lambda data: json.loads(data.decode('utf-8')),
+    pgtypes.JSONB_OID: lambda data: json.loads(data[1:].decode('utf-8')),
+    pgtypes.UUID_OID: lambda data: str(UUID(bytes=data)),
+    pgtypes.NUMERIC_OID: _decode_binary_numeric,
+    pgtypes.DATE_OID: lambda data: POSTGRES_EPOCH_DATE + timedelta(days=struct.unpack('>i', data)[0]),
+    pgtypes.TIME_OID: _decode_binary_time,
+    pgtypes.TIMESTAMP_OID: lambda data: POSTGRES_EPOCH + timedelta(microseconds=struct.unpack('>q', data)[0]),
+    pgtypes.TIMESTAMPTZ_OID: lambda data: (POSTGRES_EPOCH + timedelta(microseconds=struct.unpack('>q', data)[0])).replace(tzinfo=timezone.utc)
+}
+
+
+class CopyFormatError(Exception):
+    """Raised when the output of a COPY statement cannot be parsed."""
+    pass
+
+
+class _CopyStream(io.RawIOBase):
+    """Passes the output of a COPY from the background thread to the parsing thread through a bounded queue.
+
+    An in-process queue is used instead of an OS pipe: worker processes forked while a COPY is running would
+    inherit the write end of a pipe and the parser would never see the end of the stream.
+    """
+    def __init__(self, buffer_size, queue_size=4):
+        super().__init__()
+        self.buffer_size = buffer_size
+        self.queue = Queue(maxsize=queue_size)
+        self.pending = bytearray()
+        self.remainder = memoryview(b'')
+        self.finished = False
+        self.cancelled = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.remainder:
+            if self.finished:
+                return 0
+            data = self.queue.get()
+            if data is None:
+                self.finished = True
+                return 0
+            self.remainder = memoryview(data)
+        size = min(len(buffer), len(self.remainder))
+        buffer[:size] = self.remainder[:size]
+        self.remainder = self.remainder[size:]
+        return size
+
+    def write(self, data):
+        """Called by copy_expert in the background thread, hands over the data in blocks of buffer_size bytes."""
+        self.pending += data
+        if len(self.pending) >= self.buffer_size:
+            self._put(bytes(self.pending))
+            self.pending = bytearray()
+        return len(data)
+
+    def finish(self):
+        """Hands over the remaining data followed by the end of the stream."""
+        if self.pending:
+            self._put(bytes(self.pending))
+            self.pending = bytearray()
+        self._put(None)
+
+    def cancel(self):
+        """Stops the background thread from waiting for the parser and discards the queued data."""
+        self.cancelled = True
+        try:
+            while True:
+                self.queue.get_nowait()
+        except Empty:
+            pass
+
+    def _put(self, data):
+        while not self.cancelled:
+            try:
+                self.queue.put(data, timeout=0.1)
+                return
+            except Full:
+                pass
+        if data is not None:
+            raise CopyFormatError('The COPY was cancelled.')
+
+
+class CopyReader(object):
+    """Fetches the result of an SQL query with COPY ... TO STDOUT and parses it into typed rows.
+
+    The COPY runs in a background thread and hands its output over in blocks of buffer_size bytes, while the
+    calling thread parses the stream. The text format uses the same psycopg2
+    typecasters as a cursor, so the rows equal the ones of cursor.fetchall(). The binary format only supports the
+    types in COPY_BINARY_DECODERS and returns timestamptz values in UTC instead of the session time zone.
+
+    Args:
+        connection (psycopg2.extensions.connection): The database connection to run the COPY on.
+        sql_statement (str): The SQL query whose result is fetched.
+        column_type_codes (list): The PostgreSQL type OIDs of the result columns.
+        copy_format (str): Either 'text' or 'binary', defaults to 'text'.
+        buffer_size (int): Size of the blocks handed over between the threads in bytes, defaults to 1 MB.
+
+    Raises:
+        CopyFormatError: The binary format does not support one of the column types.
+    """
+    def __init__(self, connection, sql_statement, column_type_codes, copy_format='text', buffer_size=1048576):
+        self.connection = connection
+        self.copy_statement = 'COPY ({0}\n) TO STDOUT WITH (FORMAT {1})'.format(strip_statement(sql_statement), copy_format)
+        self.column_type_codes = column_type_codes
+        self.copy_format = copy_format
+        self.buffer_size = buffer_size
+        self.error = None
+        self.stream = None
+        self.thread = None
+
+        if self.copy_format == 'binary':
+            unsupported_type_codes = [type_code for type_code in column_type_codes if type_code not in COPY_BINARY_DECODERS]
+            if unsupported_type_codes:
+                raise CopyFormatError("The binary COPY format does not support the column type OID(s) {0}, "
+                                      "use the text format instead.".format(', '.join(map(str, unsupported_type_codes))))
+
+    def batches(self, batch_size):
+        """Yields the parsed rows in lists of batch_size rows."""
+        self.stream = _CopyStream(self.buffer_size)
+        self.thread = Thread(target=self._copy, args=(self.stream,), name='krano-copy', daemon=True)
+        self.thread.start()
+
+        source = io.BufferedReader(self.stream, buffer_size=self.buffer_size)
+        if self.copy_format == 'binary':
+            rows = self._parse_binary(source)
+        else:
+            rows = self._parse_text(source)
+
+        batch = list(islice(rows, batch_size))
+        while batch:
+            yield batch
+            batch = list(islice(rows, batch_size))
+
+        self.close()
+        if self.error:
+            raise self.error
+
+    def close(self):
+        """Stops a running COPY and waits for the background thread."""
+        if self.thread and self.thread.is_alive():
+            self.connection.cancel()
+        if self.stream:
+            self.stream.cancel()
+        if self.thread:
+            self.thread.join()
+
+    def _copy(self, stream):
+        cursor = self.connection.cursor()
+        try:
+            cursor.copy_expert(self.copy_statement, stream, size=self.buffer_size)
+        except Exception as e:
+            self.error = e
+        finally:
+            cursor.close()
+            try:
+                stream.finish()
+            except CopyFormatError:
+                pass
+
+    def _text_caster(self, type_code, cursor):
+        """Returns the function converting a non-NULL field of the COPY text format into a Python value."""
+        if type_code in pgtypes.INTEGER_OIDS:
+            return int
+        if type_code in pgtypes.FLOAT_OIDS:
+            return float
+        if type_code == pgtypes.NUMERIC_OID:
+            return Decimal
+        if type_code == pgtypes.BOOL_OID:
+            return 't'.__eq__
+        if type_code in pgtypes.STRING_OIDS:
+            return _unescape_copy_text
+
+        typecaster = self.connection.string_types.get(type_code) or psycopg2.extensions.string_types.get(type_code)
+        if typecaster is None:
+            return _unescape_copy_text
+        return lambda field: typecaster(_unescape_copy_text(field), cursor)
+
+    def _parse_text(self, source):
+        cursor = self.connection.cursor()
+        casters = [self._text_caster(type_code, cursor) for type_code in self.column_type_codes]
+        for line in source:
+            fields = line.decode('utf-8')[:-1].split('\t')
+            yield tuple([None if field == COPY_TEXT_NULL else cast(field) for cast, field in zip(casters, fields)])
+
+    def _parse_binary(self, source):
+        header = source.read(len(COPY_BINARY_SIGNATURE) + 8)
+        if not header:
+            return
+        if not header.startswith(COPY_BINARY_SIGNATURE):
+            raise CopyFormatError('The COPY output does not start with the binary format signature.')
+        source.read(struct.unpack_from('>i', header, len(COPY_BINARY_SIGNATURE) + 4)[0])
+
+        decoders = [COPY_BINARY_DECODERS[type_code] for type_code in self.column_type_codes]
+        read = source.read
+        unpack_length = struct.Struct('>i').unpack
+        while True:
+            field_count_data = read(2)
+            if len(field_count_data) < 2 or field_count_data == b'\xff\xff':
+                return
+
+            row = []
+            for decode in decoders:
+                length = unpack_length(read(4))[0]
+                row.append(None if length < 0 else decode(read(length)))
+            yield tuple(row)
+
+
+class PartitionedReader(object):
+    """Fetches the slices of a partitioned SQL query in parallel over one connection each.
+
+    Every connection imports the same exported snapshot, so all slices see the same state of the database.
+    Each slice is fetched by a background thread and its batches are merged in the order they arrive, so an
+    ORDER BY of the SQL query is not preserved across the slices.
+
+    Args:
+        connect (callable): Returns a new database connection.
+        snapshot_id (str): The identifier returned by pg_export_snapshot() in the coordinating transaction.
+        statements (list): The SQL statements of the slices.
+        column_type_codes (list): The PostgreSQL type OIDs of the result columns.
+        fetch_size (int): The count of rows fetched per batch.
+        copy_format (str): Fetch the slices with COPY in 'text' or 'binary' format instead of a server-side cursor, defaults to None.
+    """
+    def __init__(self, connect, snapshot_id, statements, column_type_codes, fetch_size, copy_format=None):
+        self.connect = connect
+        self.snapshot_id = snapshot_id
+        self.statements = statements
+        self.column_type_codes = column_type_codes
+        self.fetch_size = fetch_size
+        self.copy_format = copy_format
+        self.queue = Queue(maxsize=2 * len(statements))
+        self.connections = [None] * len(statements)
+        self.threads = []
+        self.cancelled = False
+
+    def batches(self):
+        """Yields the batches of all slices as they arrive."""
+        for index, statement in enumerate(self.statements):
+            thread = Thread(target=self._fetch_partition, args=(index, statement), name='krano-partition-{0}'.format(index + 1), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+        running = len(self.threads)
+        try:
+            while running:
+                item = self.queue.get()
+                if isinstance(item, list):
+                    yield item
+                    continue
+                running -= 1
+                if isinstance(item, Exception):
+                    raise item
+        finally:
+            self.close()
+
+    def close(self):
+        """Stops the slices still being fetched, waits for the background threads and closes their connections."""
+        self.cancelled = True
+        for thread, connection in zip(self.threads, self.connections):
+            if connection is not None and thread.is_alive():
+                connection.cancel()
+        try:
+            while True:
+                self.queue.get_nowait()
+        except Empty:
+            pass
+        for thread in self.threads:
+            thread.join()
+        for index, connection in enumerate(self.connections):
+            if connection is not None:
+                connection.close()
+                self.connections[index] = None
+
+    def _put(self, item):
+        while not self.cancelled:
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _fetch_partition(self, index, statement):
+        copy_reader = None
+        try:
+            connection = self.connect()
+            self.connections[index] = connection
+            cursor = connection.cursor()
+            cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+            cursor.execute('SET TRANSACTION SNAPSHOT %s', (self.snapshot_id,))
+            cursor.close()
+
+            fetch_start_time = perf_counter()
+            if self.copy_format:
+                copy_reader = CopyReader(connection, statement, self.column_type_codes, self.copy_format)
+                batches = copy_reader.batches(self.fetch_size)
+            else:
+                cursor = connection.cursor(name='krano_partition_{0}'.format(index + 1))
+                cursor.execute(statement)
+                batches = iter(lambda: cursor.fetchmany(self.fetch_size), [])
+
+            record_count = 0
+            for batch in batches:
+                if not self._put(batch):
+                    return
+                record_count += len(batch)
+
+            fetch_duration = elapsed(fetch_start_time)
+            logger.info("Slice {0}/{1} fetched {2} records in {3}".format(index + 1, len(self.statements), record_count, fetch_duration))
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+        finally:
+            if copy_reader is not None:
+                copy_reader.close()
+
+
+class Database(object):
+    """Connects to a PostgreSQL Database and executes given SQL queries.
+
+    Args:
+        connection_settings (ConnectionSettings): An instance of a ConnectionSettings object.
+        connection_pool (ConnectionPool): Take the connection from this pool and return it on close instead of
+            opening and closing a connection of its own, defaults to None.
+        metrics (metrics.RunMetrics): Receives the connect, execute and fetch spans of the queries, defaults to None.
+    """
+    _cursor_counter = count(1)
+
+    def __init__(self, connection_settings, connection_pool=None, metrics=None):
+        self.connection_settings = connection_settings
+        self.connection_pool = connection_pool
+        self.connection = None
+        self.metrics = metrics
+
+        if not self.connection_settings:
+            raise ValueError('You must provide connection settings.')
+
+    def _get_connection(self):
+        if self.connection:
+            return self.connection
+
+        with measure(STAGE_CONNECT, self.metrics):
+            if self.connection_pool:
+                logger.info("Taking a pooled database connection to {0}...".format(self.connection_settings.name))
+                self.connection = self.connection_pool.getconn()
+                return self.connection
+
+            logger.info("Opening database connection to {0}...".format(self.connection_settings.name))
+            self.connection = self._connect()
+
+        return self.connection
+
+    def _connect(self):
+        connection = psycopg2.connect(host=self.connection_settings.host, dbname=self.connection_settings.database_name,
+                                      user=self.connection_settings.username, password=self.connection_settings.password,
+                                      application_name=self.connection_settings.application_name)
+        connection.set_client_encoding('utf-8')
+        return connection
+
+    def query(self, sql_statement, stream=False, fetch_size=10000, fetch_method=FETCH_CURSOR, columnar=False):
+        """Executes the SQL query against the database and returns the result.
+
+        Args:
+            sql_statement (str): The SQL query to be executed.
+            stream (bool): Fetch the records lazily in batches instead of all at once, defaults to False.
+            fetch_size (int): The count of rows fetched per batch in streaming mode, defaults to 10000.
+            fetch_method (str): 'cursor' fetches the rows through a psycopg2 cursor (a server-side one in streaming mode),
+                'copy_text' and 'copy_binary' wrap the SQL query in COPY ... TO STDOUT and parse the stream in the
+                text or binary format, defaults to 'cursor'.
+            columnar (bool): Store the records column by column in typed arrays (see columnar.ColumnarRecords) as they are
+                fetched in batches of fetch_size rows, instead of as a list of tuples. Ignored in streaming mode. Defaults to False.
+
+        Returns:
+            An instance of a QueryResult object containing the results of the executed query. In streaming mode
+            an instance of a StreamingQueryResult object, which must be consumed before the database is closed.
+
+        Raises:
+            ValueError: The given fetch method is unknown.
+        """
+        if fetch_method in COPY_FORMATS:
+            return self._query_copy(sql_statement, stream, fetch_size, COPY_FORMATS[fetch_method], columnar)
+
+        if fetch_method != FETCH_CURSOR:
+            raise ValueError("Unknown fetch method '{0}', choose one of: {1}".format(fetch_method, ', '.join([FETCH_CURSOR] + list(COPY_FORMATS))))
+
+        if stream:
+            return self._query_streaming(sql_statement, fetch_size)
+
+        conn = self._get_connection()
+        logger.info("Executing SQL query against database {0}...".format(self.connection_settings.name))
+
+        cursor = conn.cursor()
+        query_start_time = perf_counter()
+
+        with measure(STAGE_EXECUTE, self.metrics):
+            cursor.execute(sql_statement)
+            conn.commit()
+        with measure(STAGE_FETCH, self.metrics) as fetch_span:
+            if columnar:
+                records = ColumnarRecords.from_batches(iter(lambda: cursor.fetchmany(fetch_size), []), [column[1] for column in cursor.description])
+            else:
+                records = cursor.fetchall()
+            fetch_span.rows = len(records)
+
+        query_duration = elapsed(query_start_time)
+
+        column_names = [column[0] for column in cursor.description]
+        column_type_codes = [column[1] for column in cursor.description]
+        query_result = QueryResult(sql_statement, records, column_names, query_duration, column_type_codes)
+        logger.info("Fetched {0} records from the database {1}".format(query_result.record_count, self.connection_settings.name))
+
+        return query_result
+
+    def _query_streaming(self, sql_statement, fetch_size):
+        conn = self._get_connection()
+        logger.info("Executing SQL query against database {0} with a server-side cursor...".format(self.connection_settings.name))
+
+        cursor = conn.cursor(name='krano_cursor_{0}'.format(next(self._cursor_counter)))
+        query_start_time = perf_counter()
+
+        with measure(STAGE_EXECUTE, self.metrics):
+            cursor.execute(sql_statement)
+            first_batch = cursor.fetchmany(fetch_size)
+
+        query_duration = elapsed(query_start_time)
+
+        def close_cursor():
+            cursor.close()
+            conn.commit()
+
+        column_names = [column[0] for column in cursor.description]
+        column_type_codes = [column[1] for column in cursor.description]
+        batches = chain([first_batch], iter(lambda: cursor.fetchmany(fetch_size), []))
+        query_result = StreamingQueryResult(sql_statement, batches, column_names, query_duration, close_callback=close_cursor,
+                                            column_type_codes=column_type_codes, metrics=self.metrics)
+        logger.info("Streaming records from the database {0} in batches of {1} rows".format(self.connection_settings.name, fetch_size))
+
+        return query_result
+
+    def _query_copy(self, sql_statement, stream, fetch_size, copy_format, columnar=False):
+        conn = self._get_connection()
+        logger.info("Executing SQL query against database {0} with COPY in {1} format...".format(self.connection_settings.name, copy_format))
+
+        query_start_time = perf_counter()
+
+        with measure(STAGE_EXECUTE, self.metrics):
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM ({0}\n) AS krano_copy LIMIT 0'.format(strip_statement(sql_statement)))
+            column_names = [column[0] for column in cursor.description]
+            column_type_codes = [column[1] for column in cursor.description]
+            cursor.close()
+
+            copy_reader = CopyReader(conn, sql_statement, column_type_codes, copy_format)
+            batches = copy_reader.batches(fetch_size)
+            if stream:
+                first_batch = next(batches, [])
+
+        if stream:
+            query_duration = elapsed(query_start_time)
+
+            def close_copy():
+                copy_reader.close()
+                conn.commit()
+
+            query_result = StreamingQueryResult(sql_statement, chain([first_batch], batches), column_names, query_duration,
+                                                close_callback=close_copy, column_type_codes=column_type_codes, metrics=self.metrics)
+            logger.info("Streaming records from the database {0} in batches of {1} rows".format(self.connection_settings.name, fetch_size))
+            return query_result
+
+        with measure(STAGE_FETCH, self.metrics) as fetch_span:
+            if columnar:
+                records = ColumnarRecords.from_batches(batches, column_type_codes)
+            else:
+                records = [row for batch in batches for row in batch]
+            conn.commit()
+            fetch_span.rows = len(records)
+
+        query_duration = elapsed(query_start_time)
+
+        query_result = QueryResult(sql_statement, records, column_names, query_duration, column_type_codes)
+        logger.info("Fetched {0} records from the database {1}".format(query_result.record_count, self.connection_settings.name))
+
+        return query_result
+
+    def query_partitioned(self, sql_statement, partitions, partition_column=None, partition_method=PARTITION_HASH, stream=False,
+                          fetch_size=10000, fetch_method=FETCH_CURSOR, columnar=False):
+        """Executes the SQL query in partitions over several connections sharing one snapshot and returns the result.
+
+        The SQL query is split into slices by partition_statements(). A coordinating transaction on the connection of
+        this object exports its snapshot with pg_export_snapshot(), every slice runs on a connection of its own that
+        imports this snapshot, so the result is as consistent as the one of a single query. The rows of the slices
+        are interleaved, an ORDER BY of the SQL query is therefore not preserved.
+
+        Args:
+            sql_statement (str): The SQL query to be executed.
+            partitions (int): The count of slices and parallel connections.
+            partition_column (str): A column of the query result to split the rows by, required by the 'range' method.
+                The 'hash' method hashes the whole row if no column is given. Defaults to None.
+            partition_method (str): Either 'hash' or 'range', defaults to 'hash'.
+            stream (bool): Return the records lazily in batches instead of all at once, defaults to False.
+            fetch_size (int): The count of rows fetched per batch and slice, defaults to 10000.
+            fetch_method (str): 'cursor', 'copy_text' or 'copy_binary', see query(), defaults to 'cursor'.
+            columnar (bool): Store the records column by column in typed arrays, see query(), defaults to False.
+
+        Returns:
+            An instance of a QueryResult object, or of a StreamingQueryResult object in streaming mode.
+
+        Raises:
+            ValueError: The partition method or the fetch method is unknown, or the 'range' method lacks a partition column.
+        """
+        if partition_method not in PARTITION_METHODS:
+            raise ValueError("Unknown partition method '{0}', choose one of: {1}".format(partition_method, ', '.join(PARTITION_METHODS)))
+
+        if partition_method == PARTITION_RANGE and not partition_column:
+            raise ValueError('The range partition method requires a partition column.')
+
+        if fetch_method != FETCH_CURSOR and fetch_method not in COPY_FORMATS:
+            raise ValueError("Unknown fetch method '{0}', choose one of: {1}".format(fetch_method, ', '.join([FETCH_CURSOR] + list(COPY_FORMATS))))
+
+        conn = self._get_connection()
+        logger.info("Executing SQL query against database {0} in {1} {2} partitions...".format(self.connection_settings.name, partitions, partition_method))
+
+        query_start_time = perf_counter()
+
+        conn.commit()
+        try:
+            with measure(STAGE_EXECUTE, self.metrics):
+                cursor = conn.cursor()
+                cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+                cursor.execute('SELECT pg_export_snapshot()')
+                snapshot_id = cursor.fetchone()[0]
+
+                cursor.execute('SELECT * FROM ({0}\n) AS krano_partition LIMIT 0'.format(strip_statement(sql_statement)))
+                column_names = [column[0] for column in cursor.description]
+                column_type_codes = [column[1] for column in cursor.description]
+
+                quoted_column = psycopg2.extensions.quote_ident(partition_column, cursor) if partition_column else None
+                boundaries = None
+                if partition_method == PARTITION_RANGE:
+                    cursor.execute('SELECT min({1}), max({1}) FROM ({0}\n) AS krano_partition'.format(strip_statement(sql_statement), quoted_column))
+                    lower, upper = cursor.fetchone()
+                    if lower is None:
+                        partitions = 1
+                        boundaries = [None, None]
+                    else:
+                        boundaries = [cursor.mogrify('%s', (value,)).decode('utf-8') for value in range_boundaries(lower, upper, partitions)]
+                cursor.close()
+        except Exception:
+            conn.rollback()
+            raise
+
+        statements = partition_statements(sql_statement, partitions, partition_method, quoted_column, boundaries)
+        reader = PartitionedReader(self._connect, snapshot_id, statements, column_type_codes, fetch_size, COPY_FORMATS.get(fetch_method))
+        batches = reader.batches()
+
+        def close_partitions():
+            reader.close()
+            conn.commit()
+
+        if stream:
+            with measure(STAGE_EXECUTE, self.metrics):
+                first_batch = next(batches, [])
+            query_duration = elapsed(query_start_time)
+            query_result = StreamingQueryResult(sql_statement, chain([first_batch], batches), column_names, query_duration,
+                                                close_callback=close_partitions, column_type_codes=column_type_codes, metrics=self.metrics)
+            logger.info("Streaming records from the database {0} in {1} partitions".format(self.connection_settings.name, partitions))
+            return query_result
+
+        with measure(STAGE_FETCH, self.metrics) as fetch_span:
+            try:
+                if columnar:
+                    records = ColumnarRecords.from_batches(batches, column_type_codes)
+                else:
+                    records = [row for batch in batches for row in batch]
+            finally:
+                close_partitions()
+            fetch_span.rows = len(records)
+
+        query_duration = elapsed(query_start_time)
+
+        query_result = QueryResult(sql_statement, records, column_names, query_duration, column_type_codes)
+        logger.info("Fetched {0} records from the database {1}".format(query_result.record_count, self.connection_settings.name))
+
+        return query_result
+
+    def watermark_delta(self, sql_statement, watermark_column, lower=None):
+        """Returns the SQL query restricted to the rows added since the last export of an incremental export.
+
+        The highest value of the watermark column is looked up first, so rows added while exporting are left for the next export.
+
+        Args:
+            sql_statement (str): The SQL query.
+            watermark_column (str): An increasing column of the query result, e.g. an id or updated_at.
+            lower: The value of the watermark column exported last, None for the first export.
+
+        Returns:
+            A tuple of the restricted SQL statement and the highest value of the watermark column in it, (None, None) if there are no new rows.
+        """
+        conn = self._get_connection()
+        logger.info("Looking up the rows of database {0} added since {1} = {2}...".format(self.connection_settings.name, watermark_column, lower))
+
+        with measure(STAGE_EXECUTE, self.metrics):
+            cursor = conn.cursor()
+            quoted_column = psycopg2.extensions.quote_ident(watermark_column, cursor)
+            lower_literal = None if lower is None else cursor.mogrify('%s', (lower,)).decode('utf-8')
+            condition = '' if lower is None else ' WHERE krano_delta.{0} > {1}'.format(quoted_column, lower_literal)
+            cursor.execute('SELECT max(krano_delta.{1}) FROM ({0}\n) AS krano_delta{2}'.format(strip_statement(sql_statement), quoted_column, condition))
+            upper = cursor.fetchone()[0]
+            conn.commit()
+            if upper is None:
+                cursor.close()
+                return None, None
+            upper_literal = cursor.mogrify('%s', (upper,)).decode('utf-8')
+            cursor.close()
+
+        return delta_statement(sql_statement, quoted_column, lower_literal, upper_literal), upper
+
+    def estimate(self, sql_statement):
+        """Asks the planner for the count and the width of the rows of the SQL query without executing it.
+
+        Runs EXPLAIN (FORMAT JSON, VERBOSE) on the statement, which takes milliseconds even for queries running for hours.
+
+        Args:
+            sql_statement (str): The SQL query.
+
+        Returns:
+            A QueryEstimate object.
+        """
+        conn = self._get_connection()
+        logger.info("Estimating the result of the SQL query against database {0}...".format(self.connection_settings.name))
+
+        with measure(STAGE_EXECUTE, self.metrics):
+            cursor = conn.cursor()
+            cursor.execute('EXPLAIN (FORMAT JSON, VERBOSE) {0}'.format(strip_statement(sql_statement)))
+            plan = cursor.fetchone()[0]
+            conn.commit()
+            cursor.close()
+
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        plan = plan[0]['Plan']
+        query_estimate = QueryEstimate(int(plan['Plan Rows']), int(plan['Plan Width']), len(plan.get('Output', [])), float(plan['Total Cost']))
+        logger.info("The planner estimates {0} rows of {1} bytes in {2} columns for the SQL query".format(query_estimate.rows, query_estimate.row_width,
+                                                                                                          query_estimate.column_count))
+        return query_estimate
+
+    def close(self):
+        if self.connection and self.connection_pool:
+            logger.info("Returning the database connection to {0} to the pool...".format(self.connection_settings.name))
+            self.connection_pool.putconn(self.connection)
+            self.connection = None
+        elif self.connection:
+            logger.info("Closing database connection to {0}...".format(self.connection_settings.name))
+            self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
\ No newline at end of file
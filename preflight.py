@@ -0,0 +1,196 @@
+#/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+import math
+import time
+from datetime import timedelta
+from threading import Lock
+from prettytable import PrettyTable
+from exporter import human_readable_size
+from resources import PARALLEL_AUTO
+from resources import auto_parallel_processes
+from resources import available_memory
+from resources import estimate_export_memory
+from resources import estimate_row_memory_size
+from resources import memory_reserve
+
+# The minimum count of seconds between two progress messages
+PROGRESS_LOG_INTERVAL = 10
+
+# Chunks held in the main process while streaming: the one being handed off and the one fetched ahead
+STREAMED_CHUNKS = 2
+
+
+class ExportPlan(object):
+    """The plan of an export, made from the estimate of the planner before any record is fetched, see plan_export().
+
+    Args:
+        estimate (postgresql.QueryEstimate): The estimate of the SQL query.
+        file_count (int): The estimated count of files.
+        chunk_count (int): The estimated count of chunks, the parts of the worksheet of a single file. Only used to size the
+            processes and the memory, the exporters still cut the chunks by the chunk size and the measured file size, so the
+            boundaries do not depend on the statistics of the planner and a resumed export finds the same chunks.
+        parallel_processes (int): The planned count of parallel export processes.
+        process_memory (int): The estimated peak memory of one export process in bytes.
+        result_memory (int): The estimated memory of the records held in the main process in bytes.
+        stream (bool): Indicates whether the records are fetched in batches through a server-side cursor.
+        available_memory (int): The memory available for the export in bytes, None if it cannot be determined.
+        violations (list): The configured limits the export exceeds, as messages, defaults to None.
+    """
+    def __init__(self, estimate, file_count, chunk_count, parallel_processes, process_memory, result_memory, stream, available_memory,
+                 violations=None):
+        self.estimate = estimate
+        self.file_count = file_count
+        self.chunk_count = chunk_count
+        self.parallel_processes = parallel_processes
+        self.process_memory = process_memory
+        self.result_memory = result_memory
+        self.stream = stream
+        self.available_memory = available_memory
+        self.violations = violations or []
+
+    @property
+    def memory_budget(self):
+        """The estimated peak memory of the export in bytes, the records in the main process plus all export processes."""
+        return self.result_memory + self.parallel_processes * self.process_memory
+
+    def statistics_table(self):
+        """Returns the plan as a PrettyTable."""
+        pt = PrettyTable()
+        pt.field_names = ['Statistic label', 'Statistic content']
+        pt.add_row(['Estimated rows', self.estimate.rows])
+        pt.add_row(['Estimated row width', '{0} bytes'.format(self.estimate.row_width)])
+        pt.add_row(['Estimated result size', human_readable_size(self.estimate.size, 2)])
+        pt.add_row(['Files', self.file_count])
+        if self.chunk_count != self.file_count:
+            pt.add_row(['Worksheet parts', self.chunk_count])
+        pt.add_row(['Parallel processes', self.parallel_processes])
+        pt.add_row(['Fetch', 'streaming' if self.stream else 'in memory'])
+        pt.add_row(['Memory per process', human_readable_size(self.process_memory, 2)])
+        pt.add_row(['Memory of the records', human_readable_size(self.result_memory, 2)])
+        pt.add_row(['Memory budget', human_readable_size(self.memory_budget, 2)])
+        if self.available_memory is not None:
+            pt.add_row(['Available memory', human_readable_size(self.available_memory, 2)])
+        return pt
+
+
+def plan_export(estimate, chunk_size, parallel_processes=2, stream=False, output_format='xlsx', engine='native', columnar=False,
+                single_file=False, max_file_size=None, max_rows=None, max_size=None):
+    """Plans the count of files and processes, the memory budget and the fetch of an export from the estimate of its SQL query.
+
+    A result which would not fit into the available memory next to the export processes is streamed instead of being fetched
+    as a whole. Exceeded limits are only listed in the violations of the plan, the caller decides whether to refuse the export.
+
+    Args:
+        estimate (postgresql.QueryEstimate): The estimate of the SQL query, see postgresql.Database.estimate().
+        chunk_size (int): The maximum count of rows per file, or per worksheet part of a single file.
+        parallel_processes (int or str): The maximum count of parallel export processes, or 'auto'. Defaults to 2.
+        stream (bool): Indicates whether streaming was requested, defaults to False.
+        output_format (str): The output format, one of writers.OUTPUT_FORMATS, defaults to 'xlsx'.
+        engine (str): The XLSX writer engine, defaults to 'native'.
+        columnar (bool): Indicates whether the records are kept in typed arrays, defaults to False.
+        single_file (bool): Indicates whether all records are written into a single XLSX file, defaults to False.
+        max_file_size (int): The maximum size of a file in bytes, defaults to None.
+        max_rows (int): Limit of the estimated count of rows, defaults to None (no limit).
+        max_size (int): Limit of the estimated size of the result in bytes, as PostgreSQL stores it, defaults to None (no limit).
+
+    Returns:
+        An ExportPlan object.
+    """
+    rows = max(estimate.rows, 1)
+    chunk_count = math.ceil(rows / chunk_size)
+    if max_file_size and not single_file:
+        # the width in PostgreSQL is a rough measure of the size of a file, the FileSizeEstimator refines it while exporting
+        chunk_count = max(chunk_count, math.ceil(estimate.size / max_file_size))
+    file_count = 1 if single_file else chunk_count
+    rows_per_chunk = math.ceil(rows / chunk_count)
+
+    row_size = estimate_row_memory_size(estimate.row_width, estimate.column_count)
+    process_memory = estimate_export_memory(None, rows_per_chunk, 'xlsx' if single_file else output_format, engine, row_size=row_size)
+    if parallel_processes == PARALLEL_AUTO:
+        parallel_processes = auto_parallel_processes(process_memory, chunk_count)
+    else:
+        parallel_processes = max(1, min(parallel_processes, chunk_count))
+
+    available = available_memory()
+    if available is not None:
+        available = max(0, available - memory_reserve())
+    streamed_memory = int(STREAMED_CHUNKS * rows_per_chunk * row_size)
+    if stream:
+        result_memory = streamed_memory
+    else:
+        result_memory = int(rows * estimate_row_memory_size(estimate.row_width, estimate.column_count, columnar))
+        if available is not None and result_memory + parallel_processes * process_memory > available:
+            logger.warning("The records need about {0} in memory, more than the {1} available next to the export processes, "
+                           "streaming them instead".format(human_readable_size(result_memory, 2), human_readable_size(available, 2)))
+            stream = True
+            result_memory = streamed_memory
+
+    violations = []
+    if max_rows is not None and estimate.rows > max_rows:
+        violations.append('about {0} rows exceed the limit of {1} rows'.format(estimate.rows, max_rows))
+    if max_size is not None and estimate.size > max_size:
+        violations.append('about {0} exceed the limit of {1}'.format(human_readable_size(estimate.size, 2), human_readable_size(max_size, 2)))
+
+    plan = ExportPlan(estimate, file_count, chunk_count, parallel_processes, process_memory, result_memory, stream, available, violations)
+    if available is not None and plan.memory_budget > available:
+        logger.warning("The export needs about {0} of memory even when streaming, only {1} are available, consider fewer parallel processes "
+                       "or a smaller chunk size".format(human_readable_size(plan.memory_budget, 2), human_readable_size(available, 2)))
+    return plan
+
+
+class ExportProgress(object):
+    """Logs the count of exported rows against the estimate of the planner and the remaining time, at most every log_interval seconds.
+
+    The exporters add the rows of every finished file or worksheet part, from whichever thread receives them.
+
+    Args:
+        estimated_rows (int): The count of rows estimated by the planner.
+        log_interval (float): The minimum count of seconds between two progress messages, defaults to PROGRESS_LOG_INTERVAL.
+    """
+    def __init__(self, estimated_rows, log_interval=PROGRESS_LOG_INTERVAL):
+        self.estimated_rows = estimated_rows
+        self.log_interval = log_interval
+        self.rows = 0
+        self.start_time = time.monotonic()
+        self.logged_time = self.start_time
+        self.lock = Lock()
+
+    def estimated_file_count(self, rows_per_file):
+        """Returns the estimated count of files with the given count of rows per file."""
+        return max(1, math.ceil(self.estimated_rows / rows_per_file))
+
+    def add(self, rows):
+        """Adds the rows of a finished file or worksheet part and logs the progress, if the last message is old enough."""
+        with self.lock:
+            self.rows += rows
+            now = time.monotonic()
+            if now - self.logged_time < self.log_interval:
+                return
+            self.logged_time = now
+            logger.info(self.status())
+
+    def remaining_duration(self):
+        """Returns the estimated remaining time as timedelta, None before the first rows or once the estimate was exceeded."""
+        if not self.rows or self.rows >= self.estimated_rows:
+            return None
+        seconds = (time.monotonic() - self.start_time) * (self.estimated_rows - self.rows) / self.rows
+        return timedelta(seconds=round(seconds))
+
+    def status(self):
+        """Returns the progress as message, e.g. 'Exported 50000 of about 200000 rows (25%) in 0:00:05, about 0:00:15 left'."""
+        elapsed_duration = timedelta(seconds=round(time.monotonic() - self.start_time))
+        remaining_duration = self.remaining_duration()
+        if remaining_duration is None:
+            return 'Exported {0} rows in {1}, the planner estimated {2}'.format(self.rows, elapsed_duration, self.estimated_rows)
+        return 'Exported {0} of about {1} rows ({2:.0%}) in {3}, about {4} left'.format(self.rows, self.estimated_rows,
+                                                                                        self.rows / self.estimated_rows, elapsed_duration,
+                                                                                        remaining_duration)
+
+    def finish(self):
+        """Logs how far the estimate of the planner was off."""
+        deviation = '' if not self.estimated_rows else ' ({0:+.0%})'.format(self.rows / self.estimated_rows - 1)
+        logger.info('Exported {0} rows in {1}, the planner estimated {2}{3}'.format(self.rows, timedelta(seconds=round(time.monotonic() - self.start_time)),
+                                                                                   self.estimated_rows, deviation))
@@ -0,0 +1,237 @@
+#/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+import math
+import os
+import sys
+import time
+from threading import Lock
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+PARALLEL_AUTO = 'auto'
+
+# Memory of a worker process before it received any records
+WORKER_BASE_MEMORY = 64 * 1024 ** 2
+
+# Peak memory of a worker process relative to the records of its chunk, by writer, covering the unpickled
+# records plus the buffers of the writer (pandas holds a DataFrame next to the records)
+WRITER_MEMORY_FACTORS = {
+    ('xlsx', 'native'): 1.5,
+    ('xlsx', 'pandas'): 4.0,
+    ('csv', 'native'): 1.2,
+    ('csv.gz', 'native'): 1.2,
+    ('parquet', 'native'): 2.5
+}
+
+# Size of a row as Python tuple beyond the bytes of its values: the tuple itself plus a pointer and an object header per value
+TUPLE_BASE_SIZE = 56
+VALUE_OVERHEAD = 48
+
+# openpyxl needs roughly 50 times the size of an XLSX file to load it
+DECORATION_MEMORY_FACTOR = 50
+
+# Share of the total memory that is kept free, at most 1 GB
+MEMORY_RESERVE_FRACTION = 0.1
+MAX_MEMORY_RESERVE = 1024 ** 3
+
+
+def _read_first_line(filepath):
+    try:
+        with open(filepath) as a_file:
+            return a_file.readline().strip()
+    except OSError:
+        return None
+
+
+def _cgroup_memory_available():
+    """Returns the memory left below the cgroup (v2) memory limit of the current process, None without limit."""
+    limit = _read_first_line('/sys/fs/cgroup/memory.max')
+    usage = _read_first_line('/sys/fs/cgroup/memory.current')
+    if not limit or limit == 'max' or not usage:
+        return None
+    return max(0, int(limit) - int(usage))
+
+
+def total_memory():
+    """Returns the total physical memory in bytes, None if it cannot be determined."""
+    if psutil is not None:
+        return psutil.virtual_memory().total
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def available_memory():
+    """Returns the memory in bytes available for new processes without swapping, None if it cannot be determined.
+
+    Uses psutil if it is installed, MemAvailable of /proc/meminfo otherwise. A cgroup memory limit, e.g. of a
+    container, is taken into account as well.
+    """
+    available = None
+    if psutil is not None:
+        available = psutil.virtual_memory().available
+    else:
+        try:
+            with open('/proc/meminfo') as meminfo:
+                for line in meminfo:
+                    if line.startswith('MemAvailable:'):
+                        available = int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            pass
+        if available is None and sys.platform != 'darwin':
+            try:
+                available = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+            except (ValueError, OSError, AttributeError):
+                pass
+
+    cgroup_available = _cgroup_memory_available()
+    if cgroup_available is not None:
+        available = cgroup_available if available is None else min(available, cgroup_available)
+    return available
+
+
+def available_cpus():
+    """Returns the count of CPUs the current process may run on, taking the CPU affinity and a cgroup (v2) quota into account."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    quota = _read_first_line('/sys/fs/cgroup/cpu.max')
+    if quota and not quota.startswith('max'):
+        limit, period = quota.split()
+        cpus = min(cpus, max(1, math.ceil(int(limit) / int(period))))
+    return cpus
+
+
+def memory_reserve():
+    """Returns the memory in bytes that is kept free for the database driver, the main process and the system."""
+    total = total_memory()
+    if total is None:
+        return MAX_MEMORY_RESERVE
+    return min(MAX_MEMORY_RESERVE, int(total * MEMORY_RESERVE_FRACTION))
+
+
+def record_memory_size(records):
+    """Returns the average size in bytes of the given records (tuples) as Python objects."""
+    if not records:
+        return 0
+    size = 0
+    for record in records:
+        size += sys.getsizeof(record) + sum(sys.getsizeof(value) for value in record)
+    return size / len(records)
+
+
+def estimate_row_memory_size(row_width, column_count, columnar=False):
+    """Returns the estimated size in bytes of a row as Python tuple, from its width in PostgreSQL, e.g. of a postgresql.QueryEstimate.
+
+    Columnar records (see columnar.ColumnarRecords) keep the values in typed arrays, which adds a pointer per value at most.
+    """
+    if columnar:
+        return row_width + 8 * column_count
+    return TUPLE_BASE_SIZE + row_width + VALUE_OVERHEAD * column_count
+
+
+def estimate_export_memory(sample, rows_per_chunk, output_format='xlsx', engine='native', row_size=None):
+    """Estimates the peak memory in bytes needed for exporting one chunk.
+
+    Covers the worker process writing the chunk and the copy of the chunk in the main process until it was handed off.
+
+    Args:
+        sample (list): A sample of the records, used for the size of a row.
+        rows_per_chunk (int): The count of rows per chunk.
+        output_format (str): The output format, one of writers.OUTPUT_FORMATS, defaults to 'xlsx'.
+        engine (str): The XLSX writer engine, defaults to 'native'.
+        row_size (float): The size of a row in bytes, replacing the one of the sample, e.g. before any record was fetched. Defaults to None.
+    """
+    factor = WRITER_MEMORY_FACTORS.get((output_format, engine if output_format == 'xlsx' else 'native'), 2.0)
+    if row_size is None:
+        row_size = record_memory_size(sample)
+    return int(WORKER_BASE_MEMORY + row_size * rows_per_chunk * (factor + 1))
+
+
+def estimate_decoration_memory(filepaths):
+    """Estimates the peak memory in bytes needed for decorating the largest of the given XLSX files."""
+    largest_file_size = max((os.path.getsize(filepath) for filepath in filepaths if os.path.isfile(filepath)), default=0)
+    return int(WORKER_BASE_MEMORY + largest_file_size * DECORATION_MEMORY_FACTOR)
+
+
+def auto_parallel_processes(process_memory, max_processes=None):
+    """Returns the count of parallel processes fitting into the available CPUs and the available memory.
+
+    Args:
+        process_memory (int): The estimated peak memory of one process in bytes.
+        max_processes (int): An upper bound, e.g. the count of files to be created, defaults to None.
+    """
+    cpus = available_cpus()
+    available = available_memory()
+    if available is None:
+        processes = cpus
+    else:
+        processes = min(cpus, int((available - memory_reserve()) // max(process_memory, 1)))
+    if max_processes:
+        processes = min(processes, max_processes)
+    processes = max(1, processes)
+
+    logger.info("Chose {0} parallel process(es) for {1} CPU(s) and {2} available memory, {3} estimated per process".format(
+        processes, cpus, 'unknown' if available is None else '{0:.0f}MB'.format(available / 1024 ** 2), '{0:.0f}MB'.format(process_memory / 1024 ** 2)))
+    return processes
+
+
+def resolve_parallel_processes(parallel_processes):
+    """Returns the given count of parallel processes, or the count of available CPUs for 'auto'."""
+    if parallel_processes == PARALLEL_AUTO:
+        return available_cpus()
+    return parallel_processes
+
+
+class MemoryAdmission(object):
+    """Holds back new processes while the available memory is below what they need, so the machine does not start swapping.
+
+    A new process is always admitted when none is running, otherwise the export could not make any progress.
+
+    Args:
+        required_memory (int): The memory in bytes that must be available to admit a new process.
+        poll_interval (float): Seconds between two checks of the available memory, defaults to 0.2.
+    """
+    def __init__(self, required_memory, poll_interval=0.2):
+        self.required_memory = required_memory
+        self.poll_interval = poll_interval
+        self.running = 0
+        self.held_back = 0
+        self.wait_duration = 0.0
+        self.lock = Lock()
+
+    def admit(self):
+        """Waits until there is enough memory available or no process is running, then counts a new running process."""
+        wait_start_time = time.monotonic()
+        held_back = False
+        while True:
+            with self.lock:
+                running = self.running
+            available = available_memory()
+            if running == 0 or available is None or available >= self.required_memory:
+                break
+            if not held_back:
+                held_back = True
+                logger.info("Only {0:.0f}MB of memory available, waiting for one of {1} running process(es) before starting another one".format(
+                    available / 1024 ** 2, running))
+            time.sleep(self.poll_interval)
+
+        with self.lock:
+            self.running += 1
+            if held_back:
+                self.held_back += 1
+                self.wait_duration += time.monotonic() - wait_start_time
+
+    def release(self):
+        """Counts a finished process."""
+        with self.lock:
+            self.running -= 1
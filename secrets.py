@@ -1,10 +1,10 @@
-#/usr/bin/python
-# -*- coding: utf-8 -*-
-
-DB_PASSWORDS = {
-    'Database DEV': 'password',
-    'Database TEST': 'password',
-    'Database REF': 'password'
-}
-
+#/usr/bin/python
+# -*- coding: utf-8 -*-
+
+DB_PASSWORDS = {
+    'Database DEV': 'password',
+    'Database TEST': 'password',
+    'Database REF': 'password'
+}
+
 JIRA_PASSWORD = 'password'
\ No newline at end of file
@@ -1,4 +1,4 @@
-#!/usr/bin/python
-# -*- coding: utf-8 -*-
-
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
 SQL_STATEMENT = """select * from my_schema.my_table limit 1000;"""
\ No newline at end of file
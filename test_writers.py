@@ -0,0 +1,61 @@
+#/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import unittest
+from decimal import Decimal
+from pgtypes import INT8_OID
+from pgtypes import JSONB_OID
+from pgtypes import NUMERIC_OID
+from pgtypes import TEXT_OID
+
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from writers import ParquetWriter
+
+
+@unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+class ParquetWriterTest(unittest.TestCase):
+    """Row groups after the first one have to fit the schema of the file, whatever values they hold."""
+
+    column_names = ['id', 'maybe', 'amount', 'document']
+    rows = [
+        (1, None, Decimal('2.5'), {'a': 1}),
+        (2, None, None, None),
+        (3, 'text', Decimal('3.125'), {'b': [1, 2]}),
+        (4, None, Decimal('-12345678901234567890.000001'), None),
+    ]
+
+    def setUp(self):
+        descriptor, self.filepath = tempfile.mkstemp(suffix='.parquet')
+        os.close(descriptor)
+
+    def tearDown(self):
+        os.remove(self.filepath)
+
+    def write(self, column_type_codes):
+        writer = ParquetWriter(self.filepath, 'Sheet1', self.column_names, column_type_codes, row_group_size=2)
+        writer.write(self.rows)
+        writer.close()
+        return pyarrow.parquet.read_table(self.filepath)
+
+    def test_type_codes(self):
+        table = self.write([INT8_OID, TEXT_OID, NUMERIC_OID, JSONB_OID])
+        self.assertEqual(pyarrow.parquet.ParquetFile(self.filepath).num_row_groups, 2)
+        self.assertEqual(table.column('id').to_pylist(), [1, 2, 3, 4])
+        self.assertEqual(table.column('maybe').to_pylist(), [None, None, 'text', None])
+        self.assertEqual(table.column('amount').to_pylist(), ['2.5', None, '3.125', '-12345678901234567890.000001'])
+        self.assertEqual(table.column('document').to_pylist(), ['{"a": 1}', None, '{"b": [1, 2]}', None])
+
+    def test_inferred_types(self):
+        table = self.write(None)
+        self.assertEqual(table.column('maybe').to_pylist(), [None, None, 'text', None])
+        self.assertEqual(table.column('amount').to_pylist(), ['2.5', None, '3.125', '-12345678901234567890.000001'])
+
+
+if __name__ == '__main__':
+    unittest.main()
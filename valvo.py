@@ -1,41 +1,119 @@
-#!/usr/bin/python
-# -*- coding: utf-8 -*-
-
-import config
-import sql
-from krano import Krano
-from exporter import  ExcelDecoration
-from exporter import  ExcelDecorationElement
-import jira
-
-
-def main_single():
-    creator = 'Your Name'
-    chunk_size = 250000
-    conn_name = 'Database PROD'
-    db_config = config.DATABASE_CONNECTION_SETTINGS[conn_name]
-    jira_issue = 'SMP-999'
-    jira_title = jira.getissuetitle(config.JIRA_BASE_URL, jira_issue, config.JIRA_USER , config.JIRA_PASSWORD)
-    xlsx_filename = 'Data_export_{0}_{1}.xlsx'.format(conn_name.replace(' ', '_'), jira_issue)
-
-    sql_statement = sql.SQL_STATEMENT
-
-    excel_decorations = []
-    excel_info_decoration = ExcelDecoration('Info', jira_title)
-    excel_info_decoration.add_element(ExcelDecorationElement('Created on', 'CURRENT_DATETIME'))
-    excel_info_decoration.add_element(ExcelDecorationElement('Created by', creator))
-    excel_info_decoration.add_element(ExcelDecorationElement('', ''))
-    excel_info_decoration.add_element(ExcelDecorationElement('Server', db_config['host']))
-    excel_info_decoration.add_element(ExcelDecorationElement('Database',  db_config['database_name']))
-    excel_info_decoration.add_element(ExcelDecorationElement('JIRA-URL', "https://{0}/{1}".format(config.JIRA_BASE_URL, jira_issue)))
-    excel_decorations.append(excel_info_decoration)
-
-    krano = Krano()
-    krano.set_database_config(db_config['connection_name'], db_config['host'], db_config['database_name'], db_config['user'], db_config['password'])
-    krano.set_export_config(config.EXPORT_FOLDERPATH)
-    krano.set_jira_config(config.JIRA_BASE_URL, config.JIRA_USER, config.JIRA_PASSWORD)
-    krano.export(sql_statement, xlsx_filename, config.XLSX_SHEET_NAME, chunk_size, config.EXPORT_OVERWRITE_FILES, config.EXPORT_PARALLEL_PROCESSES, excel_decorations, jira_issue)
-
-
-if __name__ == '__main__':
-    main_single()
\ No newline at end of file
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import sys
+import config
+import sql
+from batch import BatchExporter
+from batch import load_manifest
+from forwarders import JIRAClient
+from krano import Krano
+from postgresql import ConnectionSettings
+from exporter import  ExcelDecoration
+from exporter import  ExcelDecorationElement
+import jira
+from logconfig import configure_logging
+
+
+def get_export_options():
+    return dict(stream=config.EXPORT_STREAM_RECORDS, xlsx_engine=config.EXPORT_XLSX_ENGINE,
+                chunk_handoff=config.EXPORT_CHUNK_HANDOFF, fetch_method=config.EXPORT_FETCH_METHOD,
+                partitions=config.EXPORT_PARTITIONS, partition_column=config.EXPORT_PARTITION_COLUMN, partition_method=config.EXPORT_PARTITION_METHOD,
+                cache_mode=config.CACHE_MODE, output_format=config.EXPORT_OUTPUT_FORMAT,
+                max_file_size=config.EXPORT_MAX_FILE_SIZE_BYTES, upload_from_memory=config.JIRA_UPLOAD_FROM_MEMORY,
+                resume=config.EXPORT_RESUME, retries=config.EXPORT_PROCESS_RETRIES,
+                exact_decimal_columns=config.EXPORT_EXACT_DECIMAL_COLUMNS, columnar=config.EXPORT_COLUMNAR_RESULTS,
+                single_file=config.EXPORT_SINGLE_FILE, preflight=config.EXPORT_PREFLIGHT)
+
+
+def get_info_decoration(creator, db_config, jira_issue, jira_title):
+    excel_info_decoration = ExcelDecoration('Info', jira_title)
+    excel_info_decoration.add_element(ExcelDecorationElement('Created on', 'CURRENT_DATETIME'))
+    excel_info_decoration.add_element(ExcelDecorationElement('Created by', creator))
+    excel_info_decoration.add_element(ExcelDecorationElement('', ''))
+    excel_info_decoration.add_element(ExcelDecorationElement('Server', db_config['host']))
+    excel_info_decoration.add_element(ExcelDecorationElement('Database',  db_config['database_name']))
+    if jira_issue:
+        excel_info_decoration.add_element(ExcelDecorationElement('JIRA-URL', "https://{0}/{1}".format(config.JIRA_BASE_URL, jira_issue)))
+    return excel_info_decoration
+
+
+def main_single():
+    creator = 'Your Name'
+    chunk_size = 250000
+    conn_name = 'Database PROD'
+    db_config = config.DATABASE_CONNECTION_SETTINGS[conn_name]
+    jira_issue = 'SMP-999'
+    xlsx_filename = 'Data_export_{0}_{1}.xlsx'.format(conn_name.replace(' ', '_'), jira_issue)
+
+    sql_statement = sql.SQL_STATEMENT
+
+    async def get_decorations():
+        # the title is looked up while the query is executed
+        jira_title = await asyncio.get_running_loop().run_in_executor(None, jira.getissuetitle, config.JIRA_BASE_URL, jira_issue, config.JIRA_USER,
+                                                                      config.JIRA_PASSWORD)
+        return [get_info_decoration(creator, db_config, jira_issue, jira_title)]
+
+    krano = Krano()
+    krano.set_worker_config(config.EXPORT_WORKER_START_METHOD)
+    krano.set_database_config(db_config['connection_name'], db_config['host'], db_config['database_name'], db_config['user'], db_config['password'])
+    krano.set_export_config(config.EXPORT_FOLDERPATH)
+    krano.set_jira_config(config.JIRA_BASE_URL, config.JIRA_USER, config.JIRA_PASSWORD, config.JIRA_PARALLEL_UPLOADS, config.JIRA_MAX_RETRIES,
+                          config.JIRA_UPLOAD_BLOCK_SIZE)
+    if config.CACHE_FOLDERPATH:
+        krano.set_cache_config(config.CACHE_FOLDERPATH, config.CACHE_TTL_SECONDS, config.CACHE_MAX_SIZE_BYTES)
+    krano.set_metrics_config(config.METRICS_REPORT_FOLDERPATH, config.METRICS_PROMETHEUS_FOLDERPATH)
+    krano.set_preflight_config(config.EXPORT_PREFLIGHT_MAX_ROWS, config.EXPORT_PREFLIGHT_MAX_SIZE_BYTES, config.EXPORT_PREFLIGHT_REFUSE)
+    with krano:
+        krano.export(sql_statement, xlsx_filename, config.XLSX_SHEET_NAME, chunk_size, config.EXPORT_OVERWRITE_FILES, config.EXPORT_PARALLEL_PROCESSES, get_decorations(), jira_issue,
+                     **get_export_options())
+
+
+def main_batch(manifest_filepath):
+    creator = 'Your Name'
+    jobs = load_manifest(manifest_filepath)
+    jira_client = JIRAClient(config.JIRA_BASE_URL, config.JIRA_USER, config.JIRA_PASSWORD, max_connections=config.JIRA_PARALLEL_UPLOADS,
+                             max_retries=config.JIRA_MAX_RETRIES, block_size=config.JIRA_UPLOAD_BLOCK_SIZE)
+
+    connection_settings = {}
+    for conn_name, db_config in config.DATABASE_CONNECTION_SETTINGS.items():
+        connection_settings[conn_name] = ConnectionSettings(db_config['connection_name'], db_config['host'], db_config['database_name'],
+                                                            db_config['user'], db_config['password'])
+
+    async def get_decorations(job):
+        db_config = config.DATABASE_CONNECTION_SETTINGS[job.connection_name]
+        if job.jira_issue:
+            jira_title = await asyncio.get_running_loop().run_in_executor(None, lambda: jira.getissuetitle(
+                config.JIRA_BASE_URL, job.jira_issue, config.JIRA_USER, config.JIRA_PASSWORD, client=jira_client))
+        else:
+            jira_title = job.xlsx_filename
+        return [get_info_decoration(creator, db_config, job.jira_issue, jira_title)]
+
+    if config.CACHE_FOLDERPATH:
+        cache_config = (config.CACHE_FOLDERPATH, config.CACHE_TTL_SECONDS, config.CACHE_MAX_SIZE_BYTES)
+    else:
+        cache_config = None
+
+    batch_exporter = BatchExporter(connection_settings, config.EXPORT_FOLDERPATH, config.XLSX_SHEET_NAME, config.EXPORT_OVERWRITE_FILES,
+                                   config.EXPORT_PARALLEL_PROCESSES, config.BATCH_MAX_CONNECTIONS_PER_DATABASE,
+                                   jira_config=(config.JIRA_BASE_URL, config.JIRA_USER, config.JIRA_PASSWORD, config.JIRA_PARALLEL_UPLOADS, config.JIRA_MAX_RETRIES,
+                                                config.JIRA_UPLOAD_BLOCK_SIZE),
+                                   cache_config=cache_config,
+                                   metrics_config=(config.METRICS_REPORT_FOLDERPATH, config.METRICS_PROMETHEUS_FOLDERPATH),
+                                   preflight_config=(config.EXPORT_PREFLIGHT_MAX_ROWS, config.EXPORT_PREFLIGHT_MAX_SIZE_BYTES,
+                                                     config.EXPORT_PREFLIGHT_REFUSE),
+                                   decorations_factory=get_decorations, export_options=get_export_options(),
+                                   worker_start_method=config.EXPORT_WORKER_START_METHOD)
+    results = batch_exporter.run(jobs)
+    jira_client.close()
+    if not all(result.succeeded() for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    configure_logging()
+    if len(sys.argv) > 1:
+        main_batch(sys.argv[1])
+    else:
+        main_single()
\ No newline at end of file
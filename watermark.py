@@ -0,0 +1,136 @@
+#/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+import json
+import os
+from datetime import date
+from datetime import datetime
+from datetime import timezone
+from decimal import Decimal
+from manifest import write_atomically
+
+WATERMARK_VERSION = 1
+WATERMARK_EXTENSION = '.watermark.json'
+
+VALUE_TYPES = {'int': int, 'float': float, 'decimal': Decimal, 'datetime': datetime.fromisoformat, 'date': date.fromisoformat, 'str': str}
+
+
+def watermark_filepath(filepath_part):
+    """Returns the file path of the watermark of the incremental export creating the files starting with the given path."""
+    return filepath_part + WATERMARK_EXTENSION
+
+
+def encode_value(value):
+    """Returns a value of a watermark column as a JSON serialisable pair of its type and its text.
+
+    Raises:
+        ValueError: The value is neither a number, a date, a timestamp nor a text.
+    """
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        raise ValueError('A watermark column must be a number, a date, a timestamp or a text, got bool.')
+    for type_name, value_type in [('int', int), ('float', float), ('decimal', Decimal), ('datetime', datetime), ('date', date), ('str', str)]:
+        if isinstance(value, value_type):
+            return [type_name, value.isoformat() if isinstance(value, date) else str(value)]
+    raise ValueError('A watermark column must be a number, a date, a timestamp or a text, got {0}.'.format(type(value).__name__))
+
+
+def decode_value(encoded_value):
+    """Returns the value of a watermark column encoded by encode_value()."""
+    if encoded_value is None:
+        return None
+    type_name, text = encoded_value
+    return VALUE_TYPES[type_name](text)
+
+
+class Watermark(object):
+    """The state of an incremental export, stored in a JSON file next to its files.
+
+    It keeps the value of the watermark column exported last and the count of files created so far, so the next export only
+    fetches the rows above this value and numbers its files after the existing ones. The range of a started export is kept
+    as pending until the export succeeded, so a rerun after a failure exports the same range again instead of a larger one.
+
+    Args:
+        filepath (str): File path of the watermark.
+        column (str): The watermark column, an increasing column of the query result, e.g. an id or updated_at.
+        query_key (str): The fingerprint of the connection and the SQL query, see cache.cache_key().
+    """
+    def __init__(self, filepath, column, query_key):
+        self.filepath = filepath
+        self.column = column
+        self.query_key = query_key
+        self.data = {'version': WATERMARK_VERSION,
+                     'column': column,
+                     'query_key': query_key,
+                     'value': None,
+                     'file_count': 0,
+                     'exports': 0,
+                     'pending': None}
+
+    @classmethod
+    def load(cls, filepath, column, query_key):
+        """Loads the watermark of an incremental export, or starts a new one if it has none yet.
+
+        Raises:
+            ValueError: The watermark belongs to another SQL query, connection or watermark column.
+        """
+        watermark = cls(filepath, column, query_key)
+        if not os.path.isfile(filepath):
+            logger.info("No watermark at {0} yet, exporting all rows".format(filepath))
+            return watermark
+
+        with open(filepath, encoding='utf-8') as watermark_file:
+            data = json.load(watermark_file)
+
+        if data.get('column') != column or data.get('query_key') != query_key:
+            raise ValueError("The watermark at {0} belongs to another SQL query, connection or watermark column. "
+                             "Choose another file name or delete it to export all rows again.".format(filepath))
+
+        watermark.data = data
+        logger.info("Watermark at {0}: {1} = {2} after {3} export(s) and {4} file(s)".format(filepath, column, watermark.value, data['exports'],
+                                                                                           data['file_count']))
+        return watermark
+
+    @property
+    def value(self):
+        """The value of the watermark column exported last, None before the first export."""
+        return decode_value(self.data['value'])
+
+    @property
+    def file_count(self):
+        """The count of files created by the finished exports."""
+        return self.data['file_count']
+
+    @property
+    def pending_statement(self):
+        """The SQL statement of an export that was started but did not finish, None if there is none."""
+        return self.data['pending']['sql_statement'] if self.data['pending'] else None
+
+    def begin(self, sql_statement, upper):
+        """Records the restricted SQL statement and the highest value of the watermark column of the export about to start."""
+        self.data['pending'] = {'sql_statement': sql_statement, 'value': encode_value(upper)}
+        self.save()
+
+    def delta_range(self):
+        """Returns a description of the range of the pending export, e.g. 'id > 100 AND id <= 250'."""
+        upper = decode_value(self.data['pending']['value'])
+        if self.value is None:
+            return '{0} <= {1}'.format(self.column, upper)
+        return '{0} > {1} AND {0} <= {2}'.format(self.column, self.value, upper)
+
+    def commit(self, file_count):
+        """Moves the watermark to the highest value of the pending export, which created file_count files in total."""
+        self.data['value'] = self.data['pending']['value']
+        self.data['file_count'] = file_count
+        self.data['exports'] += 1
+        self.data['pending'] = None
+        self.save()
+        logger.info("Watermark at {0} moved to {1} = {2}".format(self.filepath, self.column, self.value))
+
+    def save(self):
+        """Writes the watermark atomically, see manifest.write_atomically()."""
+        self.data['updated_at'] = datetime.now(timezone.utc).isoformat()
+        write_atomically(self.filepath, json.dumps(self.data, indent=2))
@@ -0,0 +1,112 @@
+#/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+import importlib
+import multiprocessing
+import os
+import time
+from threading import Lock
+from logconfig import configure_logging
+
+START_FORKSERVER = 'forkserver'
+START_SPAWN = 'spawn'
+START_FORK = 'fork'
+START_METHODS = [START_FORKSERVER, START_SPAWN, START_FORK]
+
+# Imported once before the workers start, so no Excel export or decoration pays for them
+DEFAULT_PRELOAD_MODULES = ['xlsxwriter', 'openpyxl', 'pandas', 'pyarrow.parquet', 'writers', 'exporter', 'columnar']
+
+
+def _initialize_worker(modules, log_level):
+    """Configures the logging like in the main process and imports the given modules, skipping the ones that are not installed."""
+    if log_level is not None:
+        configure_logging(log_level)
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+
+
+def _worker_ready(_):
+    return os.getpid()
+
+
+class WorkerPool(object):
+    """A process pool that is started once and shared by the Excel export and decoration of successive exports.
+
+    With the 'forkserver' start method the preloaded modules are imported once into the fork server, every worker
+    is forked from there with the modules already imported. With 'spawn' every worker imports them once when it
+    starts. Either way the workers do not inherit the database connections, threads and memory of the main process.
+    Scripts using a 'forkserver' or 'spawn' pool must guard their entry point with if __name__ == '__main__'.
+
+    Args:
+        processes (int): The count of worker processes.
+        start_method (str): 'forkserver', 'spawn' or 'fork', defaults to 'forkserver' ('spawn' where it is not available).
+        preload_modules (list): The names of the modules imported before the workers start, defaults to DEFAULT_PRELOAD_MODULES.
+    """
+    def __init__(self, processes, start_method=START_FORKSERVER, preload_modules=None):
+        if start_method not in START_METHODS:
+            raise ValueError("Unknown start method '{0}', choose one of: {1}".format(start_method, ', '.join(START_METHODS)))
+        if start_method not in multiprocessing.get_all_start_methods():
+            start_method = START_SPAWN
+
+        self.processes = processes
+        self.start_method = start_method
+        self.preload_modules = DEFAULT_PRELOAD_MODULES if preload_modules is None else preload_modules
+        self.startup_duration = None
+        self.task_count = 0
+        self.pool = None
+        self.lock = Lock()
+
+    def start(self):
+        """Starts the workers and waits until all of them are ready, unless the pool is already running."""
+        if self.pool is not None:
+            return
+
+        logger.info('Starting a worker pool with {0} {1} process(es), preloading {2}...'.format(self.processes, self.start_method,
+                                                                                             ', '.join(self.preload_modules) or 'nothing'))
+        start_time = time.monotonic()
+        root_logger = logging.getLogger()
+        log_level = root_logger.level if root_logger.handlers else None
+        context = multiprocessing.get_context(self.start_method)
+        if self.start_method == START_FORKSERVER:
+            context.set_forkserver_preload(self.preload_modules)
+        self.pool = context.Pool(processes=self.processes, initializer=_initialize_worker, initargs=(self.preload_modules, log_level))
+        self.pool.map(_worker_ready, range(self.processes), chunksize=1)
+        self.startup_duration = time.monotonic() - start_time
+        logger.info('Worker pool started in {0:.3f}s'.format(self.startup_duration))
+
+    def is_warm(self):
+        """Indicates whether the workers already ran tasks, e.g. for an earlier export."""
+        return self.task_count > 0
+
+    def apply_async(self, func, args=(), kwds=None, callback=None, error_callback=None):
+        """Runs func in a worker, see multiprocessing.pool.Pool.apply_async. Starts the pool if it is not running yet."""
+        with self.lock:
+            self.start()
+            self.task_count += 1
+        return self.pool.apply_async(func, args, kwds or {}, callback=callback, error_callback=error_callback)
+
+    def close(self):
+        """Lets the workers finish their tasks and stops them."""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def terminate(self):
+        """Stops the workers immediately."""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
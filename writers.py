@@ -0,0 +1,464 @@
+#/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+import csv
+import gzip
+import io
+import json
+import os
+import zipfile
+from datetime import date
+from datetime import datetime
+from datetime import time
+from datetime import timedelta
+from itertools import islice
+from time import perf_counter
+from pgtypes import BOOL_OID
+from pgtypes import BPCHAR_OID
+from pgtypes import BYTEA_OID
+from pgtypes import DATE_OID
+from pgtypes import FLOAT_OIDS
+from pgtypes import INTEGER_OIDS
+from pgtypes import JSON_OIDS
+from pgtypes import NUMBER_OIDS
+from pgtypes import STRING_OIDS
+from pgtypes import TIME_OID
+from pgtypes import TIMESTAMP_OID
+from pgtypes import TIMESTAMPTZ_OID
+from pgtypes import TEXT_OID
+from pgtypes import VARCHAR_OID
+
+FORMAT_XLSX = 'xlsx'
+FORMAT_CSV = 'csv'
+FORMAT_CSV_GZ = 'csv.gz'
+FORMAT_PARQUET = 'parquet'
+
+# The maximum number of rows of an XLSX worksheet, the header row takes one of them
+XLSX_MAX_ROWS = 1048576
+
+
+def write_decorations(workbook, decorations):
+    """Adds one worksheet per decoration to an xlsxwriter workbook that is still being written.
+
+    The layout matches the one of exporter.ExcelDecorator: the title in B3, followed by the labels in column B
+    and the contents in column C starting at row 6.
+
+    Args:
+        workbook (xlsxwriter.Workbook): The workbook to add the decoration worksheets to.
+        decorations (list): The ExcelDecoration objects to be written.
+    """
+    title_format = workbook.add_format({'font_name': 'Calibri', 'font_size': 22, 'font_color': '#000000'})
+    key_format = workbook.add_format({'font_name': 'Calibri', 'font_size': 11, 'bold': True, 'font_color': '#000000', 'align': 'right'})
+    value_format = workbook.add_format({'font_name': 'Calibri', 'font_size': 11, 'font_color': '#000000', 'align': 'left'})
+    datetime_value_format = workbook.add_format({'font_name': 'Calibri', 'font_size': 11, 'font_color': '#000000', 'align': 'left',
+                                                 'num_format': 'yyyy-mm-dd hh:mm:ss'})
+    duration_value_format = workbook.add_format({'font_name': 'Calibri', 'font_size': 11, 'font_color': '#000000', 'align': 'left',
+                                                 'num_format': '[h]:mm:ss'})
+
+    for decoration in decorations:
+        ws = workbook.add_worksheet(decoration.sheet_name)
+        ws.write_string(2, 1, str(decoration.title), title_format)
+
+        row_index = 5
+        for element in decoration.elements:
+            content = element.get_content()
+            ws.write_string(row_index, 1, str(element.label), key_format)
+            if isinstance(content, timedelta):
+                ws.write_datetime(row_index, 2, content, duration_value_format)
+            elif isinstance(content, (datetime, date, time)):
+                ws.write_datetime(row_index, 2, content, datetime_value_format)
+            elif content is None or isinstance(content, (str, int, float, bool)):
+                ws.write(row_index, 2, content, value_format)
+            else:
+                ws.write_string(row_index, 2, str(content), value_format)
+            row_index += 1
+
+
+class XlsxRowWriter(object):
+    """Streams rows (tuples) straight into an XLSX file using xlsxwriter in constant memory mode.
+
+    Every row is flushed to disk as soon as the next one is started, so the writer never holds more than one
+    row in memory. The write function for each column is chosen once from the PostgreSQL type OIDs instead
+    of dispatching on the Python type of every single cell. Unlike the pandas engine no index column is written.
+
+    Args:
+        filepath (str or file object): File path of the Excel file to be created, or a binary file object, e.g. io.BytesIO,
+            in which case the workbook is assembled in memory.
+        sheet_name (str): The name of the worksheet to be created.
+        column_names (list): The column names used as header information.
+        column_type_codes (list): The PostgreSQL type OIDs of the columns, defaults to None (dispatch by value).
+    """
+    engine = 'native'
+    output_format = FORMAT_XLSX
+    supports_decorations = True
+
+    def __init__(self, filepath, sheet_name, column_names, column_type_codes=None):
+        self.filepath = filepath
+        self.sheet_name = sheet_name
+        self.column_names = column_names
+        self.column_type_codes = column_type_codes or [None] * len(column_names)
+
+        from xlsxwriter import Workbook
+
+        self.workbook = Workbook(self.filepath, {'constant_memory': True,
+                                                 'in_memory': not isinstance(self.filepath, str),
+                                                 'remove_timezone': True,
+                                                 'strings_to_formulas': False,
+                                                 'nan_inf_to_errors': True})
+        self.worksheet = self.workbook.add_worksheet(self.sheet_name)
+        self.header_format = self.workbook.add_format({'bold': True, 'border': 1, 'align': 'center'})
+        self.date_format = self.workbook.add_format({'num_format': 'yyyy-mm-dd'})
+        self.datetime_format = self.workbook.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'})
+        self.time_format = self.workbook.add_format({'num_format': 'hh:mm:ss'})
+        self.row_index = 0
+
+    def _column_writer(self, type_code):
+        """Returns the function writing a single non-NULL cell of a column with the given type OID."""
+        ws = self.worksheet
+
+        if type_code in NUMBER_OIDS:
+            return ws.write_number
+        if type_code in STRING_OIDS:
+            return ws.write_string
+        if type_code == BOOL_OID:
+            return ws.write_boolean
+        if type_code == DATE_OID:
+            return lambda row, col, value: ws.write_datetime(row, col, value, self.date_format)
+        if type_code in (TIMESTAMP_OID, TIMESTAMPTZ_OID):
+            return lambda row, col, value: ws.write_datetime(row, col, value, self.datetime_format)
+        if type_code == TIME_OID:
+            return lambda row, col, value: ws.write_datetime(row, col, value, self.time_format)
+        return self._write_other
+
+    def _write_other(self, row, col, value):
+        """Writes a cell of a type without a dedicated write function, e.g. json, uuid or arrays."""
+        try:
+            self.worksheet.write(row, col, value)
+        except TypeError:
+            self.worksheet.write_string(row, col, str(value))
+
+    def write(self, records):
+        """Writes the header row followed by the given records."""
+        ws = self.worksheet
+        ws.write_row(0, 0, self.column_names, self.header_format)
+
+        column_writers = list(enumerate(self._column_writer(type_code) for type_code in self.column_type_codes))
+        row_index = 0
+        for record in records:
+            row_index += 1
+            if row_index >= XLSX_MAX_ROWS:
+                # xlsxwriter ignores cells beyond the last row and only signals it with a return value of -1
+                raise ValueError("The records exceed {0} rows, the maximum number of rows in an XLSX file less the header row."
+                                 .format(XLSX_MAX_ROWS - 1))
+            for col, write_cell in column_writers:
+                value = record[col]
+                if value is not None:
+                    write_cell(row_index, col, value)
+        self.row_index = row_index
+
+    def write_decorations(self, decorations):
+        """Adds the given ExcelDecoration objects as additional worksheets."""
+        write_decorations(self.workbook, decorations)
+
+    def close(self):
+        """Finishes the XLSX file."""
+        self.workbook.close()
+
+
+class PandasXlsxWriter(object):
+    """Writes rows (tuples) into an XLSX file by building a pandas DataFrame first.
+
+    This is the original export path and only available if pandas is installed. It holds the records several
+    times in memory and is mainly kept as a fallback and as a reference for benchmarks. The seconds needed for
+    building the DataFrame are kept in the frame_build_duration attribute.
+
+    Args:
+        filepath (str or file object): File path of the Excel file to be created, or a binary file object.
+        sheet_name (str): The name of the worksheet to be created.
+        column_names (list): The column names used as header information.
+        column_type_codes (list): Ignored, pandas infers the column types itself.
+    """
+    engine = 'pandas'
+    output_format = FORMAT_XLSX
+    supports_decorations = True
+
+    def __init__(self, filepath, sheet_name, column_names, column_type_codes=None):
+        from pandas import ExcelWriter
+
+        self.filepath = filepath
+        self.sheet_name = sheet_name
+        self.column_names = column_names
+        self.writer = ExcelWriter(self.filepath, engine='xlsxwriter', engine_kwargs={'options': {'remove_timezone': True,
+                                                                                                 'strings_to_formulas': False}})
+        self.workbook = self.writer.book
+        self.frame_build_duration = None
+
+    def write(self, records):
+        """Writes the records as a DataFrame including its index."""
+        from pandas import DataFrame
+
+        frame_build_start_time = perf_counter()
+        if not isinstance(records, list):
+            records = list(records)
+        df = DataFrame(records, columns=self.column_names)
+        for column in df.select_dtypes(include=['datetimetz']).columns:
+            df[column] = df[column].dt.tz_localize(None)
+        self.frame_build_duration = perf_counter() - frame_build_start_time
+        df.to_excel(self.writer, sheet_name=self.sheet_name)
+
+    def write_decorations(self, decorations):
+        """Adds the given ExcelDecoration objects as additional worksheets."""
+        write_decorations(self.workbook, decorations)
+
+    def close(self):
+        """Finishes the XLSX file."""
+        self.writer.close()
+
+
+class CsvRowWriter(object):
+    """Streams rows (tuples) into a UTF-8 encoded CSV file with a header row.
+
+    NULL values are written as empty fields, all other values as their string representation, e.g.
+    '2019-01-31 12:00:00' for timestamps.
+
+    Args:
+        filepath (str or file object): File path of the CSV file to be created, or a binary file object.
+        sheet_name (str): Ignored, CSV files have no worksheets.
+        column_names (list): The column names used as header information.
+        column_type_codes (list): Ignored, every value is written as text.
+    """
+    engine = 'native'
+    output_format = FORMAT_CSV
+    supports_decorations = False
+
+    def __init__(self, filepath, sheet_name, column_names, column_type_codes=None):
+        self.filepath = filepath
+        self.column_names = column_names
+        self.file = self._open()
+
+    def _open(self):
+        if not isinstance(self.filepath, str):
+            return io.TextIOWrapper(self.filepath, encoding='utf-8', newline='')
+        return open(self.filepath, mode='w', encoding='utf-8', newline='', buffering=1048576)
+
+    def write(self, records):
+        """Writes the header row followed by the given records."""
+        writer = csv.writer(self.file)
+        writer.writerow(self.column_names)
+        writer.writerows(records)
+
+    def write_decorations(self, decorations):
+        """Does nothing, decorations can only be written into XLSX files."""
+        pass
+
+    def close(self):
+        """Finishes the CSV file, a given file object is left open."""
+        if isinstance(self.filepath, str):
+            self.file.close()
+        else:
+            self.file.flush()
+            self.file.detach()
+
+
+class GzipCsvRowWriter(CsvRowWriter):
+    """Streams rows (tuples) into a gzip compressed CSV file, see CsvRowWriter."""
+    output_format = FORMAT_CSV_GZ
+
+    def _open(self):
+        if not isinstance(self.filepath, str):
+            return io.TextIOWrapper(gzip.GzipFile(fileobj=self.filepath, mode='wb', compresslevel=6), encoding='utf-8', newline='')
+        return gzip.open(self.filepath, mode='wt', compresslevel=6, encoding='utf-8', newline='')
+
+    def close(self):
+        """Finishes the gzip compressed CSV file, a given file object is left open."""
+        self.file.close()
+
+
+class ParquetWriter(object):
+    """Writes rows (tuples) into a Parquet file, only available if pyarrow is installed.
+
+    The column types are taken from the PostgreSQL type OIDs, so every row group has the schema of the file. NUMERIC columns
+    are written as strings with all their digits, as their precision and scale are not known from the OID, JSON values as
+    JSON text and all other types without an Arrow counterpart (uuid, interval, arrays, ...) as their string representation.
+    Without type OIDs the types are inferred by pyarrow from the first row group, columns that are NULL or decimal there
+    are written as strings. The rows are converted and written in row groups.
+
+    Args:
+        filepath (str or file object): File path of the Parquet file to be created, or a binary file object.
+        sheet_name (str): Ignored, Parquet files have no worksheets.
+        column_names (list): The column names.
+        column_type_codes (list): The PostgreSQL type OIDs of the columns, defaults to None (types inferred by pyarrow).
+        row_group_size (int): The count of rows per row group, defaults to 100000.
+    """
+    engine = 'native'
+    output_format = FORMAT_PARQUET
+    supports_decorations = False
+
+    def __init__(self, filepath, sheet_name, column_names, column_type_codes=None, row_group_size=100000):
+        import pyarrow
+
+        self.pyarrow = pyarrow
+        self.filepath = filepath
+        self.column_names = column_names
+        self.column_type_codes = column_type_codes or [None] * len(column_names)
+        self.row_group_size = row_group_size
+        self.column_types = [self._arrow_type(type_code) for type_code in self.column_type_codes]
+        self.writer = None
+
+    def _arrow_type(self, type_code):
+        """Returns the pyarrow type for a PostgreSQL type OID, None if the OID is not known and pyarrow has to infer it."""
+        pa = self.pyarrow
+        if type_code is None:
+            return None
+        if type_code in INTEGER_OIDS:
+            return pa.int64()
+        if type_code in FLOAT_OIDS:
+            return pa.float64()
+        if type_code == BOOL_OID:
+            return pa.bool_()
+        if type_code in (TEXT_OID, VARCHAR_OID, BPCHAR_OID):
+            return pa.string()
+        if type_code == DATE_OID:
+            return pa.date32()
+        if type_code == TIMESTAMP_OID:
+            return pa.timestamp('us')
+        if type_code == TIMESTAMPTZ_OID:
+            return pa.timestamp('us', tz='UTC')
+        if type_code == TIME_OID:
+            return pa.time64('us')
+        if type_code == BYTEA_OID:
+            return pa.binary()
+        return pa.string()
+
+    def _string_array(self, values, index):
+        convert = json.dumps if self.column_type_codes[index] in JSON_OIDS else str
+        return self.pyarrow.array([None if value is None else convert(value) for value in values], type=self.pyarrow.string())
+
+    def _column_array(self, values, index):
+        pa = self.pyarrow
+        column_type = self.column_types[index]
+        if column_type is not None and pa.types.is_binary(column_type):
+            values = [None if value is None else bytes(value) for value in values]
+        try:
+            array = pa.array(values, type=column_type)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            if column_type is not None and not pa.types.is_string(column_type):
+                raise
+            return self._string_array(values, index)
+        if column_type is None and (pa.types.is_null(array.type) or pa.types.is_decimal(array.type)):
+            # a NULL or decimal type inferred from the first row group would not fit the values of the later ones
+            return self._string_array(values, index)
+        return array
+
+    def write(self, records):
+        """Writes the given records in row groups of row_group_size rows."""
+        import pyarrow.parquet
+
+        pa = self.pyarrow
+        rows = iter(records)
+        row_group = list(islice(rows, self.row_group_size))
+        while row_group:
+            columns = list(zip(*row_group))
+            arrays = [self._column_array(list(values), index) for index, values in enumerate(columns)]
+            table = pa.Table.from_arrays(arrays, names=self.column_names)
+
+            if self.writer is None:
+                # Types inferred from the first row group are kept for the whole file
+                self.column_types = [array.type for array in arrays]
+                self.writer = pyarrow.parquet.ParquetWriter(self.filepath, table.schema, compression='snappy')
+            elif table.schema != self.writer.schema:
+                table = table.cast(self.writer.schema)
+            self.writer.write_table(table)
+            row_group = list(islice(rows, self.row_group_size))
+
+    def write_decorations(self, decorations):
+        """Does nothing, decorations can only be written into XLSX files."""
+        pass
+
+    def close(self):
+        """Finishes the Parquet file."""
+        if self.writer is None:
+            import pyarrow.parquet
+
+            schema = self.pyarrow.schema([(name, column_type or self.pyarrow.null())
+                                          for name, column_type in zip(self.column_names, self.column_types)])
+            self.writer = pyarrow.parquet.ParquetWriter(self.filepath, schema, compression='snappy')
+        self.writer.close()
+
+
+XLSX_WRITERS = {
+    XlsxRowWriter.engine: XlsxRowWriter,
+    PandasXlsxWriter.engine: PandasXlsxWriter
+}
+
+WRITERS = {
+    FORMAT_CSV: CsvRowWriter,
+    FORMAT_CSV_GZ: GzipCsvRowWriter,
+    FORMAT_PARQUET: ParquetWriter
+}
+
+OUTPUT_FORMATS = [FORMAT_XLSX] + list(WRITERS)
+
+
+def get_xlsx_writer(engine):
+    """Returns the XLSX writer class for the given engine name ('native' or 'pandas').
+
+    Raises:
+        ValueError: The given engine is unknown.
+    """
+    try:
+        return XLSX_WRITERS[engine]
+    except KeyError:
+        raise ValueError("Unknown XLSX engine '{0}', choose one of: {1}".format(engine, ', '.join(XLSX_WRITERS)))
+
+
+def get_writer(output_format, engine='native'):
+    """Returns the writer class for the given output format, the engine only matters for XLSX files.
+
+    Raises:
+        ValueError: The given output format or XLSX engine is unknown.
+    """
+    if output_format == FORMAT_XLSX:
+        return get_xlsx_writer(engine)
+    try:
+        return WRITERS[output_format]
+    except KeyError:
+        raise ValueError("Unknown output format '{0}', choose one of: {1}".format(output_format, ', '.join(OUTPUT_FORMATS)))
+
+
+def split_output_extension(filepath):
+    """Splits a file path into the part before the extension and the extension, e.g. '.csv.gz' for compressed CSV files."""
+    for output_format in sorted(OUTPUT_FORMATS, key=len, reverse=True):
+        extension = '.' + output_format
+        if filepath.lower().endswith(extension) and len(filepath) > len(extension):
+            return filepath[:-len(extension)], filepath[-len(extension):]
+    return os.path.splitext(filepath)
+
+
+def output_format_for_filename(filename, default=FORMAT_XLSX):
+    """Returns the output format matching the extension of the given filename, the default if there is none."""
+    extension = split_output_extension(filename)[1].lower().lstrip('.')
+    return extension if extension in OUTPUT_FORMATS else default
+
+
+def is_complete_file(filepath, output_format):
+    """Indicates whether an existing file was written completely, e.g. to tell a truncated leftover of a crashed export.
+
+    Only the end of the file is read: XLSX files end with the central directory of their zip archive, Parquet files with
+    their footer. CSV files have no such ending and always count as complete.
+    """
+    try:
+        if output_format == FORMAT_XLSX:
+            return zipfile.is_zipfile(filepath)
+        if output_format == FORMAT_PARQUET:
+            with open(filepath, 'rb') as parquet_file:
+                parquet_file.seek(0, os.SEEK_END)
+                if parquet_file.tell() < 12:
+                    return False
+                parquet_file.seek(-4, os.SEEK_END)
+                return parquet_file.read() == b'PAR1'
+    except OSError:
+        return False
+    return True
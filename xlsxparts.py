@@ -0,0 +1,437 @@
+#/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+import io
+import re
+import struct
+import zipfile
+import zlib
+from datetime import date
+from datetime import datetime
+from datetime import time
+from datetime import timedelta
+from decimal import Decimal
+from pgtypes import BOOL_OID
+from pgtypes import DATE_OID
+from pgtypes import NUMBER_OIDS
+from pgtypes import STRING_OIDS
+from pgtypes import TIME_OID
+from pgtypes import TIMESTAMP_OID
+from pgtypes import TIMESTAMPTZ_OID
+from writers import XLSX_MAX_ROWS
+from writers import XlsxRowWriter
+
+XLSX_MAX_STRING_LENGTH = 32767
+SHEET_ENTRY_NAME = 'xl/worksheets/sheet1.xml'
+
+ZIP32_LIMIT = 0xFFFFFFFF
+ZIP_DOS_DATE = (1 << 5) | 1  # 1980-01-01, like xlsxwriter
+ZIP_DOS_TIME = 0
+
+# Excel counts the days since 1899-12-31 and wrongly treats 1900 as a leap year, see xlsxwriter.utility
+EXCEL_EPOCH = datetime(1899, 12, 31)
+EXCEL_EPOCH_ORDINAL = EXCEL_EPOCH.toordinal()
+
+_special_characters = re.compile('[&<>\x00-\x08\x0b-\x1f\ufffe\uffff]|_x[0-9a-fA-F]{4}_')
+_escaped_sequences = re.compile('(_x[0-9a-fA-F]{4}_)')
+_control_characters = re.compile('([\x00-\x08\x0b-\x1f])')
+_dimension = re.compile('<dimension ref="[^"]*"/>')
+
+
+def _gf2_matrix_times(matrix, vector):
+    total = 0
+    index = 0
+    while vector:
+        if vector & 1:
+            total ^= matrix[index]
+        vector >>= 1
+        index += 1
+    return total
+
+
+def _gf2_matrix_square(matrix):
+    return [_gf2_matrix_times(matrix, matrix[index]) for index in range(32)]
+
+
+def crc32_combine(crc1, crc2, length2):
+    """Returns the CRC-32 of two concatenated byte strings from their CRC-32 values and the length of the second one.
+
+    A port of crc32_combine() of zlib, which Python does not expose. It lets the worker processes compute the checksum
+    of their own part of the worksheet, so the parent process never has to see the uncompressed XML.
+    """
+    if length2 <= 0:
+        return crc1
+
+    odd = [0xEDB88320] + [1 << index for index in range(31)]
+    even = _gf2_matrix_square(odd)
+    odd = _gf2_matrix_square(even)
+    while True:
+        even = _gf2_matrix_square(odd)
+        if length2 & 1:
+            crc1 = _gf2_matrix_times(even, crc1)
+        length2 >>= 1
+        if not length2:
+            break
+        odd = _gf2_matrix_square(even)
+        if length2 & 1:
+            crc1 = _gf2_matrix_times(odd, crc1)
+        length2 >>= 1
+        if not length2:
+            break
+    return crc1 ^ crc2
+
+
+def escape_string(value):
+    """Escapes a string for an inline string cell like xlsxwriter does, control characters as _xHHHH_."""
+    value = _escaped_sequences.sub(r'_x005F\1', value)
+    value = _control_characters.sub(lambda match: '_x{0:04X}_'.format(ord(match.group(1))), value)
+    value = value.replace('\ufffe', '_xFFFE_').replace('\uffff', '_xFFFF_')
+    return value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def excel_serial(value):
+    """Returns a date, datetime or time as Excel serial number, the same number xlsxwriter writes."""
+    if isinstance(value, datetime):
+        delta = value.replace(tzinfo=None) - EXCEL_EPOCH
+        serial = delta.days + (delta.seconds + delta.microseconds / 1e6) / 86400
+        if value.year == 1900 and value.month == 1 and value.day == 1:
+            serial -= 1
+    elif isinstance(value, date):
+        serial = value.toordinal() - EXCEL_EPOCH_ORDINAL
+    elif isinstance(value, time):
+        return (value.hour * 3600 + value.minute * 60 + value.second + value.microsecond / 1e6) / 86400
+    else:
+        return value.days + (value.seconds + value.microseconds / 1e6) / 86400
+    return serial + 1 if serial > 59 else serial
+
+
+def _number_cell(reference, value, style=''):
+    text = '{0:.16G}'.format(value)
+    if text[-1] in 'NF':
+        # NaN and infinity, written as errors like xlsxwriter's nan_inf_to_errors option does
+        if text[-1] == 'N':
+            return '<c r="{0}"{1} t="e"><f>#NUM!</f><v>#NUM!</v></c>'.format(reference, style)
+        return '<c r="{0}"{1} t="e"><f>{2}1/0</f><v>#DIV/0!</v></c>'.format(reference, style, '-' if text[0] == '-' else '')
+    return '<c r="{0}"{1}><v>{2}</v></c>'.format(reference, style, text)
+
+
+def _string_cell(reference, value):
+    if len(value) > XLSX_MAX_STRING_LENGTH:
+        value = value[:XLSX_MAX_STRING_LENGTH]
+    if _special_characters.search(value):
+        value = escape_string(value)
+    if value and (value[0].isspace() or value[-1].isspace()):
+        return '<c r="{0}" t="inlineStr"><is><t xml:space="preserve">{1}</t></is></c>'.format(reference, value)
+    return '<c r="{0}" t="inlineStr"><is><t>{1}</t></is></c>'.format(reference, value)
+
+
+def _boolean_cell(reference, value):
+    return '<c r="{0}" t="b"><v>{1}</v></c>'.format(reference, 1 if value else 0)
+
+
+class SheetPart(object):
+    """A range of rows of a worksheet as raw deflate data, ready to be stitched into the worksheet of an XLSX file.
+
+    Args:
+        data (bytes): The compressed XML of the rows, ending with a sync flush so further parts can be appended.
+        crc (int): The CRC-32 of the uncompressed XML.
+        length (int): The length of the uncompressed XML in bytes.
+        row_count (int): The count of rows in the part.
+    """
+    def __init__(self, data, crc, length, row_count):
+        self.data = data
+        self.crc = crc
+        self.length = length
+        self.row_count = row_count
+
+
+class SheetPartWriter(object):
+    """Writes a range of rows into the XML of a worksheet and compresses it, see StitchedXlsxWriter.
+
+    The cells are written like XlsxRowWriter writes them, the write function of each column is chosen once from the
+    PostgreSQL type OIDs. Strings are written as inline strings, as xlsxwriter does in constant memory mode.
+
+    Args:
+        column_type_codes (list): The PostgreSQL type OIDs of the columns.
+        styles (dict): The cell format indexes of the 'date', 'datetime' and 'time' columns, see StitchedXlsxWriter.styles.
+        compression_level (int): The zlib compression level, defaults to the one of xlsxwriter.
+        batch_rows (int): The count of rows compressed at once, defaults to 1000.
+    """
+    def __init__(self, column_type_codes, styles, compression_level=zlib.Z_DEFAULT_COMPRESSION, batch_rows=1000):
+        from xlsxwriter.utility import xl_col_to_name
+
+        self.column_type_codes = column_type_codes
+        self.styles = styles
+        self.compression_level = compression_level
+        self.batch_rows = batch_rows
+        self.column_letters = [xl_col_to_name(col) for col in range(len(column_type_codes))]
+
+    def _column_writer(self, type_code):
+        """Returns the function writing a single non-NULL cell of a column with the given type OID."""
+        if type_code in NUMBER_OIDS:
+            return _number_cell
+        if type_code in STRING_OIDS:
+            return _string_cell
+        if type_code == BOOL_OID:
+            return _boolean_cell
+        if type_code == DATE_OID:
+            return self._datetime_writer(self.styles['date'])
+        if type_code in (TIMESTAMP_OID, TIMESTAMPTZ_OID):
+            return self._datetime_writer(self.styles['datetime'])
+        if type_code == TIME_OID:
+            return self._datetime_writer(self.styles['time'])
+        return _other_cell
+
+    def _datetime_writer(self, style_index):
+        style = ' s="{0}"'.format(style_index)
+        return lambda reference, value: _number_cell(reference, excel_serial(value), style)
+
+    def write(self, records, first_row_number):
+        """Returns the given records as SheetPart, the first one written into the row with the given number (1 based)."""
+        compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, -15)
+        column_writers = [(col, letter, self._column_writer(type_code))
+                          for col, (letter, type_code) in enumerate(zip(self.column_letters, self.column_type_codes))]
+        data = []
+        crc = 0
+        length = 0
+        row_count = 0
+        rows = []
+        row_number = first_row_number
+        for record in records:
+            number = str(row_number)
+            cells = [write_cell(letter + number, record[col]) for col, letter, write_cell in column_writers if record[col] is not None]
+            if cells:
+                # Like xlsxwriter, rows without any value are left out
+                rows.append('<row r="{0}">{1}</row>'.format(number, ''.join(cells)))
+            row_number += 1
+            row_count += 1
+            if len(rows) >= self.batch_rows:
+                crc, length = self._compress(compressor, rows, data, crc, length)
+                rows = []
+
+        crc, length = self._compress(compressor, rows, data, crc, length)
+        data.append(compressor.flush(zlib.Z_SYNC_FLUSH))
+        return SheetPart(b''.join(data), crc, length, row_count)
+
+    def _compress(self, compressor, rows, data, crc, length):
+        xml = ''.join(rows).encode('utf-8')
+        data.append(compressor.compress(xml))
+        return zlib.crc32(xml, crc), length + len(xml)
+
+
+def _other_cell(reference, value):
+    """Writes a cell of a type without a dedicated write function by its value, like XlsxRowWriter._write_other()."""
+    if isinstance(value, bool):
+        return _boolean_cell(reference, value)
+    if isinstance(value, (int, float, Decimal)):
+        return _number_cell(reference, value)
+    if isinstance(value, (date, time, timedelta)):
+        # Written without a number format, like xlsxwriter's write() does
+        return _number_cell(reference, excel_serial(value))
+    return _string_cell(reference, value if isinstance(value, str) else str(value))
+
+
+class ZipEntry(object):
+    def __init__(self, name, offset, zip64=False):
+        self.name = name.encode('utf-8')
+        self.offset = offset
+        self.zip64 = zip64
+        self.crc = 0
+        self.compressed_size = 0
+        self.size = 0
+
+
+class ZipWriter(object):
+    """Writes a zip container from already deflated data, e.g. the parts of a worksheet compressed by several processes.
+
+    Raw deflate streams ending with a sync flush can be concatenated, so an entry is written part by part and its
+    CRC-32 is combined from the ones of the parts. The sizes and the CRC-32 are patched into the local header once
+    the entry is complete, the file object has to be seekable. Zip64 records are written where the sizes need them.
+
+    Args:
+        fileobj (file object): A binary, seekable file object.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.entries = []
+        self.entry = None
+
+    def write_entry(self, name, data, compression_level=zlib.Z_DEFAULT_COMPRESSION):
+        """Compresses and writes a complete entry."""
+        compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -15)
+        self.begin_entry(name)
+        self.write_compressed(compressor.compress(data) + compressor.flush(), zlib.crc32(data), len(data))
+        self.end_entry()
+
+    def begin_entry(self, name, zip64=False):
+        """Starts an entry, zip64 has to be set if its sizes might exceed 4 GB."""
+        entry = ZipEntry(name, self.fileobj.tell(), zip64)
+        extra = struct.pack('<HHQQ', 0x0001, 16, 0, 0) if zip64 else b''
+        self.fileobj.write(struct.pack('<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20, 0, zipfile.ZIP_DEFLATED, ZIP_DOS_TIME, ZIP_DOS_DATE,
+                                       0, 0, 0, len(entry.name), len(extra)))
+        self.fileobj.write(entry.name)
+        self.fileobj.write(extra)
+        self.entry = entry
+
+    def write_compressed(self, data, crc, length):
+        """Appends raw deflate data to the current entry, given the CRC-32 and the length of its uncompressed content."""
+        entry = self.entry
+        self.fileobj.write(data)
+        entry.crc = crc32_combine(entry.crc, crc, length)
+        entry.compressed_size += len(data)
+        entry.size += length
+
+    def end_entry(self):
+        """Finishes the current entry, patching its CRC-32 and sizes into the local header.
+
+        Raises:
+            ValueError: The entry exceeds 4 GB but was not started as zip64 entry.
+        """
+        entry = self.entry
+        if not entry.zip64 and max(entry.size, entry.compressed_size) > ZIP32_LIMIT:
+            raise ValueError("The zip entry {0} is larger than 4 GB".format(entry.name.decode('utf-8')))
+
+        end = self.fileobj.tell()
+        self.fileobj.seek(entry.offset + 14)
+        if entry.zip64:
+            self.fileobj.write(struct.pack('<III', entry.crc, ZIP32_LIMIT, ZIP32_LIMIT))
+            self.fileobj.seek(entry.offset + 30 + len(entry.name) + 4)
+            self.fileobj.write(struct.pack('<QQ', entry.size, entry.compressed_size))
+        else:
+            self.fileobj.write(struct.pack('<III', entry.crc, entry.compressed_size, entry.size))
+        self.fileobj.seek(end)
+        self.entries.append(entry)
+        self.entry = None
+
+    def close(self):
+        """Writes the central directory, the file object is left open."""
+        directory_offset = self.fileobj.tell()
+        for entry in self.entries:
+            zip64_fields = []
+            size, compressed_size, offset = entry.size, entry.compressed_size, entry.offset
+            if size > ZIP32_LIMIT or compressed_size > ZIP32_LIMIT or offset > ZIP32_LIMIT:
+                # The zip64 extra field holds the original sizes and offset in this order, once any of them overflows
+                zip64_fields = [size, compressed_size, offset]
+                size = compressed_size = offset = ZIP32_LIMIT
+            extra = struct.pack('<HH{0}Q'.format(len(zip64_fields)), 0x0001, 8 * len(zip64_fields), *zip64_fields) if zip64_fields else b''
+            version = 45 if zip64_fields or entry.zip64 else 20
+            self.fileobj.write(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, version, version, 0, zipfile.ZIP_DEFLATED, ZIP_DOS_TIME,
+                                           ZIP_DOS_DATE, entry.crc, compressed_size, size, len(entry.name), len(extra), 0, 0, 0, 0,
+                                           offset))
+            self.fileobj.write(entry.name)
+            self.fileobj.write(extra)
+
+        directory_end = self.fileobj.tell()
+        directory_size = directory_end - directory_offset
+        if directory_offset > ZIP32_LIMIT or len(self.entries) > 0xFFFF:
+            self.fileobj.write(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, len(self.entries), len(self.entries),
+                                           directory_size, directory_offset))
+            self.fileobj.write(struct.pack('<IIQI', 0x07064b50, 0, directory_end, 1))
+            directory_offset = min(directory_offset, ZIP32_LIMIT)
+        entry_count = min(len(self.entries), 0xFFFF)
+        self.fileobj.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, entry_count, entry_count, directory_size, directory_offset, 0))
+
+
+class StitchedXlsxWriter(object):
+    """Assembles one XLSX file from worksheet parts written in parallel, see SheetPartWriter.
+
+    Everything except the rows of the data worksheet, i.e. the header row, the styles, the workbook metadata and the
+    decoration worksheets, is written by xlsxwriter into a small template workbook in memory. Its entries are copied
+    into the zip container, then the worksheet is written from the start of the template worksheet, the compressed
+    parts in row order and the end of the template worksheet. The parts have to be added in the order of their rows.
+
+    Args:
+        target (str or file object): File path of the XLSX file to be created, or a binary, seekable file object.
+        sheet_name (str): The name of the worksheet to be created.
+        column_names (list): The column names used as header information.
+        column_type_codes (list): The PostgreSQL type OIDs of the columns, defaults to None.
+        decorations (list): ExcelDecoration objects written as additional worksheets, defaults to None.
+        row_count (int): The count of records, if known in advance it is written into the dimension of the worksheet. Defaults to None.
+    """
+    def __init__(self, target, sheet_name, column_names, column_type_codes=None, decorations=None, row_count=None):
+        self.target = target
+        self.sheet_name = sheet_name
+        self.column_names = column_names
+        self.column_type_codes = column_type_codes or [None] * len(column_names)
+        self.row_count = row_count
+        self.written_rows = 0
+        self.fileobj = open(target, 'wb') if isinstance(target, str) else target
+        self.zip_writer = ZipWriter(self.fileobj)
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+
+        template, self.styles = self._template(decorations)
+        with zipfile.ZipFile(template) as template_zip:
+            for name in template_zip.namelist():
+                if name != SHEET_ENTRY_NAME:
+                    self.zip_writer.write_entry(name, template_zip.read(name))
+            sheet_xml = template_zip.read(SHEET_ENTRY_NAME).decode('utf-8')
+
+        self.sheet_start, self.sheet_end = sheet_xml.split('</sheetData>', 1)
+        dimension = ''
+        if row_count is not None:
+            from xlsxwriter.utility import xl_rowcol_to_cell
+
+            dimension = '<dimension ref="A1:{0}"/>'.format(xl_rowcol_to_cell(row_count, max(len(column_names) - 1, 0)))
+        self.sheet_start = _dimension.sub(dimension, self.sheet_start, count=1)
+        self.sheet_started = False
+
+    def _template(self, decorations):
+        """Returns the template workbook in memory and the cell format indexes of the date, datetime and time columns."""
+        template = io.BytesIO()
+        writer = XlsxRowWriter(template, self.sheet_name, self.column_names, self.column_type_codes)
+        writer.write([])
+        # Assigning the indexes registers the formats in the styles, although no cell of the template uses them
+        styles = {'date': writer.date_format._get_xf_index(),
+                  'datetime': writer.datetime_format._get_xf_index(),
+                  'time': writer.time_format._get_xf_index()}
+        if decorations:
+            writer.write_decorations(decorations)
+        writer.close()
+        return template, styles
+
+    def add_part(self, part):
+        """Appends the next SheetPart to the worksheet.
+
+        Raises:
+            ValueError: The worksheet would exceed the maximum number of rows of an XLSX file.
+        """
+        if self.written_rows + part.row_count >= XLSX_MAX_ROWS:
+            raise ValueError("The worksheet exceeds {0} rows, the maximum number of rows in an XLSX file.".format(XLSX_MAX_ROWS))
+        if not self.sheet_started:
+            self._start_sheet(part)
+        self.zip_writer.write_compressed(part.data, part.crc, part.length)
+        self.written_rows += part.row_count
+
+    def _start_sheet(self, first_part=None):
+        # The local header is written before the size is known, zip64 is chosen with twice the size extrapolated from the first part
+        zip64 = False
+        if first_part and first_part.row_count:
+            expected_rows = self.row_count if self.row_count is not None else XLSX_MAX_ROWS
+            zip64 = first_part.length / first_part.row_count * expected_rows * 2 > ZIP32_LIMIT
+        self.zip_writer.begin_entry(SHEET_ENTRY_NAME, zip64)
+        # A full flush empties the history, so the end of the worksheet never refers back across the parts in between
+        self._write_xml(self.sheet_start.encode('utf-8'), zlib.Z_FULL_FLUSH)
+        self.sheet_started = True
+
+    def _write_xml(self, xml, flush_mode):
+        data = self.compressor.compress(xml) + self.compressor.flush(flush_mode)
+        self.zip_writer.write_compressed(data, zlib.crc32(xml), len(xml))
+
+    def close(self):
+        """Finishes the worksheet and the zip container, a given file object is left open."""
+        try:
+            if not self.sheet_started:
+                self._start_sheet()
+            self._write_xml(('</sheetData>' + self.sheet_end).encode('utf-8'), zlib.Z_FINISH)
+            self.zip_writer.end_entry()
+            self.zip_writer.close()
+        finally:
+            if isinstance(self.target, str):
+                self.fileobj.close()
+
+    def abort(self):
+        """Closes a file created from a file path without finishing it, e.g. after a part failed."""
+        if isinstance(self.target, str):
+            self.fileobj.close()